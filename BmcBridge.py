@@ -0,0 +1,322 @@
+import collections
+import queue
+import threading
+import time
+
+from BmcNode import Node, Device, make_message
+
+
+def check_indexes(device: Device, real_indexes):
+    """
+    Make sure no simulated node of the device answers for a real board
+    :param device: the device of the simulated nodes
+    :param real_indexes: the indexes of the real boards
+    :return:
+    """
+    _used = set(device.node_indexes()) & set(real_indexes)
+    if _used:
+        raise ValueError('index {} is used by a simulated node'.format(', '.join(str(_i) for _i in sorted(_used))))
+    pass
+
+
+class _LatencyStats:
+    def __init__(self, samples: int):
+        self.__lock = threading.Lock()
+        self.__samples = collections.deque(maxlen=samples)
+        self.__count = 0
+        self.__max = 0.0
+        pass
+
+    def add(self, latency: float):
+        with self.__lock:
+            self.__samples.append(latency)
+            self.__count += 1
+            if latency > self.__max:
+                self.__max = latency
+                pass
+        pass
+
+    def summary(self) -> dict:
+        with self.__lock:
+            _samples = sorted(self.__samples)
+            _count = self.__count
+            _max = self.__max
+        if not _samples:
+            return {'count': _count, 'mean': 0.0, 'p50': 0.0, 'p99': 0.0, 'max': _max}
+        return {'count': _count,
+                'mean': sum(_samples) / len(_samples),
+                'p50': _samples[len(_samples) // 2],
+                'p99': _samples[min(len(_samples) - 1, len(_samples) * 99 // 100)],
+                'max': _max}
+
+    pass
+
+
+class _Forwarder:
+    """
+    The TX thread of one direction of the bridge, so a slow send of the target device (e.g. the retries of
+    a full CanDevice buffer) does not block the RX thread of the source device.
+    """
+
+    def __init__(self, target: Device, stats: _LatencyStats):
+        self.__target = target
+        self.__stats = stats
+        self.__queue = queue.Queue()
+        self.__thread = None
+        pass
+
+    def put(self, msg, rx_time: float):
+        self.__queue.put((msg, rx_time))
+        pass
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+            pass
+        pass
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+            pass
+        pass
+
+    def __run(self):
+        _running = True
+        while _running:
+            # Take all the queued frames, they are sent by one transmit
+            _items = [self.__queue.get()]
+            while True:
+                try:
+                    _items.append(self.__queue.get_nowait())
+                    pass
+                except queue.Empty:
+                    break
+                pass
+            if None in _items:
+                _running = False
+                _items = _items[:_items.index(None)]
+                pass
+            if not _items:
+                continue
+            try:
+                if len(_items) == 1:
+                    self.__target.transmit(_items[0][0])
+                    pass
+                else:
+                    self.__target.transmit_burst([_msg for _msg, _rx_time in _items])
+                    pass
+                pass
+            except Exception as _e:
+                print('WARNING:', 'bridge send failed: {}'.format(_e))
+                continue
+            _now = time.perf_counter()
+            for _msg, _rx_time in _items:
+                self.__stats.add(_now - _rx_time)
+                pass
+            pass
+        pass
+
+    pass
+
+
+class _BridgeNode(Node):
+    """
+    The stand-in of a board of the other side, it forwards all the frames of its index to the other device.
+    """
+    accepted_ids = None  # all the messages of the index, the board may know more than the simulator
+    exclusive = True  # a simulated node added at the index would cut the board off
+
+    def __init__(self, index: int, forwarder: _Forwarder):
+        self.__id = 0x1a000000 if index == 0 else (index << 24) | 0x10000000
+        self.__forwarder = forwarder
+        self.__forwarding = False
+        pass
+
+    def start(self):
+        self.__forwarding = True
+        pass
+
+    def stop(self):
+        self.__forwarding = False
+        pass
+
+    def on_message(self, msg_id: int, msg_data: bytearray):
+        # Stamped at RX, the data is copied since the device may reuse its buffer (e.g. BmcRing)
+        if self.__forwarding:
+            _rx_time = time.perf_counter()
+            _data = bytearray() if msg_data is None else bytearray(msg_data)
+            self.__forwarder.put(make_message(self.__id | msg_id, _data), _rx_time)
+            pass
+        pass
+
+    pass
+
+
+class CanBridge:
+    """
+    Mix real boards and simulated nodes on one SLC: the frames of the real boards are forwarded between
+    the device of the SLC (e.g. SimCanDevice, the SLC simulator) and the device of the real bus (CanDevice),
+    the other indexes are served by the simulated nodes of the SLC device.
+
+    A stand-in node is registered for every real index on both devices, so the acceptance filters of the
+    real bus pass the frames of the boards. The RX thread of a device only queues the frames, one TX thread
+    per direction sends them, so a stalled send on one side does not stop the RX of the other side. A
+    broadcast request of the SLC is forwarded to every real board by its own index. The simulated nodes
+    must not use a real index, the bridge raises ValueError if one does, and add_node raises ValueError
+    for a node added at a real index after the bridge.
+
+    To host simulated nodes on the real bus next to the boards instead, create them on the CanDevice and
+    call check_indexes with the indexes of the boards.
+    """
+
+    def __init__(self, slc_device: Device, can_device: Device, real_indexes, samples: int = 10000):
+        """
+        :param slc_device: the device of the SLC, e.g. SimCanDevice
+        :param can_device: the device of the real bus with the boards, e.g. CanDevice
+        :param real_indexes: the indexes of the real boards, 0 ~ 9
+        :param samples: the number of the latest latencies kept for the percentiles
+        """
+        self.__real_indexes = sorted(set(real_indexes))
+        check_indexes(slc_device, self.__real_indexes)
+        check_indexes(can_device, self.__real_indexes)
+        self.__to_real = _LatencyStats(samples)
+        self.__to_slc = _LatencyStats(samples)
+        self.__forwarders = (_Forwarder(can_device, self.__to_real), _Forwarder(slc_device, self.__to_slc))
+        self.__nodes = []
+        for _index in self.__real_indexes:
+            _node = _BridgeNode(_index, self.__forwarders[0])
+            slc_device.add_node(_index, _node)
+            self.__nodes.append(_node)
+            _node = _BridgeNode(_index, self.__forwarders[1])
+            can_device.add_node(_index, _node)
+            self.__nodes.append(_node)
+            pass
+        pass
+
+    @property
+    def real_indexes(self) -> list:
+        return list(self.__real_indexes)
+
+    def start(self):
+        for _forwarder in self.__forwarders:
+            _forwarder.start()
+            pass
+        for _node in self.__nodes:
+            _node.start()
+            pass
+        pass
+
+    def stop(self):
+        """
+        Stop forwarding, the frames of the real indexes are dropped by the stand-ins, the frames already
+        received are sent first
+        """
+        for _node in self.__nodes:
+            _node.stop()
+            pass
+        for _forwarder in self.__forwarders:
+            _forwarder.stop()
+            pass
+        pass
+
+    def latency(self) -> dict:
+        """
+        :return: {'to_real': {...}, 'to_slc': {...}} of the forwarded frames: count, and the mean, p50, p99
+                 and max seconds added by the bridge (from the receipt of the frame by the stand-in to the
+                 return of the transmit of the other device)
+        """
+        return {'to_real': self.__to_real.summary(), 'to_slc': self.__to_slc.summary()}
+
+    pass
+
+
+def main():
+    # An SLC stand-in polls 3 indexes: 1 is a "real" board behind the bridge, 2 and 3 are simulated.
+    # The real bus is a crossover of two devices in this process.
+    from BmcNode import BmcNode, SimCanDevice
+    from BmcSlc import SlcStandIn
+
+    class _CrossDevice(Device):
+        def __init__(self):
+            super(_CrossDevice, self).__init__()
+            self.peer = None
+            pass
+
+        def send_message(self, msg):
+            self.peer.on_frame(msg.arbitration_id, msg.data)
+            pass
+
+        pass
+
+    _bus = _CrossDevice()
+    _board_bus = _CrossDevice()
+    _bus.peer = _board_bus
+    _board_bus.peer = _bus
+    _board = BmcNode(1, _board_bus)
+    _board.config(sku='GVSMODBC9', sn='SN-REAL-BOARD-01')
+
+    _device = SimCanDevice('127.0.0.1', 8001)
+    _device.enable()
+    _nodes = []
+    for _i in (2, 3):
+        _node = BmcNode(_i, _device)
+        _node.config(sku='GVSMODBC6')
+        _nodes.append(_node)
+        pass
+    _bridge = CanBridge(_device, _bus, (1,))
+    _bridge.start()
+    _slc = SlcStandIn()
+    _slc.start()
+    _board.start()
+    for _node in _nodes:
+        _node.start()
+        pass
+
+    _polls = 200
+    _replies = sum(len(_node.profile.plans[0x0330]) for _node in [_board] + _nodes)
+    _begin = time.perf_counter()
+    for _r in range(_polls):
+        _slc.poll((1, 2, 3))
+        _slc.wait((_r + 1) * _replies, 2)
+        pass
+    _elapsed = time.perf_counter() - _begin
+    _counts = _slc.counts()
+    print('replies of index 1 (real): {}, 2 and 3 (simulated): {}, {:.0f} frames/s'.format(
+        sum(_v for _k, _v in _counts.items() if (_k >> 24) & 0xf == 1 and _k & 0xffff),
+        sum(_v for _k, _v in _counts.items() if (_k >> 24) & 0xf in (2, 3) and _k & 0xffff),
+        _slc.frames / _elapsed))
+    for _direction, _item in _bridge.latency().items():
+        print('{}: {} frames, mean {:.1f} us, p50 {:.1f} us, p99 {:.1f} us, max {:.1f} us'.format(
+            _direction, _item['count'], _item['mean'] * 1e6, _item['p50'] * 1e6, _item['p99'] * 1e6,
+            _item['max'] * 1e6))
+        pass
+    try:
+        CanBridge(_device, _bus, (2,))
+        pass
+    except ValueError as _e:
+        print('a bridge to index 2 is refused: {}'.format(_e))
+        pass
+    try:
+        BmcNode(1, _device)
+        pass
+    except ValueError as _e:
+        print('a simulated node at index 1 is refused: {}'.format(_e))
+        pass
+
+    _bridge.stop()
+    _board.stop()
+    for _node in _nodes:
+        _node.stop()
+        pass
+    _slc.stop()
+    _device.disable()
+    pass
+
+
+if __name__ == '__main__':
+    main()
+    pass
@@ -0,0 +1,690 @@
+import collections
+import functools
+import heapq
+import itertools
+import threading
+import time
+
+from BmcNode import Device
+
+BITRATE = 500000  # the bitrate of CanDevice
+
+# The bits of an extended data frame after the CRC, which are not stuffed:
+# CRC delimiter, ACK slot, ACK delimiter, end of frame, and the interframe space
+_TAIL_BITS = 1 + 2 + 7 + 3
+
+
+def _crc15(bits: list) -> int:
+    _crc = 0
+    for _bit in bits:
+        _next = _bit ^ ((_crc >> 14) & 1)
+        _crc = (_crc << 1) & 0x7fff
+        if _next:
+            _crc ^= 0x4599
+            pass
+        pass
+    return _crc
+
+
+def _append_bits(bits: list, value: int, count: int):
+    for _i in range(count - 1, -1, -1):
+        bits.append((value >> _i) & 1)
+        pass
+    pass
+
+
+@functools.lru_cache(maxsize=4096)
+def _frame_bits(arbitration_id: int, data: bytes) -> int:
+    _bits = [0]  # SOF
+    _append_bits(_bits, arbitration_id >> 18, 11)  # base id
+    _bits += [1, 1]  # SRR, IDE
+    _append_bits(_bits, arbitration_id, 18)  # extended id
+    _bits += [0, 0, 0]  # RTR, r1, r0
+    _append_bits(_bits, len(data), 4)  # DLC
+    for _byte in data:
+        _append_bits(_bits, _byte, 8)
+        pass
+    _append_bits(_bits, _crc15(_bits), 15)
+    # A stuff bit is inserted after 5 equal bits, it is a part of the next run
+    _stuff = 0
+    _run = 0
+    _last = None
+    for _bit in _bits:
+        if _bit == _last:
+            _run += 1
+            pass
+        else:
+            _last = _bit
+            _run = 1
+            pass
+        if _run == 5:
+            _stuff += 1
+            _last = 1 - _bit
+            _run = 1
+            pass
+        pass
+    return len(_bits) + _stuff + _TAIL_BITS
+
+
+def frame_bits(arbitration_id: int, data=b'') -> int:
+    """
+    :param arbitration_id: 29bit extended CAN id
+    :param data: the frame data, max 8 bytes
+    :return: the bits of the extended data frame on the bus, with the stuff bits and the interframe space
+    """
+    return _frame_bits(arbitration_id & 0x1fffffff, bytes(data))
+
+
+def worst_case_bits(dlc: int) -> int:
+    """
+    :param dlc: the data length
+    :return: the max bits of an extended data frame of the length, with the most stuff bits
+    """
+    _stuffed = 54 + 8 * dlc  # SOF ~ CRC
+    return _stuffed + (_stuffed - 1) // 4 + _TAIL_BITS
+
+
+def estimate_reply_load(nodes, msg_id: int = 0x0330, period: float = 1.0, bitrate: int = BITRATE) -> float:
+    """
+    Estimate the bus load of the replies if every node is polled once per period, with worst case stuffing
+    :param nodes: the BmcNode instances
+    :param msg_id: the request id
+    :param period: seconds between two requests of one node
+    :param bitrate: the bitrate of the bus
+    :return: the load, 1.0 is a full bus
+    """
+    _bits = 0
+    for _node in nodes:
+        for _codec in _node.profile.plans.get(msg_id, ()):
+            _bits += worst_case_bits(_codec.struct.size)
+            pass
+        pass
+    return _bits / period / bitrate
+
+
+class BusLoadMeter:
+    """
+    Sliding window of the bits on a bus
+    """
+
+    def __init__(self, bitrate: int = BITRATE, window: float = 1.0):
+        """
+        :param bitrate: the bitrate of the bus
+        :param window: seconds of the window
+        """
+        self.__bitrate = bitrate
+        self.__window = window
+        self.__records = collections.deque()  # (time, bits)
+        self.__bits = 0
+        self.__frames = 0
+        self.__total_bits = 0
+        self.__peak = 0.0
+        self.__lock = threading.Lock()
+        pass
+
+    def add(self, bits: int, now: float = None):
+        _now = time.monotonic() if now is None else now
+        with self.__lock:
+            self.__records.append((_now, bits))
+            self.__bits += bits
+            self.__frames += 1
+            self.__total_bits += bits
+            self.__expire(_now)
+            _load = self.__bits / (self.__bitrate * self.__window)
+            if _load > self.__peak:
+                self.__peak = _load
+                pass
+        pass
+
+    def __expire(self, now: float):
+        _records = self.__records
+        while _records and _records[0][0] <= now - self.__window:
+            self.__bits -= _records.popleft()[1]
+            pass
+        pass
+
+    @property
+    def load(self) -> float:
+        """
+        :return: the load of the last window, 1.0 is a full bus
+        """
+        with self.__lock:
+            self.__expire(time.monotonic())
+            return self.__bits / (self.__bitrate * self.__window)
+
+    @property
+    def peak(self) -> float:
+        return self.__peak
+
+    @property
+    def frames(self) -> int:
+        return self.__frames
+
+    @property
+    def total_bits(self) -> int:
+        return self.__total_bits
+
+    pass
+
+
+class ArbitrationScheduler:
+    """
+    Pace the frames of the nodes of a device like the bus would: the pending frame with the lowest CAN id
+    wins the arbitration and is sent first, and the sent bits are kept under max_load of the bitrate, so
+    a burst of replies is spread instead of overrunning the controller.
+
+    It is the transmitter of the device (Device.set_transmitter) while started.
+    """
+
+    def __init__(self, device: Device, bitrate: int = BITRATE, max_load: float = 0.7, window: float = 1.0):
+        """
+        :param device: the device instance
+        :param bitrate: the bitrate of the bus
+        :param max_load: the max load of the sent frames, 0 ~ 1
+        :param window: seconds of the window of the load figures
+        """
+        if max_load <= 0 or max_load > 1:
+            raise ValueError('max_load must be in 0 ~ 1')
+        self.__device = device
+        self.__bitrate = bitrate
+        self.__max_load = max_load
+        self.__heap = []
+        self.__seq = itertools.count()  # the frames with the same id keep their order
+        self.__cond = threading.Condition()
+        self.__offered = BusLoadMeter(bitrate, window)
+        self.__sent = BusLoadMeter(bitrate, window)
+        self.__high_water = 0
+        self.__sink = None
+        self.__thread = None
+        self.__terminal = False
+        pass
+
+    @property
+    def offered_load(self) -> float:
+        """
+        :return: the load of the frames submitted by the nodes in the last window
+        """
+        return self.__offered.load
+
+    @property
+    def utilization(self) -> float:
+        """
+        :return: the load of the sent frames in the last window
+        """
+        return self.__sent.load
+
+    @property
+    def peak_utilization(self) -> float:
+        return self.__sent.peak
+
+    @property
+    def sent(self) -> int:
+        return self.__sent.frames
+
+    @property
+    def pending(self) -> int:
+        return len(self.__heap)
+
+    @property
+    def high_water(self) -> int:
+        """
+        :return: the max number of pending frames ever seen
+        """
+        return self.__high_water
+
+    def set_max_load(self, max_load: float):
+        if max_load <= 0 or max_load > 1:
+            raise ValueError('max_load must be in 0 ~ 1')
+        with self.__cond:
+            self.__max_load = max_load
+            self.__cond.notify()
+        pass
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        # Chain to the transmitter installed before, e.g. a fault stage
+        self.__sink = self.__device.transmitter or self.__device.send_message
+        self.__terminal = False
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+        self.__device.set_transmitter(self.submit)
+        pass
+
+    def stop(self):
+        """
+        Restore the transmitter of the device, the pending frames are sent at once
+        """
+        if self.__thread is None:
+            return
+        self.__device.set_transmitter(None if self.__sink == self.__device.send_message else self.__sink)
+        with self.__cond:
+            self.__terminal = True
+            self.__cond.notify()
+        self.__thread.join()
+        self.__thread = None
+        pass
+
+    def submit(self, msg):
+        _bits = frame_bits(msg.arbitration_id, msg.data)
+        self.__offered.add(_bits)
+        with self.__cond:
+            heapq.heappush(self.__heap, (msg.arbitration_id, next(self.__seq), _bits, msg))
+            if len(self.__heap) > self.__high_water:
+                self.__high_water = len(self.__heap)
+                pass
+            self.__cond.notify()
+        pass
+
+    def __run(self):
+        _tokens = 0.0
+        _tokens_time = time.monotonic()
+        while True:
+            with self.__cond:
+                while True:
+                    if self.__terminal:
+                        break
+                    if not self.__heap:
+                        self.__cond.wait()
+                        continue
+                    # Token bucket of bits, it holds a few frames so a short burst is not delayed
+                    _rate = self.__bitrate * self.__max_load
+                    _now = time.monotonic()
+                    _tokens = min(max(worst_case_bits(8), _rate * 0.002), _tokens + (_now - _tokens_time) * _rate)
+                    _tokens_time = _now
+                    _bits = self.__heap[0][2]
+                    if _tokens >= _bits:
+                        break
+                    self.__cond.wait((_bits - _tokens) / _rate)
+                    pass
+                if self.__terminal:
+                    _items = sorted(self.__heap)
+                    self.__heap = []
+                    pass
+                else:
+                    _items = [heapq.heappop(self.__heap)]
+                    _tokens -= _items[0][2]
+                    pass
+            for _id, _seq, _bits, _msg in _items:
+                try:
+                    self.__sink(_msg)
+                    pass
+                except Exception as _e:
+                    print('WARNING:', 'send failed: {}'.format(_e))
+                    pass
+                self.__sent.add(_bits)
+                pass
+            if self.__terminal:
+                break
+            pass
+        pass
+
+    pass
+
+
+class VirtualBus:
+    """
+    A CAN bus in the process, without sockets or a kernel: every frame sent by an endpoint is passed to
+    all the other endpoints, e.g. the VirtualCanDevice of the simulated BMCs, an SLC stand-in, a recorder.
+
+    The pending frame with the lowest CAN id wins the arbitration, frames with the same id keep their order,
+    and every endpoint receives the frames in the same order. The data object of a frame is passed to the
+    endpoints as it is, without a copy, the receivers must not change it.
+
+    Without a bitrate the frames are delivered at once by the thread of the sender, or by the thread which
+    is delivering already, so a frame sent by a receiver is delivered after the current one. With a bitrate
+    a thread of the bus delivers them at the end of their bit time, like the wire would.
+    """
+
+    def __init__(self, bitrate: int = None, window: float = 1.0):
+        """
+        :param bitrate: the bitrate of the simulated bit time, None delivers the frames at once
+        :param window: seconds of the window of the load figures of a paced bus
+        """
+        if bitrate is not None and bitrate <= 0:
+            raise ValueError('bitrate must be greater than 0')
+        self.__bitrate = bitrate
+        self.__endpoints = ()  # (endpoint, receiver), replaced by attach and detach
+        self.__heap = []
+        self.__seq = itertools.count()
+        self.__cond = threading.Condition()
+        self.__delivering = False
+        self.__frames = 0
+        self.__high_water = 0
+        self.__meter = None
+        self.__thread = None
+        self.__terminal = False
+        if bitrate is not None:
+            self.__meter = BusLoadMeter(bitrate, window)
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+            pass
+        pass
+
+    @property
+    def bitrate(self):
+        return self.__bitrate
+
+    @property
+    def frames(self) -> int:
+        """
+        :return: the number of delivered frames
+        """
+        return self.__frames
+
+    @property
+    def pending(self) -> int:
+        return len(self.__heap)
+
+    @property
+    def high_water(self) -> int:
+        """
+        :return: the max number of pending frames ever seen
+        """
+        return self.__high_water
+
+    @property
+    def utilization(self) -> float:
+        """
+        :return: the load of the last window of a paced bus, 0.0 without a bitrate
+        """
+        return 0.0 if self.__meter is None else self.__meter.load
+
+    def attach(self, receiver, endpoint=None):
+        """
+        :param receiver: receiver(arbitration_id, data), called for every frame of the other endpoints
+        :param endpoint: the sender of the frames of this receiver, default is the receiver itself
+        :return: the endpoint, for send and detach
+        """
+        _endpoint = receiver if endpoint is None else endpoint
+        with self.__cond:
+            self.__endpoints = tuple(_item for _item in self.__endpoints if _item[0] is not _endpoint) + \
+                ((_endpoint, receiver),)
+        return _endpoint
+
+    def detach(self, endpoint):
+        with self.__cond:
+            self.__endpoints = tuple(_item for _item in self.__endpoints if _item[0] is not endpoint)
+        pass
+
+    def send(self, arbitration_id: int, data, sender=None):
+        """
+        :param arbitration_id: 29bit extended CAN id
+        :param data: the frame data
+        :param sender: the endpoint which sends it, it does not receive its own frame
+        :return:
+        """
+        self.send_burst(((arbitration_id, data),), sender)
+        pass
+
+    def send_burst(self, frames, sender=None):
+        """
+        :param frames: list of (arbitration_id, data), they take part in one arbitration
+        :param sender: the endpoint which sends them
+        :return:
+        """
+        with self.__cond:
+            if self.__terminal:
+                return
+            for _id, _data in frames:
+                heapq.heappush(self.__heap, (_id, next(self.__seq), _data, sender))
+                pass
+            if len(self.__heap) > self.__high_water:
+                self.__high_water = len(self.__heap)
+                pass
+            if self.__thread is not None:
+                self.__cond.notify()
+                return
+            if self.__delivering:
+                return
+            self.__delivering = True
+        self.__drain()
+        pass
+
+    def close(self):
+        """
+        Stop the thread of a paced bus, the pending frames are delivered at once, later frames are dropped
+        """
+        with self.__cond:
+            self.__terminal = True
+            self.__cond.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+            pass
+        pass
+
+    def __deliver(self, endpoints: tuple, frame: tuple):
+        _id, _seq, _data, _sender = frame
+        for _endpoint, _receiver in endpoints:
+            if _endpoint is not _sender:
+                try:
+                    _receiver(_id, _data)
+                    pass
+                except Exception as _e:
+                    print('WARNING:', 'virtual bus receiver failed: {}'.format(_e))
+                    pass
+                pass
+            pass
+        pass
+
+    def __drain(self):
+        # The delivering thread takes the frames until none is pending, a frame sent by a receiver is queued
+        _heap = self.__heap
+        while True:
+            with self.__cond:
+                if not _heap:
+                    self.__delivering = False
+                    return
+                _frame = heapq.heappop(_heap)
+                _endpoints = self.__endpoints
+                self.__frames += 1
+            self.__deliver(_endpoints, _frame)
+            pass
+        pass
+
+    def __run(self):
+        # The arbitration is done when the bus is free, the frame is delivered at the end of its bits
+        _heap = self.__heap
+        _due = time.monotonic()
+        while True:
+            with self.__cond:
+                _idle = not _heap
+                while not _heap and not self.__terminal:
+                    self.__cond.wait()
+                    pass
+                if self.__terminal:
+                    _frames = sorted(_heap)
+                    del _heap[:]
+                    _endpoints = self.__endpoints
+                    self.__frames += len(_frames)
+                    break
+                _frame = heapq.heappop(_heap)
+                _endpoints = self.__endpoints
+                pass
+            _bits = frame_bits(_frame[0], _frame[2])
+            _now = time.monotonic()
+            if _idle or _due < _now - 0.01:
+                # A late wake-up of a busy bus is caught up, an idle bus starts now
+                _due = max(_due, _now)
+                pass
+            _due += _bits / self.__bitrate
+            if _due > _now:
+                time.sleep(_due - _now)
+                pass
+            self.__meter.add(_bits)
+            with self.__cond:
+                self.__frames += 1
+            self.__deliver(_endpoints, _frame)
+            pass
+        for _frame in _frames:
+            self.__deliver(_endpoints, _frame)
+            pass
+        pass
+
+    pass
+
+
+class VirtualCanDevice(Device):
+    """
+    The device of a VirtualBus, the nodes of it talk to the other endpoints of the bus. The frames are
+    passed without a copy, and its own frames are not received.
+    """
+
+    def __init__(self, bus: VirtualBus):
+        """
+        :param bus: the virtual bus
+        """
+        super(VirtualCanDevice, self).__init__()
+        self.__bus = bus
+        self.__enabled = False
+        pass
+
+    @property
+    def bus(self) -> VirtualBus:
+        return self.__bus
+
+    def enable(self):
+        if not self.__enabled:
+            self.__bus.attach(self.on_frame, self)
+            self.__enabled = True
+            pass
+        pass
+
+    def disable(self):
+        if self.__enabled:
+            self.__enabled = False
+            self.__bus.detach(self)
+            pass
+        pass
+
+    def send_message(self, msg):
+        if not self.__enabled:
+            raise IOError('Virtual CAN device is not enabled')
+        self.__bus.send(msg.arbitration_id, msg.data, self)
+        pass
+
+    def send_burst(self, msgs: list):
+        if not self.__enabled:
+            raise IOError('Virtual CAN device is not enabled')
+        self.__bus.send_burst([(_msg.arbitration_id, _msg.data) for _msg in msgs], self)
+        pass
+
+    pass
+
+
+def main():
+    from BmcNode import BmcNode, make_message
+
+    print('bits of 0x11000330 without data: {}, 8 bytes of 0x00: {}, 8 bytes of 0x55: {}, worst case: {}'.format(
+        frame_bits(0x11000330), frame_bits(0x11000330, bytes(8)), frame_bits(0x11000330, b'\x55' * 8),
+        worst_case_bits(8)))
+
+    class _CountDevice(Device):
+        def __init__(self):
+            super(_CountDevice, self).__init__()
+            self.count = 0
+            pass
+
+        def send_message(self, msg):
+            self.count += 1
+            pass
+
+        pass
+
+    _device = _CountDevice()
+    _nodes = []
+    for _i in range(10):
+        _node = BmcNode(_i, _device)
+        _node.config(sku='GVSMODBC9')
+        _nodes.append(_node)
+        pass
+    print('10 nodes polled by 0x0330 every 100ms: {:.1%} of {} bit/s'.format(
+        estimate_reply_load(_nodes, 0x0330, 0.1), BITRATE))
+
+    # The replies of 10 nodes to 5 polls, paced at 50% load
+    for _node in _nodes:
+        _node.start()
+        pass
+    _scheduler = ArbitrationScheduler(_device, max_load=0.5)
+    _scheduler.start()
+    _begin = time.monotonic()
+    for _r in range(5):
+        _device.on_message(make_message((Device.E_BROADCAST_INDEX << 24) | 0x10000330))
+        pass
+    _replies = 5 * sum(len(_node.profile.plans[0x0330]) for _node in _nodes)
+    while _scheduler.sent < _replies:
+        time.sleep(0.01)
+        pass
+    _elapsed = time.monotonic() - _begin
+    print('sent: {} frames in {:.3f}s, utilization: {:.1%}, peak: {:.1%}, high water: {}'.format(
+        _scheduler.sent, _elapsed, _scheduler.utilization, _scheduler.peak_utilization, _scheduler.high_water))
+    _scheduler.stop()
+    for _node in _nodes:
+        _node.stop()
+        pass
+
+    # The overhead of the simulator alone: 10 nodes on a virtual bus polled by an SLC endpoint
+    class _Slc:
+        def __init__(self):
+            self.cond = threading.Condition()
+            self.ids = []
+            pass
+
+        def __call__(self, arbitration_id, data):
+            with self.cond:
+                self.ids.append(arbitration_id)
+                self.cond.notify()
+            pass
+
+        def wait(self, frames: int):
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.ids) >= frames, 10)
+            pass
+
+        pass
+
+    for _bitrate in (None, BITRATE):
+        _bus = VirtualBus(_bitrate)
+        _device = VirtualCanDevice(_bus)
+        _device.enable()
+        _nodes = []
+        for _i in range(10):
+            _node = BmcNode(_i, _device)
+            _node.config(sku='GVSMODBC9')
+            _node.start()
+            _nodes.append(_node)
+            pass
+        _slc = _Slc()
+        _bus.attach(_slc)
+        _polls = 1000 if _bitrate is None else 5
+        _replies = sum(len(_node.profile.plans[0x0330]) for _node in _nodes)
+        _begin = time.perf_counter()
+        for _r in range(_polls):
+            _bus.send_burst([(((_i << 24) | 0x10000330) if _i else 0x1a000330, b'') for _i in range(10)], _slc)
+            _slc.wait((_r + 1) * _replies)
+            pass
+        _elapsed = time.perf_counter() - _begin
+        if _bitrate is None:
+            print('virtual bus: {} frames in {:.3f}s, {:.0f} frames/s, {:.1f} us per frame'.format(
+                len(_slc.ids), _elapsed, len(_slc.ids) / _elapsed, _elapsed / len(_slc.ids) * 1e6))
+            pass
+        else:
+            # The replies of one poll are pending at once, the lowest id wins
+            _ordered = sum(1 for _a, _b in zip(_slc.ids, _slc.ids[1:]) if _a <= _b)
+            print('virtual bus at {} bit/s: {} frames in {:.3f}s, utilization: {:.1%}, '
+                  'ordered pairs: {} of {}'.format(_bitrate, len(_slc.ids), _elapsed, _bus.utilization, _ordered,
+                                                   len(_slc.ids) - 1))
+            pass
+        for _node in _nodes:
+            _node.stop()
+            pass
+        _device.disable()
+        _bus.close()
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    main()
+    pass
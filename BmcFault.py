@@ -0,0 +1,272 @@
+import random
+import threading
+import time
+
+from BmcNode import Device, make_message
+from BmcTiming import Scheduler, shared_scheduler
+
+
+class FaultStage:
+    """
+    Inject faults into the frames of a device: drop, duplicate, delay, reorder, corrupt, and heartbeat gaps.
+
+    A stage is attached to one direction of one device: attach_tx puts it between the nodes and
+    Device.send_message (as the transmitter), attach_rx puts it before the dispatch to the nodes (as the
+    receiver). Stages are chained by attaching them one after another, and must be detached in the reverse
+    order. A detached stage costs nothing.
+
+    Every frame takes at most one fault, chosen by one draw of a seeded random generator, so a run with
+    the same seed and the same frame order injects the same faults.
+    """
+
+    def __init__(self, drop: float = 0.0, duplicate: float = 0.0, delay: float = 0.0, max_delay: float = 0.01,
+                 reorder: float = 0.0, corrupt: float = 0.0, msg_ids=None, indexes=None, seed: int = None,
+                 scheduler: Scheduler = None):
+        """
+        :param drop: the probability of a dropped frame
+        :param duplicate: the probability of a frame sent twice
+        :param delay: the probability of a delayed frame
+        :param max_delay: seconds, a delayed frame is delayed by 0 ~ max_delay
+        :param reorder: the probability of a frame held back and sent after the next frame
+        :param corrupt: the probability of a frame with one flipped data bit
+        :param msg_ids: the 16bit message ids to inject faults, None means all
+        :param indexes: the node indexes to inject faults, None means all
+        :param seed: the seed of the random generator
+        :param scheduler: the scheduler of the delayed frames, default is the shared scheduler
+        """
+        _total = drop + duplicate + delay + reorder + corrupt
+        if min(drop, duplicate, delay, reorder, corrupt) < 0 or _total > 1:
+            raise ValueError('the probabilities must be positive and the sum must not exceed 1')
+        # Cumulative thresholds of one draw
+        self.__drop = drop
+        self.__duplicate = self.__drop + duplicate
+        self.__delay = self.__duplicate + delay
+        self.__reorder = self.__delay + reorder
+        self.__corrupt = self.__reorder + corrupt
+        self.__max_delay = max_delay
+        self.__msg_ids = None if msg_ids is None else frozenset(msg_ids)
+        self.__indexes = None if indexes is None else frozenset(indexes)
+        self.__random = random.Random(seed)
+        self.__scheduler = scheduler
+        self.__lock = threading.Lock()
+        self.__held = None  # the frame held back by reorder
+        self.__gaps = {}  # node index: the end time of the heartbeat gap
+        self.__counters = dict.fromkeys(
+            ('passed', 'dropped', 'duplicated', 'delayed', 'reordered', 'corrupted', 'heartbeat_dropped'), 0)
+        self.__device = None
+        self.__tx = False
+        self.__sink = None
+        pass
+
+    @property
+    def counters(self) -> dict:
+        """
+        :return: the number of the frames of every fault, and of the passed frames
+        """
+        with self.__lock:
+            return dict(self.__counters)
+
+    def attach_tx(self, device: Device):
+        """
+        Inject faults into the frames sent by the nodes of the device
+        """
+        self.__attach(device, True)
+        pass
+
+    def attach_rx(self, device: Device):
+        """
+        Inject faults into the frames received by the device before they reach the nodes
+        """
+        self.__attach(device, False)
+        pass
+
+    def __attach(self, device: Device, tx: bool):
+        if self.__device is not None:
+            raise ValueError('the stage is attached')
+        self.__device = device
+        self.__tx = tx
+        if tx:
+            self.__sink = device.transmitter or device.send_message
+            device.set_transmitter(self.__on_tx)
+            pass
+        else:
+            self.__sink = device.receiver or device.dispatch
+            device.set_receiver(self.__on_rx)
+            pass
+        pass
+
+    def detach(self):
+        """
+        Restore the device, a frame held back by reorder is sent
+        """
+        _device = self.__device
+        if _device is None:
+            return
+        if self.__tx:
+            _device.set_transmitter(None if self.__sink == _device.send_message else self.__sink)
+            pass
+        else:
+            _device.set_receiver(None if self.__sink == _device.dispatch else self.__sink)
+            pass
+        self.__flush()
+        self.__device = None
+        pass
+
+    def heartbeat_gap(self, duration: float, indexes=None):
+        """
+        Drop the heartbeats (message id 0) of the nodes for a while
+        :param duration: seconds
+        :param indexes: the node indexes, None means all
+        :return:
+        """
+        _end = time.monotonic() + duration
+        with self.__lock:
+            for _index in (range(10) if indexes is None else indexes):
+                self.__gaps[_index] = _end
+                pass
+        pass
+
+    def __on_tx(self, msg):
+        self.__inject(msg.arbitration_id, msg.data, msg)
+        pass
+
+    def __on_rx(self, arbitration_id: int, data):
+        self.__inject(arbitration_id, data, None)
+        pass
+
+    def __emit(self, arbitration_id: int, data, msg):
+        if self.__tx:
+            self.__sink(msg if msg is not None else make_message(arbitration_id, data))
+            pass
+        else:
+            self.__sink(arbitration_id, data)
+            pass
+        pass
+
+    def __flush(self):
+        with self.__lock:
+            _held = self.__held
+            self.__held = None
+        if _held is not None:
+            self.__emit(*_held)
+            pass
+        pass
+
+    def __inject(self, arbitration_id: int, data, msg):
+        _index = (arbitration_id >> 24) & 0xf
+        if _index == 0xa:
+            _index = 0
+            pass
+        if self.__gaps and (arbitration_id & 0xffff) == 0 and _index in self.__gaps:
+            with self.__lock:
+                if time.monotonic() < self.__gaps.get(_index, 0):
+                    self.__counters['heartbeat_dropped'] += 1
+                    return
+                self.__gaps.pop(_index, None)
+            pass
+        if (self.__msg_ids is not None and (arbitration_id & 0xffff) not in self.__msg_ids) or \
+                (self.__indexes is not None and _index not in self.__indexes):
+            _r = 1.0
+            pass
+        else:
+            with self.__lock:
+                _r = self.__random.random()
+                pass
+            pass
+
+        if _r >= self.__corrupt:
+            # Most frames pass, the frame held back by reorder follows them
+            with self.__lock:
+                self.__counters['passed'] += 1
+                _held = self.__held
+                self.__held = None
+            self.__emit(arbitration_id, data, msg)
+            if _held is not None:
+                self.__emit(*_held)
+                pass
+            return
+
+        if _r < self.__drop:
+            with self.__lock:
+                self.__counters['dropped'] += 1
+            pass
+        elif _r < self.__duplicate:
+            with self.__lock:
+                self.__counters['duplicated'] += 1
+            self.__emit(arbitration_id, data, msg)
+            self.__emit(arbitration_id, data, msg)
+            pass
+        elif _r < self.__delay:
+            with self.__lock:
+                self.__counters['delayed'] += 1
+                _delay = self.__random.uniform(0.0, self.__max_delay)
+            _scheduler = self.__scheduler if self.__scheduler is not None else shared_scheduler()
+            # The data of a received frame may be a view which is only valid during this call
+            _scheduler.call_later(_delay, self.__emit, arbitration_id, bytearray(data), msg)
+            pass
+        elif _r < self.__reorder:
+            with self.__lock:
+                self.__counters['reordered'] += 1
+                _held = self.__held
+                self.__held = (arbitration_id, bytearray(data), msg)
+            if _held is not None:
+                self.__emit(*_held)
+                pass
+            pass
+        else:
+            _data = bytearray(data)
+            with self.__lock:
+                self.__counters['corrupted'] += 1
+                if _data:
+                    _bit = self.__random.randrange(len(_data) * 8)
+                    _data[_bit >> 3] ^= 1 << (_bit & 7)
+                    pass
+            self.__emit(arbitration_id, _data, None)
+            pass
+        pass
+
+    pass
+
+
+def main():
+    # The cost of a transmit without a stage, with a stage injecting nothing, and with faults
+    class _CountDevice(Device):
+        def __init__(self):
+            super(_CountDevice, self).__init__()
+            self.count = 0
+            pass
+
+        def send_message(self, msg):
+            self.count += 1
+            pass
+
+        pass
+
+    _frames = 200000
+    _msgs = [make_message(0x11000330 + (_i & 0x1f), bytearray(8)) for _i in range(64)]
+    for _name, _stage in (('no stage', None),
+                          ('stage without faults', FaultStage(seed=1)),
+                          ('stage with 5% faults', FaultStage(drop=0.01, duplicate=0.01, reorder=0.01,
+                                                              corrupt=0.02, seed=1))):
+        _device = _CountDevice()
+        if _stage is not None:
+            _stage.attach_tx(_device)
+            pass
+        _begin = time.perf_counter()
+        for _i in range(_frames):
+            _device.transmit(_msgs[_i & 0x3f])
+            pass
+        _elapsed = time.perf_counter() - _begin
+        if _stage is not None:
+            _stage.detach()
+            pass
+        print('{}: {:.2f} us per frame, sent: {}{}'.format(
+            _name, _elapsed / _frames * 1e6, _device.count,
+            '' if _stage is None else ', {}'.format(_stage.counters)))
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    main()
+    pass
@@ -1,13 +1,67 @@
-import can
 import sys
 import threading
 import queue
 import time
 import socket
+import collections
+import functools
+import re
+import array
+import struct
+import mmap
+import math
 from abc import ABCMeta, abstractmethod
 
 
+class Frame:
+    """
+    An extended CAN frame. It has the attributes of can.Message used by the devices, so the simulator
+    devices run without python-can, and CanDevice turns it into a can.Message.
+    """
+    __slots__ = ('arbitration_id', 'data')
+    is_extended_id = True
+
+    def __init__(self, arbitration_id: int, data=None):
+        self.arbitration_id = arbitration_id
+        self.data = bytearray() if data is None else data if isinstance(data, bytearray) else bytearray(data)
+        pass
+
+    @property
+    def dlc(self) -> int:
+        return len(self.data)
+
+    def __repr__(self):
+        return 'Frame(0x{:0>8X}, {})'.format(self.arbitration_id, ' '.join('{:0>2X}'.format(_v) for _v in self.data))
+
+    pass
+
+
+def make_message(arbitration_id: int, data=None) -> Frame:
+    """
+    :param arbitration_id: 29bit extended CAN id
+    :param data: message data
+    :return: the CAN message
+    """
+    return Frame(arbitration_id, data)
+
+
+def _can_error(text: str) -> OSError:
+    # can.CanError (an OSError) if python-can is installed, so the callers catch the same error as before
+    try:
+        import can
+        return can.CanError(text)
+    except ImportError:
+        return OSError(text)
+
+
 class Node:
+    __slots__ = ()
+    # The 16bit message ids handled by the node, the device can filter the other frames out.
+    # None means all messages.
+    accepted_ids = None
+    # True if no other node may take the index of this node by add_node, it must be removed first
+    exclusive = False
+
     @abstractmethod
     def start(self):
         pass
@@ -25,9 +79,18 @@ class Node:
 
 
 class Device:
+    # Simulator only: a frame with this index is a broadcast to all nodes of the device, see fan_out
+    E_BROADCAST_INDEX = 0xf
+
     def __init__(self):
         self.__nodes = {}
         self.__lock = threading.Lock()
+        self.__receiver = None
+        self.__transmitter = None
+        self.__fan_out_window = None
+        self.__fan_out_pending = {}  # msg id: set of node indexes
+        self.__fan_out_cond = threading.Condition()
+        self.__fan_out_thread = None
         pass
 
     def add_node(self, index: int, node: Node):
@@ -36,30 +99,268 @@ class Device:
             raise ValueError(_error_msg)
             pass
         with self.__lock:
+            _node = self.__nodes.get(index)
+            if _node is not None and _node is not node and _node.exclusive:
+                raise ValueError('index {} is taken by {}'.format(index, type(_node).__name__))
             self.__nodes[index] = node
         pass
 
+    def remove_node(self, index: int, node: Node = None) -> bool:
+        """
+        Unregister a node, the frames of its index are ignored then
+        :param index: the node index
+        :param node: only remove this node, None removes any node of the index
+        :return: False if no node is removed
+        """
+        with self.__lock:
+            if index not in self.__nodes or (node is not None and self.__nodes[index] is not node):
+                return False
+            del self.__nodes[index]
+        return True
+
+    def node_indexes(self) -> list:
+        """
+        :return: the indexes of the registered nodes
+        """
+        with self.__lock:
+            return sorted(self.__nodes)
+
+    def acceptance_filters(self) -> list:
+        """
+        The acceptance filters of the frames for the registered nodes, the frame is accepted if
+        (arbitration_id & can_mask) == can_id for any filter
+        :return: list of (can_id, can_mask) of 29bit extended ids
+        """
+        with self.__lock:
+            _nodes = sorted(self.__nodes.items())
+        _filters = []
+        _broadcast_ids = set()
+        for _index, _node in _nodes:
+            _nibble = 0xa if _index == 0 else _index
+            if _node.accepted_ids is None:
+                _filters.append((_nibble << 24, 0x0f000000))
+                _broadcast_ids = None
+                pass
+            else:
+                _filters.extend(((_nibble << 24) | _msg_id, 0x0f00ffff) for _msg_id in _node.accepted_ids)
+                if _broadcast_ids is not None:
+                    _broadcast_ids.update(_node.accepted_ids)
+                    pass
+                pass
+            pass
+        if _nodes:
+            if _broadcast_ids is None:
+                _filters.append((Device.E_BROADCAST_INDEX << 24, 0x0f000000))
+                pass
+            else:
+                _filters.extend(((Device.E_BROADCAST_INDEX << 24) | _msg_id, 0x0f00ffff)
+                                for _msg_id in sorted(_broadcast_ids))
+                pass
+            pass
+        return _filters
+
+    def set_receiver(self, receiver):
+        """
+        :param receiver: receiver(arbitration_id, data), it takes the received frames instead of dispatch,
+                         e.g. BmcRing.RxDispatcher hands them over to its consumer threads. None restores
+                         the direct dispatch.
+        :return:
+        """
+        self.__receiver = receiver
+        pass
+
+    @property
+    def receiver(self):
+        return self.__receiver
+
+    def set_transmitter(self, transmitter):
+        """
+        :param transmitter: transmitter(msg), it takes the frames of the nodes instead of send_message,
+                            e.g. BmcBus.ArbitrationScheduler paces them. None restores the direct send.
+        :return:
+        """
+        self.__transmitter = transmitter
+        pass
+
+    @property
+    def transmitter(self):
+        return self.__transmitter
+
+    def transmit(self, msg):
+        """
+        Send a frame of a node, through the transmitter if there is one
+        """
+        _transmitter = self.__transmitter
+        if _transmitter is None:
+            self.send_message(msg)
+            pass
+        else:
+            _transmitter(msg)
+            pass
+        pass
+
+    def transmit_burst(self, msgs: list):
+        """
+        Send many frames of the nodes, through the transmitter if there is one, otherwise by send_burst
+        """
+        _transmitter = self.__transmitter
+        if _transmitter is None:
+            self.send_burst(msgs)
+            pass
+        else:
+            for _msg in msgs:
+                _transmitter(_msg)
+                pass
+            pass
+        pass
+
     def on_message(self, msg):
         # print(msg)
+        self.on_frame(msg.arbitration_id, msg.data)
+        pass
+
+    def on_frame(self, arbitration_id: int, data):
+        """
+        A received frame without a message object, for the devices parsing the frames by themselves
+        """
+        _receiver = self.__receiver
+        if _receiver is None:
+            self.dispatch(arbitration_id, data)
+            pass
+        else:
+            _receiver(arbitration_id, data)
+            pass
+        pass
+
+    def dispatch(self, arbitration_id: int, data):
         # max supports 10 BMCs and index range is 0 ~ 9
-        _index = (msg.arbitration_id >> 24) & 0xf
+        _index = (arbitration_id >> 24) & 0xf
         if _index == 0xa:
             _index = 0
             pass
+        elif _index == Device.E_BROADCAST_INDEX:
+            self.fan_out(arbitration_id & 0xffff, data)
+            return
         elif _index < 1 or _index > 0xa:
             _index = None
             pass
         else:
             pass
+        if self.__fan_out_window is not None and (arbitration_id & 0xffff) in _REQUEST_CODECS:
+            with self.__fan_out_cond:
+                self.__fan_out_pending.setdefault(arbitration_id & 0xffff, set()).add(_index)
+                self.__fan_out_cond.notify()
+            return
         try:
             with self.__lock:
                 _node = self.__nodes[_index]
-            _node.on_message(msg.arbitration_id & 0xffff, msg.data)
+            _node.on_message(arbitration_id & 0xffff, data)
             pass
         except KeyError:
             pass
         pass
 
+    def fan_out(self, msg_id: int, msg_data=None, indexes=None) -> int:
+        """
+        Let many nodes respond to the same request in one pass: the replies of all nodes are encoded
+        message by message from one snapshot per node, then the replies of every node are queued to its
+        TX thread as one burst, so they keep their order with the other frames of the node.
+        :param msg_id: 16bit request id
+        :param msg_data: request data
+        :param indexes: the indexes of the target nodes, None means all nodes
+        :return: the number of queued frames
+        """
+        with self.__lock:
+            _nodes = [_node for _index, _node in self.__nodes.items() if indexes is None or _index in indexes]
+        _codecs = _REQUEST_CODECS.get(msg_id)
+        _now = time.monotonic()
+        _groups = {}  # the nodes of the same plan: plan: [(id, identity, state, frames)]
+        _bursts = []  # (node, frames)
+        for _node in _nodes:
+            if _codecs is not None and isinstance(_node, BmcNode):
+                _view = _node._fan_out_view(msg_id, _now)
+                if _view is not None:
+                    _msgs = []
+                    _groups.setdefault(_view[1], []).append((_view[0], _view[2], _view[3], _msgs))
+                    _bursts.append((_node, _msgs))
+                    pass
+                pass
+            else:
+                _node.on_message(msg_id, msg_data)
+                pass
+            pass
+        if not _groups:
+            return 0
+
+        _groups = [(frozenset(_plan), _views) for _plan, _views in _groups.items()]
+        for _codec in _codecs:
+            _size = _codec.struct.size
+            _pack_into = _codec.struct.pack_into
+            _values = _codec.values
+            for _plan, _views in _groups:
+                if _codec in _plan:
+                    for _id, _identity, _state, _msgs in _views:
+                        _buf = bytearray(_size)
+                        _pack_into(_buf, 0, *_values(_identity, _state))
+                        _msgs.append(make_message(_id | _codec.msg_id, _buf))
+                        pass
+                    pass
+                pass
+            pass
+        _count = 0
+        for _node, _msgs in _bursts:
+            if _msgs:
+                _node._queue_burst(_msgs, _now)
+                _count += len(_msgs)
+                pass
+            pass
+        return _count
+
+    def set_fan_out_window(self, window: float = None):
+        """
+        Coalesce the requests of replies (e.g. 0x0330) which are sent to single nodes within the window
+        into one fan_out, for a SLC polling all BMCs in quick succession.
+        :param window: seconds, None disables it
+        :return:
+        """
+        _thread = None
+        with self.__fan_out_cond:
+            self.__fan_out_window = window
+            if window is not None and self.__fan_out_thread is None:
+                self.__fan_out_thread = threading.Thread(target=self.__run_fan_out, daemon=True)
+                self.__fan_out_thread.start()
+                pass
+            elif window is None and self.__fan_out_thread is not None:
+                _thread = self.__fan_out_thread
+                self.__fan_out_thread = None
+                self.__fan_out_cond.notify()
+                pass
+        if _thread is not None:
+            _thread.join()
+            pass
+        pass
+
+    def __run_fan_out(self):
+        while True:
+            with self.__fan_out_cond:
+                while not self.__fan_out_pending and self.__fan_out_window is not None:
+                    self.__fan_out_cond.wait()
+                    pass
+                _window = self.__fan_out_window
+            if _window is not None:
+                time.sleep(_window)
+                pass
+            with self.__fan_out_cond:
+                _pending = self.__fan_out_pending
+                self.__fan_out_pending = {}
+            for _msg_id, _indexes in _pending.items():
+                self.fan_out(_msg_id, None, _indexes)
+                pass
+            if _window is None:
+                break
+            pass
+        pass
+
     def enable(self):
         pass
 
@@ -70,25 +371,45 @@ class Device:
     def send_message(self, msg):
         pass
 
+    def send_burst(self, msgs: list):
+        """
+        Send many messages at once, a device can override it to batch them
+        """
+        for _msg in msgs:
+            self.send_message(_msg)
+            pass
+        pass
+
     __metaclass__ = ABCMeta
     pass
 
 
-class _CanListener(can.listener.Listener):
+class _CanListener:
+    # A listener of can.Notifier, which takes a callable, so python-can is not imported by this module
     def __init__(self, device: Device):
         self.__dev = device
         pass
 
+    def __call__(self, msg):
+        self.on_message_received(msg)
+        pass
+
     def on_message_received(self, msg):
         self.__dev.on_message(msg)
         pass
 
+    def stop(self):
+        pass
+
     pass
 
 
 class CanDevice(Device):
     def __init__(self, device_index: int = 0):
         super(CanDevice, self).__init__()
+        # python-can is only imported by the real device, the simulator devices don't need it
+        import can
+        self.__can = can
         if sys.platform == 'linux':
             # sudo ip link set can0 up type can bitrate 500000
             self.__channel = 'can{}'.format(device_index)
@@ -111,13 +432,17 @@ class CanDevice(Device):
             return self.__can_bus_instance
         pass
 
-    def send_message(self, msg: can.Message):
+    def send_message(self, msg):
+        _can = self.__can
+        if not isinstance(msg, _can.Message):
+            msg = _can.Message(extended_id=True, arbitration_id=msg.arbitration_id, data=msg.data)
+            pass
         for _i in range(11):
             try:
                 self.__can_bus.send(msg)
                 break
                 pass
-            except can.CanError as _e:
+            except _can.CanError as _e:
                 if _i < 10:
                     time.sleep(0.1)
                     pass
@@ -127,13 +452,34 @@ class CanDevice(Device):
             pass
         pass
 
+    def add_node(self, index: int, node: Node):
+        super(CanDevice, self).add_node(index, node)
+        if self.__can_bus_instance is not None:
+            self.__can_bus_instance.set_filters(self.__can_filters())
+            pass
+        pass
+
+    def remove_node(self, index: int, node: Node = None) -> bool:
+        _removed = super(CanDevice, self).remove_node(index, node)
+        if _removed and self.__can_bus_instance is not None:
+            self.__can_bus_instance.set_filters(self.__can_filters())
+            pass
+        return _removed
+
+    def __can_filters(self):
+        # Filtered by the controller or the kernel if it can, the frames of the other BMCs on the bus
+        # and the echoes of the replies do not wake up the notifier then
+        return [{'can_id': _can_id, 'can_mask': _can_mask, 'extended': True}
+                for _can_id, _can_mask in self.acceptance_filters()]
+
     def enable(self):
         if self.__can_bus_instance is None:
-            self.__can_bus_instance = can.interface.Bus(channel=self.__channel,
+            self.__can_bus_instance = self.__can.interface.Bus(channel=self.__channel,
                                                         bustype=self.__bus_type,
-                                                        bitrate=500000)
+                                                        bitrate=500000,
+                                                        can_filters=self.__can_filters())
             self.__listener = _CanListener(self)
-            self.__can_notifier = can.Notifier(bus=self.__can_bus, listeners=[self.__listener, ])
+            self.__can_notifier = self.__can.Notifier(bus=self.__can_bus, listeners=[self.__listener, ])
             pass
         else:
             pass
@@ -155,27 +501,114 @@ class CanDevice(Device):
     pass
 
 
+# Datagram formats of SimCanDevice: one socketcan frame per datagram, or a batch of socketcan frames
+# after a header. A batch is never 16 bytes long, so the receiver tells them apart by the length.
+SIM_FRAME = struct.Struct('=IB3x8s')  # struct can_frame: can id + flags, dlc, padding, data
+SIM_BATCH_MAGIC = b'BMCB'
+SIM_BATCH_VERSION = 1
+SIM_BATCH_HEADER = struct.Struct('<4sBxH')  # magic, version, frame count
+_CAN_EFF_FLAG = 0x80000000
+
+
+def pack_sim_frame(arbitration_id: int, data) -> bytes:
+    """
+    :param arbitration_id: 29bit extended CAN id
+    :param data: the frame data, max 8 bytes
+    :return: a datagram of one frame
+    """
+    return SIM_FRAME.pack((arbitration_id & 0x1fffffff) | _CAN_EFF_FLAG, len(data), bytes(data))
+
+
+def pack_sim_batches(frames, mtu: int = 1500) -> list:
+    """
+    :param frames: list of (arbitration_id, data) of extended frames
+    :param mtu: the MTU of the network, a batch fits into one IPv4 UDP packet
+    :return: the batch datagrams
+    """
+    _per_datagram = max(1, (mtu - 28 - SIM_BATCH_HEADER.size) // SIM_FRAME.size)
+    _datagrams = []
+    for _begin in range(0, len(frames), _per_datagram):
+        _chunk = frames[_begin:_begin + _per_datagram]
+        _buf = bytearray(SIM_BATCH_HEADER.size + SIM_FRAME.size * len(_chunk))
+        SIM_BATCH_HEADER.pack_into(_buf, 0, SIM_BATCH_MAGIC, SIM_BATCH_VERSION, len(_chunk))
+        for _i, (_id, _data) in enumerate(_chunk):
+            SIM_FRAME.pack_into(_buf, SIM_BATCH_HEADER.size + SIM_FRAME.size * _i,
+                                (_id & 0x1fffffff) | _CAN_EFF_FLAG, len(_data), bytes(_data))
+            pass
+        _datagrams.append(_buf)
+        pass
+    return _datagrams
+
+
+def unpack_sim_datagram(datagram) -> list:
+    """
+    :param datagram: a datagram of either format
+    :return: list of (arbitration_id, data), empty if the datagram is invalid
+    """
+    if len(datagram) == SIM_FRAME.size:
+        _offsets = (0,)
+        pass
+    elif len(datagram) >= SIM_BATCH_HEADER.size and bytes(datagram[:4]) == SIM_BATCH_MAGIC:
+        _count = SIM_BATCH_HEADER.unpack_from(datagram, 0)[2]
+        if len(datagram) < SIM_BATCH_HEADER.size + SIM_FRAME.size * _count:
+            return []
+        _offsets = range(SIM_BATCH_HEADER.size, SIM_BATCH_HEADER.size + SIM_FRAME.size * _count, SIM_FRAME.size)
+        pass
+    else:
+        return []
+    _frames = []
+    for _offset in _offsets:
+        _can_id, _dlc, _data = SIM_FRAME.unpack_from(datagram, _offset)
+        _can_id = (_can_id & 0x1fffffff) if _can_id & _CAN_EFF_FLAG else (_can_id & 0x7ff)
+        _frames.append((_can_id, bytearray(_data[:min(_dlc, 8)])))
+        pass
+    return _frames
+
+
 if sys.platform == 'linux':
-    from can.interfaces.socketcan.socketcan import build_can_frame, capture_message
     import select
 
 
     class SimCanDevice(Device):
-        def __init__(self, ip: str, port: int):
+        E_WIRE_FRAME = 'frame'  # one frame per datagram, the default for compatibility
+        E_WIRE_BATCH = 'batch'  # many frames per datagram
+        E_WIRE_AUTO = 'auto'  # one frame per datagram until a batch is received from the remote
+
+        def __init__(self, ip: str, port: int, wire_format: str = 'frame', mtu: int = 1500):
+            """
+            :param ip: the ip of the SLC simulator
+            :param port: the port of the SLC simulator
+            :param wire_format: E_WIRE_FRAME, E_WIRE_BATCH or E_WIRE_AUTO
+            :param mtu: the MTU of the network, the size limit of a batch
+            """
             super(SimCanDevice, self).__init__()
+            if wire_format not in (SimCanDevice.E_WIRE_FRAME, SimCanDevice.E_WIRE_BATCH, SimCanDevice.E_WIRE_AUTO):
+                raise ValueError('{} is invalid wire format'.format(wire_format))
             self.__remote = (ip, port)
             self.__local = ('0.0.0.0', 8002)
             self.__udp_socket = None
+            self.__wake = None  # socket pair waking up the receive thread
             self.__thread = None
             self.__terminal = False
+            self.__wire_format = wire_format
+            self.__batch = wire_format == SimCanDevice.E_WIRE_BATCH
+            self.__mtu = mtu
             pass
 
+        @property
+        def wire_format(self):
+            """
+            :return: the wire format in use, E_WIRE_FRAME or E_WIRE_BATCH
+            """
+            return SimCanDevice.E_WIRE_BATCH if self.__batch else SimCanDevice.E_WIRE_FRAME
+
         def enable(self):
             if self.__thread is None:
                 self.__terminal = False
                 self.__udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
                 self.__udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 self.__udp_socket.bind(self.__local)
+                self.__wake = socket.socketpair()
                 self.__thread = threading.Thread(target=self.__run)
                 self.__thread.start()
                 pass
@@ -183,18 +616,43 @@ if sys.platform == 'linux':
 
         def disable(self):
             if isinstance(self.__thread, threading.Thread):
-                if self.__thread.isAlive():
+                if self.__thread.is_alive():
                     self.__terminal = True
+                    # Wake up the select at once instead of waiting for its timeout
+                    self.__wake[1].send(b'\0')
                     self.__thread.join()
                     self.__udp_socket.close()
+                    for _s in self.__wake:
+                        _s.close()
+                        pass
+                    self.__wake = None
                     self.__thread = None
             pass
 
-        def send_message(self, msg: can.Message):
+        def send_message(self, msg):
+            if self.__batch:
+                self.send_burst((msg,))
+                pass
+            else:
+                self.__send_datagram(pack_sim_frame(msg.arbitration_id, msg.data))
+                pass
+            pass
+
+        def send_burst(self, msgs: list):
+            if self.__batch:
+                for _datagram in pack_sim_batches([(_msg.arbitration_id, _msg.data) for _msg in msgs], self.__mtu):
+                    self.__send_datagram(_datagram)
+                    pass
+                pass
+            else:
+                super(SimCanDevice, self).send_burst(msgs)
+                pass
+            pass
+
+        def __send_datagram(self, data):
             for _i in range(11):
-                _data = build_can_frame(msg)
-                _n_byte = self.__udp_socket.sendto(_data, self.__remote)
-                if _n_byte == len(_data):
+                _n_byte = self.__udp_socket.sendto(data, self.__remote)
+                if _n_byte == len(data):
                     break
                     pass
                 else:
@@ -202,17 +660,24 @@ if sys.platform == 'linux':
                         time.sleep(0.1)
                         pass
                     else:
-                        raise can.CanError("Transmit buffer full")
+                        raise _can_error("Transmit buffer full")
                 pass
             pass
 
         def __run(self):
             print('SimCanDevice is enabled')
             while True:
-                _ready = select.select([self.__udp_socket], [], [], 1)[0]
-                if _ready:
-                    _msg = capture_message(_ready[0], False)
-                    self.on_message(_msg)
+                _ready = select.select([self.__udp_socket, self.__wake[0]], [], [], 1)[0]
+                if self.__udp_socket in _ready:
+                    _datagram = self.__udp_socket.recv(65536)
+                    if not self.__batch and self.__wire_format == SimCanDevice.E_WIRE_AUTO and \
+                            len(_datagram) != SIM_FRAME.size and _datagram[:4] == SIM_BATCH_MAGIC:
+                        # The remote speaks the batch format
+                        self.__batch = True
+                        pass
+                    for _arbitration_id, _data in unpack_sim_datagram(_datagram):
+                        self.on_frame(_arbitration_id, _data)
+                        pass
                     pass
                 else:
                     pass
@@ -229,7 +694,338 @@ if sys.platform == 'linux':
     pass
 
 
+# Immutable view of the dynamic data of one BMC. A new instance is swapped in on every
+# change, so readers (encoders, UI, scripts) never lock and always see a consistent state.
+BmcState = collections.namedtuple('BmcState', [
+    'version',  # increased by one on every change
+    'fuse',  # (fuse0, fuse1)
+    'breaker',
+    'current',  # 10 currents
+    'bat_type',  # 10 x (va, vb, vc, vd)
+    'bat_temp',  # 10 x (va, vb, vc, vd)
+    'string_led',  # 10 LED status
+])
+
+# The state of a new node, shared by the nodes until their first change
+_DEFAULT_STATE = BmcState(
+    version=0,
+    fuse=(False, True),
+    breaker=False,
+    current=(0,) * 10,
+    bat_type=((0x00, 0x00, 0x00, 0x00),) * 10,
+    bat_temp=((0, 0, 0, 0),) * 10,
+    string_led=(2,) * 10  # BmcNode.E_STRING_LED_OFF
+)
+
+# Fleet snapshot file: header + one fixed size record per node, little endian and without padding,
+# so a file can be memory-mapped and restored by offset. Values are stored as they are sent on the bus.
+_FLEET_MAGIC = b'BMCF'
+_FLEET_FORMAT_VERSION = 1
+_FLEET_HEADER = struct.Struct('<4sHHI')  # magic, format version, record size, record count
+_FLEET_RECORD = struct.Struct(
+    '<BB'  # index, battery number
+    'IBI'  # hw build, hw version, hw config
+    'BBBH'  # fw major, fw minor, fw deviation, fw build
+    '16s16s16s'  # sn, sku, mbc_sn
+    'B'  # bit0: fuse0, bit1: fuse1, bit2: breaker
+    '10H'  # currents
+    '40B'  # battery types, 10 x 4
+    '40b'  # battery temperatures, 10 x 4
+    '10B'  # string LED status
+)
+
+
+# Immutable identity (static data) of one BMC, it is swapped as a whole by config
+BmcIdentity = collections.namedtuple('BmcIdentity', [
+    'sn',
+    'sku',
+    'mbc_sn',
+    'fw_major',
+    'fw_minor',
+    'fw_deviation',
+    'fw_build',
+    'hw_build',
+    'hw_version',
+    'hw_config',
+    'battery_num',
+])
+
+# The identity of a new node, shared by the nodes until config
+_DEFAULT_IDENTITY = BmcIdentity(
+    sn='SN*************E',
+    sku='SKU************E',
+    mbc_sn='SN*MBC*********E',
+    fw_major=0,
+    fw_minor=1,
+    fw_deviation=2,
+    fw_build=0x1234,
+    hw_build=0,
+    hw_version=1,
+    hw_config=0x12345678,
+    battery_num=10
+)
+
+# Message table of the BMC Can Protocol.
+# Reply messages: (msg id, layout, fields, min battery number). A field is an expression of the identity `i`
+# (BmcIdentity) and the state `s` (BmcState), it is masked to the size of its layout code. A message is only
+# sent if the battery number of the node is not less than the min battery number.
+_BAT_TYPE_IDS = (0x0108, 0x0109, 0x010A, 0x010B, 0x0126, 0x0127, 0x0150, 0x0151, 0x0152, 0x0153)
+_BAT_TEMP_IDS = (0x010C, 0x010D, 0x010E, 0x010F, 0x0128, 0x0129, 0x0154, 0x0155, 0x0156, 0x0157)
+_REPLY_TABLE = [
+    (0x0001, '>BBBH', ('i.fw_major', 'i.fw_minor', 'i.fw_deviation', 'i.fw_build'), 0),
+    (0x0006, '>BHBI', ('i.hw_build >> 16', 'i.hw_build', 'i.hw_version', 'i.hw_config'), 0),
+    (0x0004, '8s', ("i.sn.encode('ascii')[:8]",), 0),
+    (0x0005, '8s', ("i.sn.encode('ascii')[8:16]",), 0),
+    (0x0011, '8s', ("i.sku.encode('ascii')[:8]",), 0),
+    (0x0012, '8s', ("i.sku.encode('ascii')[8:16]",), 0),
+    (0x0013, '8s', ("i.mbc_sn.encode('ascii')[:8]",), 0),
+    (0x0014, '8s', ("i.mbc_sn.encode('ascii')[8:16]",), 0),
+    # bit2: fuse1 broken, bit3: fuse0 broken, bit4: breaker off
+    (0x0124, 'B', ('(0x04 if s.fuse[1] is False else 0)'
+                   ' | (0x08 if s.fuse[0] is False else 0)'
+                   ' | (0x10 if s.breaker is False else 0)',), 0),
+    (0x0125, '>4H', ('s.current[0]', 's.current[1]', 's.current[2]', 's.current[3]'), 0),
+    (0x0158, '>2H', ('s.current[4]', 's.current[5]'), 0),
+    (0x0159, '>4H', ('s.current[6]', 's.current[7]', 's.current[8]', 's.current[9]'), 7),
+] + [
+    (_id, '4B', tuple('s.bat_type[{}][{}]'.format(_i, _j) for _j in range(4)), 0 if _i < 6 else 7)
+    for _i, _id in enumerate(_BAT_TYPE_IDS)
+] + [
+    (_id, '4B', tuple('s.bat_temp[{}][{}]'.format(_i, _j) for _j in range(4)), 0 if _i < 6 else 7)
+    for _i, _id in enumerate(_BAT_TEMP_IDS)
+]
+
+# Requests: (msg id, reply msg ids in order)
+_REQUEST_TABLE = (
+    (0x0201, (0x0001,)),
+    (0x0206, (0x0006,)),
+    (0x0204, (0x0004, 0x0005)),
+    (0x0211, (0x0011, 0x0012)),
+    (0x0213, (0x0013, 0x0014)),
+    (0x0330, (0x0125, 0x0158, 0x0159) + _BAT_TYPE_IDS + _BAT_TEMP_IDS + (0x0124,)),
+)
+
+# String LED commands: (msg id, layout, the first string, the value of a missing byte (E_STRING_LED_OFF))
+_LED_TABLE = (
+    (0x032A, '6B', 0, 2),
+    (0x032B, '4B', 6, 2),
+)
+
+_Codec = collections.namedtuple('_Codec', ['msg_id', 'struct', 'values', 'min_battery'])
+_LedCodec = collections.namedtuple('_LedCodec', ['msg_id', 'struct', 'start', 'padding'])
+_LAYOUT_MASKS = {'B': 0xff, 'H': 0xffff, 'I': 0xffffffff, 's': None}
+
+
+def _compile_codec(msg_id: int, layout: str, fields: tuple, min_battery: int) -> _Codec:
+    # The fields are compiled to one function returning the values of struct.pack_into
+    _masks = []
+    for _count, _code in re.findall(r'(\d*)([a-zA-Z])', layout):
+        if _code not in _LAYOUT_MASKS:
+            raise ValueError('unsupported layout code {} of message 0x{:0>4X}'.format(_code, msg_id))
+        if _code == 's':
+            _masks.append(None)
+            pass
+        else:
+            _masks.extend([_LAYOUT_MASKS[_code]] * int(_count or 1))
+            pass
+        pass
+    if len(_masks) != len(fields):
+        raise ValueError('{} fields for the layout {} of message 0x{:0>4X}'.format(len(fields), layout, msg_id))
+    _values = ', '.join('({})'.format(_f) if _m is None else '({}) & 0x{:x}'.format(_f, _m)
+                        for _f, _m in zip(fields, _masks))
+    return _Codec(msg_id, struct.Struct(layout), eval('lambda i, s: ({},)'.format(_values)), min_battery)
+
+
+_REPLY_CODECS = {_r[0]: _compile_codec(*_r) for _r in _REPLY_TABLE}
+_REQUEST_CODECS = {_msg_id: tuple(_REPLY_CODECS[_id] for _id in _ids) for _msg_id, _ids in _REQUEST_TABLE}
+_LED_CODECS = tuple(_LedCodec(_msg_id, struct.Struct(_layout), _start, bytes((_padding,)) * struct.calcsize(_layout))
+                    for _msg_id, _layout, _start, _padding in _LED_TABLE)
+
+# The requests of the identity messages, their replies are the announcement of a BMC after power on
+_ANNOUNCE_IDS = (0x0201, 0x0206, 0x0204, 0x0211, 0x0213)
+
+# Dense dispatch: the handler slot of every 16-bit message id, shared by all nodes.
+# Slot 0 is the no-op handler of all the ids which are not handled.
+_DISPATCH_IDS = (None,) + tuple(_REQUEST_CODECS) + tuple(_codec.msg_id for _codec in _LED_CODECS)
+_DISPATCH_INDEX = bytearray(0x10000)
+for _slot, _msg_id in enumerate(_DISPATCH_IDS[1:], 1):
+    _DISPATCH_INDEX[_msg_id] = _slot
+    pass
+
+
+def _ignore(node, msg_data):
+    pass
+
+
+def _bind_actions(function, args) -> tuple:
+    # One callable per message, handler(node, msg_data) calls function(arg, node, msg_data)
+    return tuple(functools.partial(function, _arg) for _arg in args)
+
+
+# Cabinet profile: the battery number of a cabinet type and its encode plan, {request msg id: the codecs of
+# the reply in order}. A plan only holds the messages of the cabinet, so the encoders have no condition.
+CabinetProfile = collections.namedtuple('CabinetProfile', ['name', 'battery_num', 'plans'])
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_plans(battery_num: int) -> dict:
+    return {_msg_id: tuple(_codec for _codec in _codecs if battery_num >= _codec.min_battery)
+            for _msg_id, _codecs in _REQUEST_CODECS.items()}
+
+
+_PROFILES = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _unnamed_profile(battery_num: int) -> CabinetProfile:
+    # The profile of a SKU which is not registered, shared by all nodes of the battery number
+    return CabinetProfile(None, battery_num, _compile_plans(battery_num))
+
+
+def register_profile(name: str, battery_num: int) -> CabinetProfile:
+    """
+    Add a cabinet type, a node configured with the SKU of the name uses it
+    :param name: the SKU, max 16 characters
+    :param battery_num: the number of battery strings, 0 ~ 10
+    :return: the profile
+    """
+    if not isinstance(name, str) or len(name) > 16:
+        raise ValueError('invalid SKU {}'.format(name))
+    if not isinstance(battery_num, int) or battery_num < 0 or battery_num > 10:
+        raise ValueError('invalid battery number {}'.format(battery_num))
+    _profile = CabinetProfile(name, battery_num, _compile_plans(battery_num))
+    _PROFILES[name] = _profile
+    return _profile
+
+
+def get_profile(name: str) -> CabinetProfile:
+    """
+    :return: the profile of the SKU, None if it is not registered
+    """
+    return _PROFILES.get(name)
+
+
+def profile_names() -> list:
+    return list(_PROFILES)
+
+
+register_profile('GVSMODBC6', 6)  # 6 battery strings
+register_profile('GVSMODBC6B', 6)  # 6 battery strings, cabinet with fuse
+register_profile('GVSMODBC9', 9)  # 9 battery strings
+register_profile('GVSMODBC9B', 9)  # 9 battery strings, cabinet with fuse
+
+
+class _ReplyBatch:
+    """
+    The frames of the reply to one request in the TX queue of a node, the TX thread measures the reply
+    latency from request_time when it sends them
+    """
+    __slots__ = ('request_time', 'frames')
+
+    def __init__(self, request_time: float, frames: list):
+        self.request_time = request_time
+        self.frames = frames
+        pass
+
+    pass
+
+
+class _LedHistory:
+    """
+    Fixed size ring of the timestamped string LED transitions of one node. When the ring is full the oldest
+    transition is dropped into the base, the status of every string at base_time, so the status at any time
+    since base_time is still known.
+    """
+    __slots__ = ('times', 'strings', 'status', 'start', 'count', 'base', 'base_time', 'current')
+
+    def __init__(self, size: int, string_led, now: float):
+        self.times = array.array('d', bytes(8 * size))
+        self.strings = bytearray(size)
+        self.status = bytearray(size)
+        self.start = 0  # the physical position of the oldest transition
+        self.count = 0
+        self.base = bytearray(string_led)
+        self.base_time = math.nextafter(now, 0.0)  # the status before the first transition at now
+        self.current = bytearray(string_led)  # the status after the last transition
+        pass
+
+    def update(self, now: float, string_led):
+        # Add a transition for every string whose status is not the last recorded one
+        if self.current != bytearray(string_led):
+            for _string, (_old, _new) in enumerate(zip(self.current, string_led)):
+                if _old != _new:
+                    self.add(now, _string, _new)
+                    pass
+                pass
+            pass
+        pass
+
+    def add(self, now: float, string: int, status: int):
+        _size = len(self.times)
+        if self.count == _size:
+            _oldest = self.start
+            self.base[self.strings[_oldest]] = self.status[_oldest]
+            self.base_time = self.times[_oldest]
+            self.start = (_oldest + 1) % _size
+            self.count -= 1
+            pass
+        _pos = (self.start + self.count) % _size
+        self.times[_pos] = now
+        self.strings[_pos] = string
+        self.status[_pos] = status
+        self.count += 1
+        self.current[string] = status
+        pass
+
+    def __after(self, t: float) -> int:
+        # The logical position of the first transition later than t, by binary search
+        _size = len(self.times)
+        _low = 0
+        _high = self.count
+        while _low < _high:
+            _mid = (_low + _high) // 2
+            if self.times[(self.start + _mid) % _size] <= t:
+                _low = _mid + 1
+                pass
+            else:
+                _high = _mid
+                pass
+            pass
+        return _low
+
+    def query(self, string: int, t0: float, t1: float) -> list:
+        _size = len(self.times)
+        _t0 = max(t0, self.base_time)
+        _first = self.__after(_t0)
+        # The status in effect at t0: the last transition of the string before it, else the base
+        _status = self.base[string]
+        for _i in range(_first - 1, -1, -1):
+            _pos = (self.start + _i) % _size
+            if self.strings[_pos] == string:
+                _status = self.status[_pos]
+                break
+            pass
+        _result = [(_t0, _status)]
+        for _i in range(_first, self.__after(t1)):
+            _pos = (self.start + _i) % _size
+            if self.strings[_pos] == string:
+                _result.append((self.times[_pos], self.status[_pos]))
+                pass
+            pass
+        return _result
+
+    pass
+
+
 class BmcNode(Node):
+    # No __dict__: the per node memory of a large fleet is these references only, the immutable data
+    # (the default identity and state, the cabinet profiles and the handlers) is shared by all nodes
+    __slots__ = ('__can_dev', '__index', '__id', '__thread', '__msg_queue', '__run_state', '__timing',
+                 '__binding', '__config_lock', '__state_lock', '__plane', '__slot', '__state', '__actions',
+                 '__hits', '__led_history', '__led_history_size', '__last_tx', '__tx_since', '__request_time',
+                 '__reply_latency', '__queue_probe')
+    accepted_ids = _DISPATCH_IDS[1:]
+
     E_BAT_TYPE_INVALID_TYPE = 0  # Invalid Type
     E_BAT_TYPE_LCR127R2P1 = 1  # Panasonic LCR127R2P1 7AH
     E_BAT_TYPE_RESERVED1 = 2  # Reserved battery type 1
@@ -269,108 +1065,102 @@ class BmcNode(Node):
         """
         self.__can_dev = can_dev
         self.__index = index
+        self.__id = 0x1a000000 if index == 0 else ((index << 24) | 0x10000000)
         self.__can_dev.add_node(self.__index, self)
         self.__thread = None
-        self.__msg_queue = queue.Queue()
+        self.__msg_queue = None  # created when it is used first, an idle node has none
         self.__run_state = False
-        self.__battery_num = 10
-        self.__string_led = [BmcNode.E_STRING_LED_OFF] * 10
-
-        # BMC Static Data
-        self.__sn = 'SN*************E'
-        self.__fw = {
-            'major': 0,
-            'minor': 1,
-            'deviation': 2,
-            'build': 0x1234
-        }
-        self.__hw = {
-            'build': 0,
-            'version': 1,
-            'config': 0x12345678
-        }
-
-        self.__sku = 'SKU************E'
-        self.__mbc_sn = 'SN*MBC*********E'
-        # BMC Dynamic Data
-        self.__fuse = [False, True]
-        self.__breaker = False
-        self.__current = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-        self.__bat_type = [
-            [0x00, 0x00, 0x00, 0x00],
-            [0x00, 0x00, 0x00, 0x00],
-            [0x00, 0x00, 0x00, 0x00],
-            [0x00, 0x00, 0x00, 0x00],
-            [0x00, 0x00, 0x00, 0x00],
-            [0x00, 0x00, 0x00, 0x00],
-            [0x00, 0x00, 0x00, 0x00],
-            [0x00, 0x00, 0x00, 0x00],
-            [0x00, 0x00, 0x00, 0x00],
-            [0x00, 0x00, 0x00, 0x00]
-        ]
-        self.__bat_temp = [
-            [0, 0, 0, 0],
-            [0, 0, 0, 0],
-            [0, 0, 0, 0],
-            [0, 0, 0, 0],
-            [0, 0, 0, 0],
-            [0, 0, 0, 0],
-            [0, 0, 0, 0],
-            [0, 0, 0, 0],
-            [0, 0, 0, 0],
-            [0, 0, 0, 0]
-        ]
-
-        # Command Actions
-        self.__cmd_actions = {
-            0x0201: (self.__send_fw, False),
-            0x0206: (self.__send_hw, False),
-            0x0204: (self.__send_sn, False),
-            0x0330: (self.__send_all_sample_data, False),
-            0x0211: (self.__send_sku, False),
-            0x0213: (self.__send_mbc_sn, False),
-            0x032A: (self.__drive_led_1_6, True),
-            0x032B: (self.__drive_led_7_10, True),
-        }
+        self.__timing = None
+        # TX health for BmcWatchdog, time.monotonic() times
+        self.__last_tx = None  # the end of the last transmit
+        self.__tx_since = None  # the start of the transmit in progress
+        self.__request_time = None  # the oldest request which is not replied yet
+        self.__reply_latency = 0.0  # the worst reply latency since the last reset_reply_latency
+        self.__queue_probe = None  # probe(seconds) of the wait in the TX queue, see _set_queue_probe
+
+        # BMC Static Data, the identity and its cabinet profile are swapped together, see __set_identity
+        self.__binding = None
+        self.__config_lock = threading.Lock()
+        self.__set_identity(_DEFAULT_IDENTITY)
+
+        # BMC Dynamic Data, the immutable default state is shared until the first change
+        self.__state_lock = threading.Lock()  # serializes the writers only
+        self.__plane = None  # the shared memory state plane, see attach_state_plane
+        self.__slot = None
+        self.__state = _DEFAULT_STATE
+        self.__led_history = None  # created on the first LED transition, see set_led_history
+        self.__led_history_size = 256
+
+        # Command Actions, the shared table of the class, see _set_actions
+        self.__actions = BmcNode.__ACTIONS
+        self.__hits = array.array('Q', bytes(8 * len(_DISPATCH_IDS)))
         pass
 
+    def __set_identity(self, identity: BmcIdentity):
+        # Bind the identity to its cabinet profile. Both are swapped in by one assignment, so an encoder
+        # sees either the old pair or the new one, never a mix.
+        _profile = get_profile(identity.sku)
+        if _profile is None or _profile.battery_num != identity.battery_num:
+            _profile = _unnamed_profile(identity.battery_num)
+            pass
+        self.__binding = (identity, _profile)
+        pass
+
+    @property
+    def __identity(self) -> BmcIdentity:
+        return self.__binding[0]
+
+    @property
+    def profile(self) -> CabinetProfile:
+        """
+        :return: the cabinet profile in use, its name is None if the SKU is not registered or the
+                 battery number is changed by battery_number
+        """
+        return self.__binding[1]
+
+    @property
+    def index(self) -> int:
+        return self.__index
+
     @property
     def fw(self):
-        return '{}.{}.{}.{}'.format(self.__fw['major'],
-                                    self.__fw['minor'],
-                                    self.__fw['deviation'],
-                                    self.__fw['build'])
+        _identity = self.__identity
+        return '{}.{}.{}.{}'.format(_identity.fw_major,
+                                    _identity.fw_minor,
+                                    _identity.fw_deviation,
+                                    _identity.fw_build)
         pass
 
     @property
     def hw(self):
-        return '{}.{}.{}'.format(self.__hw['build'], self.__hw['version'], self.__hw['config'])
+        _identity = self.__identity
+        return '{}.{}.{}'.format(_identity.hw_build, _identity.hw_version, _identity.hw_config)
         pass
 
     @property
     def sn(self):
-        return self.__sn
+        return self.__identity.sn
         pass
 
     @property
     def sku(self):
-        return self.__sku
+        return self.__identity.sku
         pass
 
     @property
     def mbc_sn(self):
-        return self.__mbc_sn
+        return self.__identity.mbc_sn
         pass
 
     @property
     def battery_number(self):
-        return self.__battery_num
+        return self.__identity.battery_num
         pass
 
     @battery_number.setter
     def battery_number(self, value: int):
         if isinstance(value, int) and (value > -1 or value < 11):
-            self.__battery_num = value
+            self.__set_identity(self.__identity._replace(battery_num=value))
             pass
         else:
             raise ValueError('invalid battery number {}'.format(value))
@@ -382,33 +1172,183 @@ class BmcNode(Node):
         :param msg_data: message data
         :return:
         """
-        _id = msg_id | (0x1a000000 if self.__index == 0 else ((self.__index << 24) | 0x10000000))
-        _msg = can.message.Message(extended_id=True, arbitration_id=_id, data=msg_data)
-        self.__msg_queue.put(_msg)
+        self.__put(make_message(self.__id | msg_id, msg_data))
+        pass
+
+    def _queue_burst(self, msgs: list, request_time: float = None):
+        # The frames of one reply, e.g. by Device.fan_out, sent by the TX thread in one transmit. With
+        # request_time the reply latency is measured from it
+        self.__put(msgs if request_time is None else _ReplyBatch(request_time, msgs))
+        pass
+
+    def __put(self, item):
+        # Every item of the TX queue is put here, with a queue probe it carries the time it is put
+        _queue = self.__msg_queue
+        if _queue is None:
+            _queue = self._tx_queue()
+            pass
+        if self.__queue_probe is not None:
+            item = (time.perf_counter(), item)
+            pass
+        _queue.put(item)
+        pass
+
+    def _set_queue_probe(self, probe):
+        # probe(seconds) is called by the TX thread with the wait of every item in the TX queue, e.g. by
+        # BmcProfiler. None removes it
+        self.__queue_probe = probe
+        pass
+
+    def _tx_queue(self) -> queue.Queue:
+        # The queue of the frames waiting for the TX thread, BmcProfiler times the wait in it
+        _queue = self.__msg_queue
+        if _queue is None:
+            with self.__config_lock:
+                if self.__msg_queue is None:
+                    self.__msg_queue = queue.Queue()
+                    pass
+                _queue = self.__msg_queue
+            pass
+        return _queue
+
+    def _actions(self) -> tuple:
+        # The handlers of the node, handler(node, msg_data) in the order of _DISPATCH_IDS
+        return self.__actions
+
+    def _set_actions(self, actions: tuple):
+        # Replace the handlers of this node, e.g. by BmcProfiler. None restores the shared table
+        self.__actions = BmcNode.__ACTIONS if actions is None else actions
+        pass
+
+    def set_timing(self, timing):
+        """
+        :param timing: BmcTiming.TimingModel instance, the replies are released by it. None sends the
+                       replies at once (default).
+        :return:
+        """
+        self.__timing = timing
         pass
 
     def start(self):
         if self.__thread is None:
+            self._tx_queue()
+            self.__last_tx = time.monotonic()
             self.__thread = threading.Thread(target=self._run)
             self.__thread.start()
             self.__run_state = True
             pass
         pass
 
+    def restart_tx(self) -> bool:
+        """
+        Replace the TX thread of a running node if it is dead or stalled, e.g. in the retries of a full
+        transmit buffer. The frames waiting for the old thread are dropped, the old thread exits when its
+        transmit returns.
+        :return: False if the node is not running
+        """
+        with self.__config_lock:
+            if self.__run_state is not True or self.__thread is None:
+                return False
+            _queue = self.__msg_queue
+            with _queue.mutex:
+                _queue.queue.clear()
+            _queue.put(None)
+            self.__msg_queue = queue.Queue()
+            self.__tx_since = None
+            self.__request_time = None
+            self.__last_tx = time.monotonic()
+            self.__thread = threading.Thread(target=self._run)
+            self.__thread.start()
+        return True
+
+    def _tx_status(self) -> tuple:
+        # (running, TX thread alive, last TX time, TX start time or None, queued frames, time of the oldest
+        # request not replied or None, the worst reply latency since reset_reply_latency), for BmcWatchdog
+        _thread = self.__thread
+        _queue = self.__msg_queue
+        return (self.__run_state is True, _thread is not None and _thread.is_alive(), self.__last_tx,
+                self.__tx_since, 0 if _queue is None else len(_queue.queue), self.__request_time,
+                self.__reply_latency)
+
+    @property
+    def reply_latency(self) -> float:
+        """
+        :return: seconds, the worst time from a request to the transmit of its reply since the last
+                 reset_reply_latency
+        """
+        return self.__reply_latency
+
+    def reset_reply_latency(self) -> float:
+        """
+        Start a new measure of the reply latency
+        :return: seconds, the worst reply latency before the reset
+        """
+        with self.__config_lock:
+            _latency = self.__reply_latency
+            self.__reply_latency = 0.0
+        return _latency
+
     def stop(self):
+        if self._signal_stop():
+            self._join_stop()
+        pass
+
+    def _signal_stop(self) -> bool:
+        # The first half of stop, it returns at once so a fleet is signaled before any join, see stop_all
         if isinstance(self.__thread, threading.Thread):
-            if self.__thread.isAlive():
+            if self.__thread.is_alive():
                 self.__run_state = False
                 self.__msg_queue.put(None)
-                self.__thread.join()
-                self.__thread = None
+                return True
+        return False
+
+    def _set_running(self, running: bool):
+        # Handle the messages without the TX thread, e.g. a benchmark of the dispatch, the frames sent
+        # meanwhile wait in the TX queue. It must not be used with start and stop.
+        if self.__thread is not None:
+            raise ValueError('the node is started')
+        self.__run_state = running
+        pass
+
+    def _join_stop(self):
+        # The second half of stop, wait for the thread which is signaled by _signal_stop
+        if isinstance(self.__thread, threading.Thread):
+            self.__thread.join()
+            self.__thread = None
         pass
 
     def config(self, **kwargs):
+        # All changes are applied at once, nothing is changed if any value is invalid
+        with self.__config_lock:
+            self.__set_identity(self.__identity._replace(**self.__config_changes(kwargs)))
+        pass
+
+    def reconfigure(self, announce: bool = True, **kwargs):
+        """
+        Change the static data of a running node without stop, waiting for the heartbeat loss and start.
+        The identity and the cabinet profile are swapped between two frames: a reply is encoded either
+        from the old data or from the new data.
+        :param announce: True sends a heartbeat and the identity messages (fw, hw, sn, sku, mbc_sn) at
+                         once, like a BMC after power on, so the SLC takes the new data without polling
+        :param kwargs: the same as config
+        :return:
+        """
+        with self.__config_lock:
+            self.__set_identity(self.__identity._replace(**self.__config_changes(kwargs)))
+        if announce and self.__run_state is True:
+            self.send_message(0, bytearray((0, 0, 0, 0, 0, 0, 0, 0)))
+            for _msg_id in _ANNOUNCE_IDS:
+                self.__send_replies(_msg_id)
+                pass
+            pass
+        pass
+
+    def __config_changes(self, kwargs: dict) -> dict:
+        _changes = {}
         try:
             _fw = kwargs['fw']
             if isinstance(_fw, str):
-                self.__parse_fw(_fw)
+                _changes.update(self.__parse_fw(_fw))
                 pass
             else:
                 raise TypeError('firmware version must be the string type')
@@ -419,7 +1359,7 @@ class BmcNode(Node):
         try:
             _hw = kwargs['hw']
             if isinstance(_hw, str):
-                self.__parse_hw(_hw)
+                _changes.update(self.__parse_hw(_hw))
                 pass
             else:
                 raise TypeError('hardware version must be the string type')
@@ -431,7 +1371,7 @@ class BmcNode(Node):
             _sn = kwargs['sn']
             if isinstance(_sn, str):
                 if len(_sn) <= 16:
-                    self.__sn = _sn
+                    _changes['sn'] = _sn
                     pass
                 else:
                     raise ValueError('invalid serial number')
@@ -447,7 +1387,7 @@ class BmcNode(Node):
             _sn = kwargs['mbc_sn']
             if isinstance(_sn, str):
                 if len(_sn) <= 16:
-                    self.__mbc_sn = _sn
+                    _changes['mbc_sn'] = _sn
                     pass
                 else:
                     raise ValueError('invalid MBC serial number')
@@ -468,99 +1408,251 @@ class BmcNode(Node):
                 _is_force = False
                 pass
             if isinstance(_sku, str):
-                self.__parse_sku(_sku, _is_force)
+                _changes.update(self.__parse_sku(_sku, _is_force))
                 pass
             else:
                 raise TypeError('sku number must be the string type')
             pass
         except KeyError:
             pass
+        return _changes
+
+    @property
+    def version(self):
+        """
+        :return: the version of the dynamic data, it increases on every change
+        """
+        return self.__load_state().version
+
+    def snapshot(self) -> BmcState:
+        """
+        :return: an immutable and consistent view of the dynamic data, no lock is needed
+        """
+        return self.__load_state()
+
+    def __load_state(self) -> BmcState:
+        _plane = self.__plane
+        if _plane is None:
+            return self.__state
+        # Re-read only if the plane is changed by any writer, else the cached state is returned
+        _state = _plane.load(self.__slot, self.__state)
+        self.__state = _state
+        return _state
+
+    def __commit(self, state: BmcState, **kwargs):
+        # The caller must hold self.__state_lock. Every change of the string LEDs goes to the LED history,
+        # by any writer, with the changes of the other writers of the state plane seen in state
+        _state = state._replace(version=state.version + 1, **kwargs)
+        if self.__led_history_size and (self.__led_history is not None or _state.string_led != state.string_led):
+            self.__record_led(state.string_led, _state.string_led)
+            pass
+        if self.__plane is not None:
+            self.__plane.store(self.__slot, _state)
+            pass
+        self.__state = _state
+        pass
+
+    def attach_state_plane(self, plane, slot: int):
+        """
+        Keep the dynamic data in a shared memory state plane, so other processes can drive it
+        :param plane: BmcShm.SharedStatePlane instance
+        :param slot: the slot of this node in the plane
+        :return:
+        """
+        with self.__state_lock:
+            _state = self.__load_state()
+            plane.store(slot, _state)
+            self.__plane = plane
+            self.__slot = slot
+            self.__state = plane.load(slot, None)
+        pass
+
+    def detach_state_plane(self):
+        with self.__state_lock:
+            self.__state = self.__load_state()
+            self.__plane = None
         pass
 
     def set_breaker(self, value: bool):
-        self.__breaker = value
+        with self.__state_lock:
+            self.__commit(self.__load_state(), breaker=value)
         pass
 
     def get_breaker(self):
-        return self.__breaker
+        return self.__load_state().breaker
         pass
 
     def set_fuse(self, index: int, value: bool):
-        try:
-            self.__fuse[index] = value
-            pass
-        except IndexError:
-            raise ValueError('out of index')
+        with self.__state_lock:
+            _state = self.__load_state()
+            _fuse = list(_state.fuse)
+            try:
+                _fuse[index] = value
+                pass
+            except IndexError:
+                raise ValueError('out of index')
+            self.__commit(_state, fuse=tuple(_fuse))
         pass
 
     def get_fuse(self, index):
         try:
-            return self.__fuse[index]
+            return self.__load_state().fuse[index]
         except IndexError:
             raise ValueError('out of index')
         pass
 
     def set_type(self, index: int, va: int, vb: int, vc: int, vd: int):
-        if index < self.__battery_num:
-            self.__bat_type[index][0] = va
-            self.__bat_type[index][1] = vb
-            self.__bat_type[index][2] = vc
-            self.__bat_type[index][3] = vd
+        if index < self.__identity.battery_num:
+            with self.__state_lock:
+                _state = self.__load_state()
+                _bat_type = list(_state.bat_type)
+                _bat_type[index] = (va, vb, vc, vd)
+                self.__commit(_state, bat_type=tuple(_bat_type))
             pass
         else:
             raise ValueError('out of index')
         pass
 
     def get_type(self, index: int):
-        if index < self.__battery_num:
-            return tuple(self.__bat_type[index])
+        if index < self.__identity.battery_num:
+            return self.__load_state().bat_type[index]
         else:
             raise ValueError('out of index')
         pass
 
     def set_temperature(self, index: int, va: int, vb: int, vc: int, vd: int):
-        if index < self.__battery_num:
-            self.__bat_temp[index][0] = va
-            self.__bat_temp[index][1] = vb
-            self.__bat_temp[index][2] = vc
-            self.__bat_temp[index][3] = vd
+        if index < self.__identity.battery_num:
+            with self.__state_lock:
+                _state = self.__load_state()
+                _bat_temp = list(_state.bat_temp)
+                _bat_temp[index] = (va, vb, vc, vd)
+                self.__commit(_state, bat_temp=tuple(_bat_temp))
             pass
         else:
             raise ValueError('out of index')
         pass
 
     def get_temperature(self, index: int):
-        if index < self.__battery_num:
-            return tuple(self.__bat_temp[index])
+        if index < self.__identity.battery_num:
+            return self.__load_state().bat_temp[index]
         else:
             raise ValueError('out of index')
         pass
 
     def set_currents(self, index: int, value: int):
-        if index < self.__battery_num:
-            self.__current[index] = value
+        if index < self.__identity.battery_num:
+            with self.__state_lock:
+                _state = self.__load_state()
+                _current = list(_state.current)
+                _current[index] = value
+                self.__commit(_state, current=tuple(_current))
             pass
         else:
             raise ValueError('out of index')
         pass
 
     def get_current(self, index: int):
-        if index < self.__battery_num:
-            return self.__current[index]
+        if index < self.__identity.battery_num:
+            return self.__load_state().current[index]
         else:
             raise ValueError('out of index')
         pass
 
     def get_string_led_status(self) -> list:
-        return self.__string_led
+        return list(self.__load_state().string_led)
+
+    def set_led_history(self, size: int):
+        """
+        :param size: the number of the latest LED transitions kept, default is 256, 0 keeps none.
+                     The history is cleared.
+        :return:
+        """
+        if size < 0:
+            raise ValueError('invalid LED history size {}'.format(size))
+        with self.__state_lock:
+            self.__led_history_size = size
+            self.__led_history = None
+        pass
+
+    def get_led_history(self, string: int, t0: float = None, t1: float = None) -> list:
+        """
+        The status of a string LED between t0 and t1, with the changes which are faster than any poll. A
+        change by another writer of the state plane is recorded when this node sees it, e.g. by this call
+        :param string: the string index, 0 ~ 9
+        :param t0: time.monotonic() time, None means since the oldest known status
+        :param t1: time.monotonic() time, None means until now
+        :return: [(time, status)], the status in effect at t0 (or at the oldest known time if it is later),
+                 then every transition of the string until t1
+        """
+        if string < 0 or string > 9:
+            raise ValueError('out of index')
+        _t0 = float('-inf') if t0 is None else t0
+        _t1 = float('inf') if t1 is None else t1
+        with self.__state_lock:
+            _history = self.__led_history
+            if _history is None:
+                return [(_t0 if t0 is not None else time.monotonic(), self.__load_state().string_led[string])]
+            _history.update(time.monotonic(), self.__load_state().string_led)
+            return _history.query(string, _t0, _t1)
+
+    def _pack_record(self, buf, offset: int):
+        _state = self.__load_state()
+        _flags = (0x01 if _state.fuse[0] else 0) | (0x02 if _state.fuse[1] else 0) | (0x04 if _state.breaker else 0)
+        _identity = self.__identity
+        _FLEET_RECORD.pack_into(
+            buf, offset,
+            self.__index, _identity.battery_num,
+            _identity.hw_build, _identity.hw_version, _identity.hw_config,
+            _identity.fw_major, _identity.fw_minor, _identity.fw_deviation, _identity.fw_build,
+            _identity.sn.encode('ascii'), _identity.sku.encode('ascii'), _identity.mbc_sn.encode('ascii'),
+            _flags,
+            *[_v & 0xffff for _v in _state.current],
+            *[_v & 0xff for _row in _state.bat_type for _v in _row],
+            *[((_v + 0x80) & 0xff) - 0x80 for _row in _state.bat_temp for _v in _row],
+            *[_v & 0xff for _v in _state.string_led])
+        pass
+
+    def _unpack_record(self, buf, offset: int):
+        _r = _FLEET_RECORD.unpack_from(buf, offset)
+        if _r[0] != self.__index:
+            raise ValueError('the record of index {} is given to the node of index {}'.format(_r[0], self.__index))
+        _identity = BmcIdentity(
+            sn=_r[9].rstrip(b'\x00').decode('ascii'),
+            sku=_r[10].rstrip(b'\x00').decode('ascii'),
+            mbc_sn=_r[11].rstrip(b'\x00').decode('ascii'),
+            fw_major=_r[5],
+            fw_minor=_r[6],
+            fw_deviation=_r[7],
+            fw_build=_r[8],
+            hw_build=_r[2],
+            hw_version=_r[3],
+            hw_config=_r[4],
+            battery_num=_r[1]
+        )
+        with self.__config_lock:
+            self.__set_identity(_identity)
+        _flags = _r[12]
+        _type = _r[23:63]
+        _temp = _r[63:103]
+        with self.__state_lock:
+            self.__commit(self.__load_state(),
+                          fuse=((_flags & 0x01) != 0, (_flags & 0x02) != 0),
+                          breaker=(_flags & 0x04) != 0,
+                          current=_r[13:23],
+                          bat_type=tuple(_type[_i:_i + 4] for _i in range(0, 40, 4)),
+                          bat_temp=tuple(_temp[_i:_i + 4] for _i in range(0, 40, 4)),
+                          string_led=_r[103:113])
+        pass
 
-    def __parse_fw(self, fw: str):
+    @staticmethod
+    def __parse_fw(fw: str) -> dict:
         _fw_buf = fw.split('.')
+        _changes = {}
         _data = (
-            ('major', 0, 0xff),
-            ('minor', 0, 0xff),
-            ('deviation', 0, 0xff),
-            ('build', 0, 0xffff)
+            ('fw_major', 0, 0xff),
+            ('fw_minor', 0, 0xff),
+            ('fw_deviation', 0, 0xff),
+            ('fw_build', 0, 0xffff)
         )
         for _i, _d in enumerate(_data):
             try:
@@ -568,7 +1660,7 @@ class BmcNode(Node):
                 try:
                     _v = int(_v_s)
                     if (_v >= _d[1]) and (_v <= _d[2]):
-                        self.__fw[_d[0]] = _v
+                        _changes[_d[0]] = _v
                         pass
                     else:
                         raise ValueError('{} range is {} ~ {}'.format(_d[0], 0, 0xff))
@@ -578,14 +1670,16 @@ class BmcNode(Node):
             except IndexError:
                 raise ValueError('invalid firmware version {}'.format(fw))
             pass
-        pass
+        return _changes
 
-    def __parse_hw(self, hw: str):
+    @staticmethod
+    def __parse_hw(hw: str) -> dict:
         _hw_buf = hw.split('.')
+        _changes = {}
         _data = (
-            ('build', 0, 0xffffff),
-            ('version', 0, 0xff),
-            ('config', 0, 0xffffffff),
+            ('hw_build', 0, 0xffffff),
+            ('hw_version', 0, 0xff),
+            ('hw_config', 0, 0xffffffff),
         )
         for _i, _d in enumerate(_data):
             try:
@@ -593,7 +1687,7 @@ class BmcNode(Node):
                 try:
                     _v = int(_v_s)
                     if (_v >= _d[1]) and (_v <= _d[2]):
-                        self.__hw[_d[0]] = _v
+                        _changes[_d[0]] = _v
                         pass
                     else:
                         raise ValueError('{} range is {} ~ {}'.format(_d[0], 0, 0xff))
@@ -603,61 +1697,102 @@ class BmcNode(Node):
             except IndexError:
                 raise ValueError('invalid hardware version {}'.format(hw))
             pass
-        pass
-
-    def __parse_sku(self, sku: str, force=False):
-        # GVSMODBC6 (6 battery strings)
-        # GVSMODBC6B (6 battery strings, cabinet with fuse)
-        # GVSMODBC9 (9 battery strings)
-        # GVSMODBC9B (9 battery strings, cabinet with fuse)
+        return _changes
 
-        _is_valid_sku = False
+    @staticmethod
+    def __parse_sku(sku: str, force=False) -> dict:
+        # The registered cabinet profiles, see register_profile
+        _profile = get_profile(sku[:16])
+        if _profile is not None:
+            return {'sku': _profile.name, 'battery_num': _profile.battery_num}
+
+        # For invalid SKU test case, the SKU is kept with 9 battery strings
+        _changes = {'sku': sku[:16], 'battery_num': 9}
         try:
-            # For invalid SKU test case
-            self.__sku = sku[:16]
-            self.__battery_num = 9
-
-            _num_str = sku[8]
-            try:
-                _num = int(_num_str)
-                if (_num == 6) or (_num == 9):
-                    self.__sku = sku[:16]
-                    self.__battery_num = _num
-                    _is_valid_sku = True
-                    pass
-                else:
-                    pass
-                pass
-            except ValueError:
-                pass
+            _num = int(sku[8])
+            if (_num == 6) or (_num == 9):
+                _changes['battery_num'] = _num
+                return _changes
             pass
-        except IndexError:
+        except (IndexError, ValueError):
             pass
-        if _is_valid_sku is False:
-            if force:
-                self.__sku = sku[:16]
-                # self.__battery_num = 9  # No need to set
-                return
+        if not force:
             print('WARNING:', '{} is invalid SKU'.format(sku))
             pass
-        pass
+        return _changes
 
     def _run(self):
         print('BMC {} is start'.format(self.__index))
-        while True:
+        _queue = self.__msg_queue  # restart_tx gives a new thread a new queue
+        _running = True
+        while _running:
             try:
-                _msg = self.__msg_queue.get(timeout=1)
+                _msg = _queue.get(timeout=1)
+            except queue.Empty:
+                self.send_message(0, bytearray((0, 0, 0, 0, 0, 0, 0, 0)))
+                continue
+            # Take all the queued frames, a reply burst is sent by one send_burst
+            _msgs = []
+            _request_time = None  # the oldest request answered by these frames
+            while True:
+                if _msg.__class__ is tuple:
+                    # (put time, item) while a queue probe is set
+                    _put_time, _msg = _msg
+                    _probe = self.__queue_probe
+                    if _probe is not None:
+                        _probe(time.perf_counter() - _put_time)
+                        pass
+                    pass
                 if _msg is None:
                     print('BMC {} is stop'.format(self.__index))
+                    _running = False
                     break
+                elif isinstance(_msg, Frame):
+                    _msgs.append(_msg)
+                    pass
+                elif isinstance(_msg, _ReplyBatch):
+                    _msgs.extend(_msg.frames)
+                    if _request_time is None or _msg.request_time < _request_time:
+                        _request_time = _msg.request_time
+                        pass
                     pass
-                elif isinstance(_msg, can.Message):
-                    self.__can_dev.send_message(_msg)
+                elif isinstance(_msg, list):
+                    _msgs.extend(_msg)
                     pass
                 else:
                     pass
-            except queue.Empty:
-                self.send_message(0, bytearray((0, 0, 0, 0, 0, 0, 0, 0)))
+                try:
+                    _msg = _queue.get_nowait()
+                    pass
+                except queue.Empty:
+                    break
+                pass
+            if not _msgs:
+                continue
+            if _queue is self.__msg_queue:
+                self.__tx_since = time.monotonic()
+                pass
+            if len(_msgs) == 1:
+                self.__can_dev.transmit(_msgs[0])
+                pass
+            else:
+                self.__can_dev.transmit_burst(_msgs)
+                pass
+            _now = time.monotonic()
+            if _queue is self.__msg_queue:
+                self.__tx_since = None
+                self.__last_tx = _now
+                if _request_time is not None:
+                    # Only a sent reply answers the pending request, not a heartbeat or other frames
+                    _pending = self.__request_time
+                    if _pending is not None and _pending <= _request_time:
+                        self.__request_time = None
+                        pass
+                    with self.__config_lock:
+                        if _now - _request_time > self.__reply_latency:
+                            self.__reply_latency = _now - _request_time
+                            pass
+                    pass
                 pass
             pass
         pass
@@ -665,249 +1800,271 @@ class BmcNode(Node):
     def on_message(self, msg_id: int, msg_data: bytearray):
         # print('[{}]{:0>4X}: {}'.format(self.__index, msg_id, ', '.join('{:0>2X}'.format(_v) for _v in msg_data)))
         if self.__run_state is True:
-            try:
-                _action, _is_need_data = self.__cmd_actions[msg_id]
-                if _is_need_data:
-                    _action(msg_data)
-                    pass
-                else:
-                    _action()
-                    pass
-                pass
-            except KeyError:
+            _slot = _DISPATCH_INDEX[msg_id & 0xffff]
+            self.__hits[_slot] += 1
+            if _slot:
+                self.__actions[_slot](self, msg_data)
                 pass
         pass
 
+    def _fan_out_view(self, msg_id: int, now: float):
+        # The inputs of Device.fan_out: (CAN id of this node, plan, identity, state), None if not running.
+        # now is the time of the request, the burst is queued by _queue_burst(frames, now)
+        if self.__run_state is not True:
+            return None
+        if self.__timing is not None:
+            # A node with a timing model releases its reply by itself
+            self.on_message(msg_id, None)
+            return None
+        self.__hits[_DISPATCH_INDEX[msg_id]] += 1
+        _identity, _profile = self.__binding
+        if self.__request_time is None and _profile.plans[msg_id]:
+            self.__request_time = now
+            pass
+        return self.__id, _profile.plans[msg_id], _identity, self.__load_state()
+
+    def get_hit_counts(self) -> dict:
+        """
+        :return: {msg id: count} of the received messages while running, the key None is for all the
+                 messages which are not handled
+        """
+        return dict(zip(_DISPATCH_IDS, self.__hits))
+
     def update_data(self):
+        _bat_type = []
         _val = 0
         for _i in range(10):
+            _row = []
             for _j in range(4):
-                self.__bat_type[_i][_j] = _val
+                _row.append(_val)
                 _val += 1
                 if _val > 0xf:
                     _val = 0
+            _bat_type.append(tuple(_row))
             pass
 
+        _bat_temp = []
         _val = -10
         for _i in range(10):
+            _row = []
             for _j in range(4):
-                self.__bat_temp[_i][_j] = _val
+                _row.append(_val)
                 _val += 2
                 if _val > 80:
                     _val = 0
+            _bat_temp.append(tuple(_row))
             pass
-        for _i in range(10):
-            self.__current[_i] = _i * 0x3f
+        _current = tuple(_i * 0x3f for _i in range(10))
+
+        with self.__state_lock:
+            self.__commit(self.__load_state(),
+                          bat_type=tuple(_bat_type),
+                          bat_temp=tuple(_bat_temp),
+                          current=_current,
+                          fuse=(True, True),
+                          breaker=True)
+        pass
+
+    def __send_replies(self, msg_id: int, msg_data: bytearray = None):
+        # One snapshot for the whole reply, so all frames come from the same version and identity
+        _identity, _profile = self.__binding
+        _state = self.__load_state()
+        _plan = _profile.plans[msg_id]
+        if not _plan:
+            return
+        _now = time.monotonic()
+        if self.__request_time is None:
+            self.__request_time = _now
+            pass
+        _msgs = []
+        for _codec in _plan:
+            _buf = bytearray(_codec.struct.size)
+            _codec.struct.pack_into(_buf, 0, *_codec.values(_identity, _state))
+            _msgs.append(make_message(self.__id | _codec.msg_id, _buf))
+            pass
+        _timing = self.__timing
+        if _timing is None:
+            self._queue_burst(_msgs, _now)
+            pass
+        else:
+            # The frames are released one by one, the last one completes the reply
+            _msgs[-1] = _ReplyBatch(_now, [_msgs[-1]])
+            _timing.submit(_msgs, self.__put)
             pass
+        pass
 
-        self.__fuse[0] = True
-        self.__fuse[1] = True
-        self.__breaker = True
+    @staticmethod
+    def __on_request(msg_id: int, node, msg_data: bytearray):
+        node.__send_replies(msg_id, msg_data)
         pass
 
-    def __send_sn(self):
-        _buf_l = bytearray(8)
-        _buf_h = bytearray(8)
-        _sn_b = bytearray(self.__sn, encoding='ascii')
-        for _i, _v in enumerate(_sn_b):
-            if _i < 8:
-                _buf_l[_i] = _v
-                pass
-            else:
-                _buf_h[_i - 8] = _v
-                pass
+    @staticmethod
+    def __drive_led(codec: _LedCodec, node, msg_data: bytearray):
+        if len(msg_data) < codec.struct.size:
+            msg_data = bytes(msg_data) + codec.padding[len(msg_data):]
             pass
-        self.send_message(0x0004, _buf_l)
-        self.send_message(0x0005, _buf_h)
+        _stat = codec.struct.unpack_from(msg_data)
+        _end = codec.start + len(_stat)
+        with node.__state_lock:
+            _state = node.__load_state()
+            _led = _state.string_led[:codec.start] + _stat + _state.string_led[_end:]
+            if _led != _state.string_led:
+                node.__commit(_state, string_led=_led)
+                pass
         pass
 
-    def __send_mbc_sn(self):
-        _buf_l = bytearray(8)
-        _buf_h = bytearray(8)
-        _sn_b = bytearray(self.__mbc_sn, encoding='ascii')
-        for _i, _v in enumerate(_sn_b):
-            if _i < 8:
-                _buf_l[_i] = _v
-                pass
-            else:
-                _buf_h[_i - 8] = _v
-                pass
+    def __record_led(self, old: tuple, new: tuple):
+        # The caller must hold self.__state_lock, old is the status before the first transition
+        _now = time.monotonic()
+        _history = self.__led_history
+        if _history is None:
+            _history = self.__led_history = _LedHistory(self.__led_history_size, old, _now)
             pass
-        self.send_message(0x0013, _buf_l)
-        self.send_message(0x0014, _buf_h)
+        _history.update(_now, new)
         pass
 
-    def __send_fw(self):
-        _buf = bytearray(5)
-        _buf[0] = self.__fw['major'] & 0xff
-        _buf[1] = self.__fw['minor'] & 0xff
-        _buf[2] = self.__fw['deviation'] & 0xff
-        _buf[3] = (self.__fw['build'] >> 8) & 0xff
-        _buf[4] = self.__fw['build'] & 0xff
-        self.send_message(0x0001, _buf)
+    @staticmethod
+    def __print_buf(_buf):
+        print('buf:', ', '.join('{:0>2X}'.format(_v) for _v in _buf))
         pass
 
-    def __send_hw(self):
-        _buf = bytearray(8)
-        _buf[0] = (self.__hw['build'] >> 16) & 0xff
-        _buf[1] = (self.__hw['build'] >> 8) & 0xff
-        _buf[2] = self.__hw['build'] & 0xff
-        _buf[3] = self.__hw['version'] & 0xff
-        for _i in range(4):
-            _buf[4 + _i] = (self.__hw['config'] >> (3 - _i) * 8) & 0xff
-            pass
-        self.send_message(0x0006, _buf)
+    # The handlers in the order of _DISPATCH_IDS, handler(node, msg_data), shared by all nodes. The message
+    # of a handler is bound by functools.partial, so a frame is dispatched by one call
+    __ACTIONS = (_ignore,) + _bind_actions(__on_request.__func__, _REQUEST_CODECS) + \
+        _bind_actions(__drive_led.__func__, _LED_CODECS)
+
+    pass
+
+
+def _read_fleet_header(buf, path: str):
+    try:
+        _magic, _version, _size, _count = _FLEET_HEADER.unpack_from(buf, 0)
+    except struct.error:
+        raise ValueError('invalid fleet file {}'.format(path))
+    if _magic != _FLEET_MAGIC or _version != _FLEET_FORMAT_VERSION or _size != _FLEET_RECORD.size \
+            or len(buf) < _FLEET_HEADER.size + _size * _count:
+        raise ValueError('invalid fleet file {}'.format(path))
+    return _count
+
+
+def save_fleet(path: str, nodes):
+    """
+    Save the full state of the nodes to a fleet snapshot file
+    :param path: the file path
+    :param nodes: the BmcNode instances, the order is kept in the file
+    :return:
+    """
+    _nodes = list(nodes)
+    _buf = bytearray(_FLEET_HEADER.size + _FLEET_RECORD.size * len(_nodes))
+    _FLEET_HEADER.pack_into(_buf, 0, _FLEET_MAGIC, _FLEET_FORMAT_VERSION, _FLEET_RECORD.size, len(_nodes))
+    for _i, _node in enumerate(_nodes):
+        _node._pack_record(_buf, _FLEET_HEADER.size + _FLEET_RECORD.size * _i)
         pass
+    with open(path, 'wb') as _f:
+        _f.write(_buf)
+    pass
+
 
-    def __send_sku(self):
-        _buf_l = bytearray(8)
-        _buf_h = bytearray(8)
-        _sku_b = bytearray(self.__sku, encoding='ascii')
-        for _i, _v in enumerate(_sku_b):
-            if _i < 8:
-                _buf_l[_i] = _v
+def load_fleet(path: str, nodes):
+    """
+    Restore the full state of the nodes from a fleet snapshot file, the file is memory-mapped
+    :param path: the file path
+    :param nodes: the BmcNode instances, in the same order as they are saved, ValueError if the index of a
+                  node is not the saved one, and no node is changed then
+    :return: the number of restored nodes
+    """
+    _nodes = list(nodes)
+    with open(path, 'rb') as _f:
+        with mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ) as _buf:
+            _count = _read_fleet_header(_buf, path)
+            if _count != len(_nodes):
+                raise ValueError('{} nodes are saved in {}, but {} nodes are given'.format(_count, path, len(_nodes)))
+            for _i, _node in enumerate(_nodes):
+                _index = _buf[_FLEET_HEADER.size + _FLEET_RECORD.size * _i]
+                if _index != _node.index:
+                    raise ValueError('node {} of {} is saved with index {}, but the node has index {}'.format(
+                        _i, path, _index, _node.index))
                 pass
-            else:
-                _buf_h[_i - 8] = _v
+            for _i, _node in enumerate(_nodes):
+                _node._unpack_record(_buf, _FLEET_HEADER.size + _FLEET_RECORD.size * _i)
                 pass
-            pass
-        self.send_message(0x0011, _buf_l)
-        self.send_message(0x0012, _buf_h)
+    return len(_nodes)
+
+
+def read_fleet_indexes(path: str) -> list:
+    """
+    :param path: the file path
+    :return: the node indexes saved in a fleet snapshot file, it helps to create the nodes before load_fleet
+    """
+    with open(path, 'rb') as _f:
+        _buf = _f.read()
+    _count = _read_fleet_header(_buf, path)
+    return [_buf[_FLEET_HEADER.size + _FLEET_RECORD.size * _i] for _i in range(_count)]
+
+
+def start_all(nodes, devices=()) -> float:
+    """
+    Enable the devices, then start many nodes, e.g. a fleet before a test case
+    :param nodes: the BmcNode instances
+    :param devices: the Device instances to enable before the nodes are started
+    :return: seconds to enable the devices and start all the nodes
+    """
+    _begin = time.perf_counter()
+    for _device in devices:
+        _device.enable()
         pass
-
-    def __send_fuse_and_breaker_state(self):
-        _buf = bytearray(1)
-        _buf[0] = 0x00
-        if self.__fuse[1] is False:  # broken
-            _buf[0] |= 0x04
-            pass
-        if self.__fuse[0] is False:  # broken
-            _buf[0] |= 0x08
-            pass
-        if self.__breaker is False:  # off
-            _buf[0] |= 0x10
-            pass
-        self.send_message(0x0124, _buf)
+    for _node in nodes:
+        _node.start()
         pass
+    return time.perf_counter() - _begin
+
+
+def stop_all(nodes, devices=()) -> float:
+    """
+    Stop many nodes, then disable their devices. Every node is signaled before any of them is joined, so
+    the threads stop together instead of one after another, and no one waits for a timeout.
+    :param nodes: the BmcNode instances
+    :param devices: the Device instances to disable after the nodes are stopped
+    :return: seconds to stop all the nodes and disable the devices
+    """
+    _begin = time.perf_counter()
+    _signaled = [_node for _node in nodes if _node._signal_stop()]
+    for _node in _signaled:
+        _node._join_stop()
+        pass
+    for _device in devices:
+        _device.disable()
+        pass
+    return time.perf_counter() - _begin
 
-    def __send_current(self):
-        _buf = bytearray(8)
-        for _i in range(4):  # 0, 1, 2, 3
-            _buf[_i * 2] = (self.__current[_i] >> 8) & 0xff
-            _buf[_i * 2 + 1] = self.__current[_i] & 0xff
-            pass
-        self.send_message(0x0125, _buf)
 
-        _buf = bytearray(4)
-        for _i in range(4, 6):  # 4, 5
-            _buf[(_i - 4) * 2] = (self.__current[_i] >> 8) & 0xff
-            _buf[(_i - 4) * 2 + 1] = self.__current[_i] & 0xff
+def benchmark_fleet(nodes: int = 1000):
+    """
+    The start and stop latency of a fleet on one device, by start_all and stop_all
+    """
+    class _NullDevice(Device):
+        def send_message(self, msg):
             pass
-        self.send_message(0x0158, _buf)
-
-        if self.__battery_num > 6:
-            _buf = bytearray(8)
-            for _i in range(6, 10):  # 6, 7, 8, 9
-                _buf[(_i - 6) * 2] = (self.__current[_i] >> 8) & 0xff
-                _buf[(_i - 6) * 2 + 1] = self.__current[_i] & 0xff
-                pass
-            self.send_message(0x0159, _buf)
 
         pass
 
-    def __send_temperature(self):
-        _id = (
-            0x010C,
-            0x010D,
-            0x010E,
-            0x010F,
-            0x0128,
-            0x0129,
-            0x0154,
-            0x0155,
-            0x0156,
-            0x0157
-        )
-        for _i in range(6):
-            _buf = bytearray(4)
-            _dat = self.__bat_temp[_i]
-            _buf[0] = _dat[0] & 0xff
-            _buf[1] = _dat[1] & 0xff
-            _buf[2] = _dat[2] & 0xff
-            _buf[3] = _dat[3] & 0xff
-            self.send_message(_id[_i], _buf)
-            pass
-        if self.__battery_num > 6:
-            for _i in range(6, 10):
-                _buf = bytearray(4)
-                _dat = self.__bat_temp[_i]
-                _buf[0] = _dat[0] & 0xff
-                _buf[1] = _dat[1] & 0xff
-                _buf[2] = _dat[2] & 0xff
-                _buf[3] = _dat[3] & 0xff
-                self.send_message(_id[_i], _buf)
-                pass
-            pass
-        pass
-
-    def __send_battery_type(self):
-        _id = [
-            0x0108,
-            0x0109,
-            0x010A,
-            0x010B,
-            0x0126,
-            0x0127,
-            0x0150,
-            0x0151,
-            0x0152,
-            0x0153
-        ]
-        for _i in range(6):
-            _buf = bytearray(4)
-            _dat = self.__bat_type[_i]
-            _buf[0] = _dat[0] & 0xff
-            _buf[1] = _dat[1] & 0xff
-            _buf[2] = _dat[2] & 0xff
-            _buf[3] = _dat[3] & 0xff
-            self.send_message(_id[_i], _buf)
-            pass
-
-        if self.__battery_num > 6:
-            for _i in range(6, 10):
-                _buf = bytearray(4)
-                _dat = self.__bat_type[_i]
-                _buf[0] = _dat[0] & 0xff
-                _buf[1] = _dat[1] & 0xff
-                _buf[2] = _dat[2] & 0xff
-                _buf[3] = _dat[3] & 0xff
-                self.send_message(_id[_i], _buf)
-                pass
-            pass
-        pass
-
-    def __send_all_sample_data(self):
-        self.__send_current()
-        self.__send_battery_type()
-        self.__send_temperature()
-        self.__send_fuse_and_breaker_state()
-        pass
-
-    def __drive_led_1_6(self, msg_data: bytearray):
-        for i in range(0, 6):
-            stat = msg_data[i] if i < len(msg_data) else BmcNode.E_STRING_LED_OFF
-            self.__string_led[i] = stat if i < len(self.__string_led) else self.__string_led.append(stat)
-
-    def __drive_led_7_10(self, msg_data: bytearray):
-        for i in range(6, 10):
-            stat = msg_data[i - 6] if (i - 6) < len(msg_data) else BmcNode.E_STRING_LED_OFF
-            self.__string_led[i] = stat if i < len(self.__string_led) else self.__string_led.append(stat)
-
-    @staticmethod
-    def __print_buf(_buf):
-        print('buf:', ', '.join('{:0>2X}'.format(_v) for _v in _buf))
+    _device = _NullDevice()
+    _nodes = []
+    for _i in range(nodes):
+        _node = BmcNode(_i % 10, _device)
+        _node.config(sku='GVSMODBC9')
+        _nodes.append(_node)
         pass
-
+    _stdout = sys.stdout
+    sys.stdout = None  # the start and stop lines of the nodes
+    try:
+        _started = start_all(_nodes, [_device])
+        _stopped = stop_all(_nodes, [_device])
+        pass
+    finally:
+        sys.stdout = _stdout
+        pass
+    print('{} nodes: started in {:.3f}s, stopped in {:.3f}s'.format(nodes, _started, _stopped))
     pass
 
 
@@ -929,25 +2086,137 @@ def main():
     time.sleep(10)
     _bmc_node.update_data()
     time.sleep(35)
-    _bmc_node.stop()
-    time.sleep(10)
 
     # 2
-    print('Start second time')
-    _bmc_node.config(hw='8.9.10',
-                     # fw='11.12.13.14',
-                     sn='SN-123456789abcd',
-                     sku='GVSMODBC9',
-                     mbc_sn='SN-EXTERNAL-MBCx')
-    time.sleep(15)
-    _bmc_node.start()
+    print('Reconfigure without restart')
+    _bmc_node.reconfigure(hw='8.9.10',
+                          # fw='11.12.13.14',
+                          sn='SN-123456789abcd',
+                          sku='GVSMODBC9',
+                          mbc_sn='SN-EXTERNAL-MBCx')
     time.sleep(35)
     _bmc_node.stop()
     _can_dev.disable()
     pass
 
 
+def benchmark_dispatch(frames: int = 1000000):
+    """
+    Micro benchmark of BmcNode.on_message with mixed traffic: 1 of 10 frames is a LED command for this
+    node, the others are not handled. The dict and KeyError dispatch of the former version, with the same
+    handlers, is measured as the reference.
+    """
+    class _NullDevice(Device):
+        def send_message(self, msg):
+            pass
+
+        pass
+
+    _node = BmcNode(1, _NullDevice())
+    _node._set_running(True)  # no TX thread needed
+    _led = bytearray((BmcNode.E_STRING_LED_ON,) * 6)
+    _traffic = [(0x032A if _i % 10 == 0 else 0x0400 + _i) for _i in range(1000)]
+    _rounds = max(1, frames // len(_traffic))
+
+    _handlers = _node._actions()
+    _actions = {_msg_id: (functools.partial(_handlers[_slot], _node), True)
+                for _slot, _msg_id in enumerate(_DISPATCH_IDS) if _slot}
+
+    def _on_message(msg_id, msg_data):
+        try:
+            _action, _is_need_data = _actions[msg_id]
+            if _is_need_data:
+                _action(msg_data)
+                pass
+            else:
+                _action()
+                pass
+            pass
+        except KeyError:
+            pass
+        pass
+
+    for _name, _fn in (('dict and KeyError', _on_message), ('dense dispatch', _node.on_message)):
+        _begin = time.perf_counter()
+        for _r in range(_rounds):
+            for _msg_id in _traffic:
+                _fn(_msg_id, _led)
+                pass
+            pass
+        _elapsed = time.perf_counter() - _begin
+        print('{}: {:.0f} frames/s'.format(_name, _rounds * len(_traffic) / _elapsed))
+        pass
+    print('hit counts: {}'.format({('0x{:0>4X}'.format(_k) if _k is not None else None): _v
+                                   for _k, _v in _node.get_hit_counts().items()}))
+    pass
+
+
+def benchmark_memory(nodes: int = 10000):
+    """
+    The memory of nodes, traced by tracemalloc, in three cases:
+        idle       created and configured, the default state is shared by all nodes
+        own state  every node has its own values, what every node costs without the shared default
+        plane      the nodes of own state attached to a BmcShm.SharedStatePlane
+    The devices and the plane are created before the trace, so only the nodes are counted. The former
+    layout without slots and shared tables took about 7400 bytes per idle node.
+    """
+    import gc
+    import tracemalloc
+    from BmcShm import SharedStatePlane
+
+    class _NullDevice(Device):
+        def send_message(self, msg):
+            pass
+
+        pass
+
+    _devices = [_NullDevice() for _i in range((nodes + 9) // 10)]
+    _plane = SharedStatePlane(nodes)
+    for _case in ('idle', 'own state', 'plane'):
+        gc.collect()
+        tracemalloc.start()
+        _base = tracemalloc.get_traced_memory()[0]
+        _nodes = []
+        for _i in range(nodes):
+            _node = BmcNode(_i % 10, _devices[_i // 10])
+            _node.config(sku='GVSMODBC9')
+            if _case != 'idle':
+                for _string in range(_node.battery_number):
+                    _node.set_temperature(_string, 20 + _string, 21, 22, 23 + _i % 50)
+                    _node.set_type(_string, 1, 2, 3, _i % 200)
+                    _node.set_currents(_string, 1000 + _i % 5000)
+                    pass
+                pass
+            if _case == 'plane':
+                _node.attach_state_plane(_plane, _i)
+                pass
+            _nodes.append(_node)
+            pass
+        gc.collect()
+        _used = tracemalloc.get_traced_memory()[0] - _base
+        tracemalloc.stop()
+        print('{} nodes, {}: {:.1f} MB, {:.0f} bytes per node'.format(nodes, _case, _used / 1e6, _used / nodes))
+        for _node in _nodes:
+            _node.detach_state_plane()
+            pass
+        del _nodes
+        pass
+    _plane.close()
+    pass
+
+
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark_dispatch()
+        pass
+    elif len(sys.argv) > 1 and sys.argv[1] == 'mem':
+        benchmark_memory()
+        pass
+    elif len(sys.argv) > 1 and sys.argv[1] == 'fleet':
+        benchmark_fleet()
+        pass
+    else:
+        main()
+        pass
     pass
 
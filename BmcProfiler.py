@@ -0,0 +1,346 @@
+import collections
+import functools
+import itertools
+import signal
+import sys
+import threading
+import time
+
+from BmcNode import Device, BmcNode
+
+
+class Profiler:
+    """
+    Time the stages of the frames of devices and nodes:
+        rx       Device.on_frame to the nodes, through the receiver of the device
+        handler  the handler of one message id, called by BmcNode.on_message
+        queue    the wait of a frame in the TX queue of a node, stamped by the node when the profiler is on
+        tx       Device.transmit / transmit_burst, through the transmitter of the device
+        send     Device.send_message / send_burst, with the retries of a full buffer
+
+    The hooks are installed by enable and removed by disable, a disabled profiler costs nothing. With
+    sample_every > 1 only one of every sample_every outermost calls is timed with all the calls nested in it,
+    so the nesting of a flame graph stays consistent.
+
+    The receiver and the transmitter of a device are chained like BmcFault.FaultStage, a stage attached
+    after enable must be detached before disable.
+    """
+
+    E_STAGES = ('rx', 'handler', 'queue', 'tx', 'send')
+
+    def __init__(self, sample_every: int = 1):
+        """
+        :param sample_every: time one of every sample_every calls, 1 times every call
+        """
+        if sample_every < 1:
+            raise ValueError('sample_every must be 1 at least')
+        self.__sample_every = sample_every
+        self.__sequence = itertools.count(1)  # next() is atomic, the RX, TX and queue threads share it
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__devices = []
+        self.__nodes = []
+        self.__enabled = False
+        self.__sinks = {}  # device: the receiver replaced by enable
+        self.__stacks = collections.defaultdict(lambda: [0, 0.0, 0.0])  # stack: [count, total, max]
+        self.__signal_path = None
+        pass
+
+    @property
+    def enabled(self) -> bool:
+        return self.__enabled
+
+    @property
+    def sample_every(self) -> int:
+        return self.__sample_every
+
+    def watch(self, devices=(), nodes=()):
+        """
+        Add the devices and the nodes to profile, they are hooked at once if the profiler is enabled
+        :param devices: the Device instances
+        :param nodes: the BmcNode instances
+        :return:
+        """
+        _devices = [_device for _device in devices if _device not in self.__devices]
+        _nodes = [_node for _node in nodes if _node not in self.__nodes]
+        self.__devices.extend(_devices)
+        self.__nodes.extend(_nodes)
+        if self.__enabled:
+            self.__install(_devices, _nodes)
+            pass
+        pass
+
+    def enable(self):
+        if not self.__enabled:
+            self.__install(self.__devices, self.__nodes)
+            self.__enabled = True
+            pass
+        pass
+
+    def disable(self):
+        if self.__enabled:
+            self.__enabled = False
+            self.__uninstall()
+            pass
+        pass
+
+    def toggle(self) -> bool:
+        """
+        :return: True if the profiler is enabled now
+        """
+        if self.__enabled:
+            self.disable()
+            pass
+        else:
+            self.enable()
+            pass
+        return self.__enabled
+
+    def reset(self):
+        with self.__lock:
+            self.__stacks.clear()
+        pass
+
+    def install_signal(self, signum: int = None, path: str = None):
+        """
+        Switch the profiler by a signal, e.g. kill -USR2 <pid>. When it is switched off, the summary is
+        printed and the collapsed stacks are written to path.
+        Only the main thread can install a signal handler.
+        :param signum: the signal, default is SIGUSR2
+        :param path: the file of the collapsed stacks, None writes no file
+        :return:
+        """
+        if signum is None:
+            if not hasattr(signal, 'SIGUSR2'):
+                raise ValueError('SIGUSR2 is not supported by this system, a signal must be given')
+            signum = signal.SIGUSR2
+            pass
+        self.__signal_path = path
+        signal.signal(signum, self.__on_signal)
+        pass
+
+    def __on_signal(self, signum, frame):
+        if self.toggle():
+            print('profiler is enabled')
+            pass
+        else:
+            print(self.format_summary())
+            if self.__signal_path is not None:
+                self.write_collapsed(self.__signal_path)
+                print('profiler stacks are written to {}'.format(self.__signal_path))
+                pass
+            pass
+        pass
+
+    def summary(self) -> dict:
+        """
+        :return: {stage: {'count', 'total', 'mean', 'max'}} of the timed calls, seconds. A nested call is
+                 counted in the stage of the caller too.
+        """
+        _summary = {}
+        with self.__lock:
+            _items = [(_stack, list(_value)) for _stack, _value in self.__stacks.items()]
+        for _stack, (_count, _total, _max) in _items:
+            _stage = _stack[-1].split(' ')[0]
+            _item = _summary.setdefault(_stage, {'count': 0, 'total': 0.0, 'mean': 0.0, 'max': 0.0})
+            _item['count'] += _count
+            _item['total'] += _total
+            _item['max'] = max(_item['max'], _max)
+            pass
+        for _item in _summary.values():
+            _item['mean'] = _item['total'] / _item['count'] if _item['count'] else 0.0
+            pass
+        return _summary
+
+    def format_summary(self) -> str:
+        _summary = self.summary()
+        _lines = ['{:<8} {:>10} {:>12} {:>10} {:>10}'.format('stage', 'count', 'total ms', 'mean us', 'max us')]
+        for _stage in Profiler.E_STAGES:
+            if _stage in _summary:
+                _item = _summary[_stage]
+                _lines.append('{:<8} {:>10} {:>12.3f} {:>10.1f} {:>10.1f}'.format(
+                    _stage, _item['count'], _item['total'] * 1e3, _item['mean'] * 1e6, _item['max'] * 1e6))
+                pass
+            pass
+        if self.__sample_every > 1:
+            _lines.append('one of every {} calls is timed'.format(self.__sample_every))
+            pass
+        return '\n'.join(_lines)
+
+    def write_collapsed(self, path: str):
+        """
+        Write the stacks in the collapsed format of flamegraph.pl and speedscope, one line of
+        'stage;nested stage microseconds' per stack, the value is the time spent in the stack itself.
+        The queue stage is left out, it is the wait of the frames and not the time spent in a call.
+        :param path: the file path
+        :return:
+        """
+        with self.__lock:
+            _totals = {_stack: _value[1] for _stack, _value in self.__stacks.items() if _stack[0] != 'queue'}
+        _self = dict(_totals)
+        for _stack, _total in _totals.items():
+            if len(_stack) > 1 and _stack[:-1] in _self:
+                _self[_stack[:-1]] -= _total
+                pass
+            pass
+        with open(path, 'w') as _f:
+            for _stack in sorted(_self):
+                _us = int(round(max(_self[_stack], 0.0) * 1e6))
+                if _us:
+                    _f.write('{} {}\n'.format(';'.join(_stack), _us))
+                    pass
+                pass
+        pass
+
+    def __install(self, devices, nodes):
+        for _device in devices:
+            self.__sinks[_device] = _device.receiver
+            _device.set_receiver(self.__wrap('rx', _device.receiver or _device.dispatch))
+            # The instance attributes hide the methods, Device calls them through self
+            _device.transmit = self.__wrap('tx', _device.transmit)
+            _device.transmit_burst = self.__wrap('tx', _device.transmit_burst)
+            _device.send_message = self.__wrap('send', _device.send_message)
+            _device.send_burst = self.__wrap('send', _device.send_burst)
+            pass
+        for _node in nodes:
+            _node._set_actions(self.__wrap_actions(_node._actions()))
+            _node._set_queue_probe(self.__on_queue_wait)
+            pass
+        pass
+
+    def __uninstall(self):
+        for _device in self.__devices:
+            _device.set_receiver(self.__sinks.pop(_device, None))
+            for _name in ('transmit', 'transmit_burst', 'send_message', 'send_burst'):
+                _device.__dict__.pop(_name, None)
+                pass
+            pass
+        for _node in self.__nodes:
+            _node._set_actions(None)
+            _node._set_queue_probe(None)
+            pass
+        pass
+
+    def __add(self, stack: tuple, elapsed: float):
+        with self.__lock:
+            _value = self.__stacks[stack]
+            _value[0] += 1
+            _value[1] += elapsed
+            if elapsed > _value[2]:
+                _value[2] = elapsed
+                pass
+        pass
+
+    def __sampled(self) -> bool:
+        return next(self.__sequence) % self.__sample_every == 0
+
+    def __call(self, label: str, function, args):
+        _local = self.__local
+        _stack = getattr(_local, 'stack', None)
+        if _stack is False or (_stack and _stack[-1] == label):
+            # Nested in a call which is not sampled, or in the same stage, e.g. send_message by send_burst
+            return function(*args)
+        _outermost = _stack is None
+        if _outermost:
+            if not self.__sampled():
+                _local.stack = False
+                try:
+                    return function(*args)
+                finally:
+                    _local.stack = None
+            _stack = _local.stack = []
+            pass
+        _stack.append(label)
+        _key = tuple(_stack)
+        _begin = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.__add(_key, time.perf_counter() - _begin)
+            _stack.pop()
+            if _outermost:
+                _local.stack = None
+                pass
+            pass
+
+    def __wrap(self, label: str, function):
+        def _wrapper(*args):
+            return self.__call(label, function, args)
+
+        return _wrapper
+
+    def __wrap_actions(self, actions: tuple) -> tuple:
+        # The handler of every message id is timed, the first entry ignores the other messages
+        _wrapped = [actions[0]]
+        for _handler, _msg_id in zip(actions[1:], BmcNode.accepted_ids):
+            _wrapped.append(functools.partial(self.__handler, _handler, 'handler 0x{:0>4X}'.format(_msg_id)))
+            pass
+        return tuple(_wrapped)
+
+    def __handler(self, handler, label, node, msg_data):
+        return self.__call(label, handler, (node, msg_data))
+
+    def __on_queue_wait(self, seconds: float):
+        # The queue probe of the nodes, called by their TX threads
+        if self.__sampled():
+            self.__add(('queue',), seconds)
+            pass
+        pass
+
+    pass
+
+
+def main():
+    # The stages of 0x0330 requests to 10 nodes, and the cost of the hooks
+    class _CountDevice(Device):
+        def __init__(self):
+            super(_CountDevice, self).__init__()
+            self.count = 0
+            pass
+
+        def send_message(self, msg):
+            self.count += 1
+            pass
+
+        pass
+
+    _device = _CountDevice()
+    _nodes = []
+    for _i in range(10):
+        _node = BmcNode(_i, _device)
+        _node.config(sku='GVSMODBC9')
+        _node.start()
+        _nodes.append(_node)
+        pass
+    _profiler = Profiler()
+    _profiler.watch([_device], _nodes)
+    _requests = 20000
+    for _name in ('disabled', 'enabled'):
+        if _name == 'enabled':
+            _profiler.enable()
+            pass
+        _sent = _device.count
+        _begin = time.perf_counter()
+        for _i in range(_requests):
+            _device.on_frame(((_i % 9) + 1) << 24 | 0x10000330, bytearray())
+            pass
+        while _device.count < _sent + _requests * 24:
+            time.sleep(0.001)
+            pass
+        _elapsed = time.perf_counter() - _begin
+        print('{}: {:.1f} us per request'.format(_name, _elapsed / _requests * 1e6))
+        pass
+    _profiler.disable()
+    print(_profiler.format_summary())
+    _path = sys.argv[1] if len(sys.argv) > 1 else 'bmc-profile.txt'
+    _profiler.write_collapsed(_path)
+    print('stacks are written to {}'.format(_path))
+    for _node in _nodes:
+        _node.stop()
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    main()
+    pass
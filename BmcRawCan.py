@@ -0,0 +1,320 @@
+import ctypes
+import ctypes.util
+import errno
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+from BmcNode import Node, Device, _can_error
+
+# linux/can.h and linux/can/raw.h
+_CAN_EFF_FLAG = 0x80000000
+_CAN_RTR_FLAG = 0x40000000
+_CAN_ERR_FLAG = 0x20000000
+_CAN_EFF_MASK = 0x1fffffff
+_SOL_CAN_RAW = 101
+_CAN_RAW_FILTER = 1
+_CAN_FRAME = struct.Struct('=IB3x8s')  # struct can_frame: can id, dlc, padding, data
+_CAN_FILTER = struct.Struct('=II')  # struct can_filter: can id, mask
+_MSG_DONTWAIT = 0x40
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IoVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_libc():
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int,
+                                   ctypes.c_void_p]
+        _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+        return _libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc() if sys.platform == 'linux' else None
+
+
+def is_supported() -> bool:
+    """
+    :return: True if this system has AF_CAN raw sockets
+    """
+    if not hasattr(socket, 'AF_CAN'):
+        return False
+    try:
+        socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW).close()
+        return True
+    except OSError:
+        return False
+
+
+class _FrameBatch:
+    """
+    Preallocated frames for recvmmsg / sendmmsg, one iovec per frame. Without recvmmsg / sendmmsg (not
+    glibc) the frames are received and sent one by one.
+    """
+
+    def __init__(self, count: int, frame_size: int = _CAN_FRAME.size):
+        self.count = count
+        self.frame_size = frame_size
+        self.buf = ctypes.create_string_buffer(frame_size * count)
+        self.view = memoryview(self.buf).cast('B')
+        self.__iovecs = (_IoVec * count)()
+        self.__headers = (_MMsgHdr * count)()
+        _base = ctypes.addressof(self.buf)
+        for _i in range(count):
+            self.__iovecs[_i].iov_base = _base + _i * frame_size
+            self.__iovecs[_i].iov_len = frame_size
+            self.__headers[_i].msg_hdr.msg_iov = ctypes.pointer(self.__iovecs[_i])
+            self.__headers[_i].msg_hdr.msg_iovlen = 1
+            pass
+        pass
+
+    def recv(self, sock: socket.socket) -> int:
+        """
+        :return: the number of received frames at offset 0, 1 * frame_size ..., 0 if there is none
+        """
+        if _libc is not None:
+            _n = _libc.recvmmsg(sock.fileno(), self.__headers, self.count, _MSG_DONTWAIT, None)
+            if _n < 0:
+                _errno = ctypes.get_errno()
+                if _errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return 0
+                raise OSError(_errno, 'recvmmsg failed')
+            return _n
+        _n = 0
+        while _n < self.count:
+            try:
+                sock.recv_into(self.view[_n * self.frame_size:(_n + 1) * self.frame_size], 0, _MSG_DONTWAIT)
+                pass
+            except BlockingIOError:
+                break
+            _n += 1
+            pass
+        return _n
+
+    def send(self, sock: socket.socket, count: int) -> int:
+        """
+        :param count: the number of frames at offset 0, 1 * frame_size ... to send
+        :return: the number of sent frames
+        """
+        if _libc is not None:
+            _n = _libc.sendmmsg(sock.fileno(), self.__headers, count, 0)
+            if _n < 0:
+                _errno = ctypes.get_errno()
+                if _errno in (errno.ENOBUFS, errno.EAGAIN, errno.EINTR):
+                    return 0
+                raise OSError(_errno, 'sendmmsg failed')
+            return _n
+        for _i in range(count):
+            try:
+                sock.send(self.view[_i * self.frame_size:(_i + 1) * self.frame_size])
+                pass
+            except OSError as _e:
+                if _e.errno in (errno.ENOBUFS, errno.EAGAIN):
+                    return _i
+                raise
+            pass
+        return count
+
+    pass
+
+
+class RawCanDevice(Device):
+    """
+    SocketCAN device on a raw AF_CAN socket without python-can: the kernel filters the frames by
+    Device.acceptance_filters, and the frames are received and sent in batches (recvmmsg / sendmmsg).
+
+    Linux only, e.g. on a vcan interface without hardware:
+        sudo modprobe vcan
+        sudo ip link add dev vcan0 type vcan
+        sudo ip link set up vcan0
+    """
+
+    def __init__(self, channel: str = 'can0', batch: int = 64):
+        """
+        :param channel: the interface, e.g. can0 or vcan0
+        :param batch: the max number of frames of one recvmmsg / sendmmsg
+        """
+        super(RawCanDevice, self).__init__()
+        self.__channel = channel
+        self.__socket = None
+        self.__thread = None
+        self.__terminal = False
+        self.__rx_batch = _FrameBatch(batch)
+        self.__tx_batch = _FrameBatch(batch)
+        self.__tx_lock = threading.Lock()
+        self.enable()
+
+    @property
+    def channel(self):
+        return self.__channel
+
+    def add_node(self, index: int, node: Node):
+        super(RawCanDevice, self).add_node(index, node)
+        self.__set_filters()
+        pass
+
+    def remove_node(self, index: int, node: Node = None) -> bool:
+        _removed = super(RawCanDevice, self).remove_node(index, node)
+        if _removed:
+            self.__set_filters()
+            pass
+        return _removed
+
+    def __set_filters(self):
+        # Only the frames handled by the registered nodes reach the RX thread
+        _sock = self.__socket
+        if _sock is None:
+            return
+        _filters = b''.join(_CAN_FILTER.pack(_CAN_EFF_FLAG | _can_id, _CAN_EFF_FLAG | _can_mask)
+                            for _can_id, _can_mask in self.acceptance_filters())
+        _sock.setsockopt(_SOL_CAN_RAW, _CAN_RAW_FILTER, _filters)
+        pass
+
+    def enable(self):
+        if self.__thread is None:
+            self.__terminal = False
+            self.__socket = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+            self.__set_filters()
+            self.__socket.bind((self.__channel,))
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+            pass
+        pass
+
+    def disable(self):
+        if self.__thread is not None:
+            self.__terminal = True
+            self.__thread.join()
+            self.__socket.close()
+            self.__socket = None
+            self.__thread = None
+            pass
+        pass
+
+    def __pack(self, offset: int, msg):
+        _data = msg.data
+        _CAN_FRAME.pack_into(self.__tx_batch.view, offset, (msg.arbitration_id & _CAN_EFF_MASK) | _CAN_EFF_FLAG,
+                             len(_data), bytes(_data))
+        pass
+
+    def send_message(self, msg):
+        self.send_burst((msg,))
+        pass
+
+    def send_burst(self, msgs: list):
+        _batch = self.__tx_batch
+        with self.__tx_lock:
+            for _begin in range(0, len(msgs), _batch.count):
+                _chunk = msgs[_begin:_begin + _batch.count]
+                for _i, _msg in enumerate(_chunk):
+                    self.__pack(_i * _batch.frame_size, _msg)
+                    pass
+                _sent = 0
+                _retry = 0
+                while _sent < len(_chunk):
+                    _n = _batch.send(self.__socket, len(_chunk) - _sent)
+                    if _n > 0:
+                        _sent += _n
+                        _retry = 0
+                        # Move the rest to the front of the batch
+                        for _i, _msg in enumerate(_chunk[_sent:]):
+                            self.__pack(_i * _batch.frame_size, _msg)
+                            pass
+                        pass
+                    elif _retry < 10:
+                        # The TX queue of the interface is full, wait like CanDevice
+                        _retry += 1
+                        time.sleep(0.1)
+                        pass
+                    else:
+                        raise _can_error('Transmit buffer full')
+                    pass
+                pass
+        pass
+
+    def __run(self):
+        _sock = self.__socket
+        _batch = self.__rx_batch
+        _view = _batch.view
+        _size = _batch.frame_size
+        _unpack_from = _CAN_FRAME.unpack_from
+        _on_frame = self.on_frame
+        while not self.__terminal:
+            if not select.select([_sock], [], [], 1)[0]:
+                continue
+            _n = _batch.recv(_sock)
+            for _i in range(_n):
+                _can_id, _dlc, _ = _unpack_from(_view, _i * _size)
+                if _can_id & (_CAN_EFF_FLAG | _CAN_RTR_FLAG | _CAN_ERR_FLAG) != _CAN_EFF_FLAG:
+                    continue
+                _offset = _i * _size + 8
+                # The data is a view of the batch, it is only valid during the call
+                _on_frame(_can_id & _CAN_EFF_MASK, _view[_offset:_offset + min(_dlc, 8)])
+                pass
+            pass
+        pass
+
+    pass
+
+
+def main():
+    # Requests from a raw socket (the SLC) to one node on a vcan interface, replies/s and filtered frames
+    from BmcNode import BmcNode
+
+    _channel = sys.argv[1] if len(sys.argv) > 1 else 'vcan0'
+    if not is_supported():
+        print('AF_CAN is not supported by this system')
+        return
+    _device = RawCanDevice(_channel)
+    _node = BmcNode(1, _device)
+    _node.config(sku='GVSMODBC9')
+    _node.start()
+    _slc = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    _slc.bind((_channel,))
+    _slc.settimeout(0.5)
+    _requests = 1000
+    _begin = time.perf_counter()
+    for _i in range(_requests):
+        _slc.send(_CAN_FRAME.pack(0x11000330 | _CAN_EFF_FLAG, 0, b''))
+        _slc.send(_CAN_FRAME.pack(0x15000330 | _CAN_EFF_FLAG, 0, b''))  # no node 5, filtered by the kernel
+        pass
+    _replies = 0
+    try:
+        while _replies < _requests * 24:
+            _can_id = _CAN_FRAME.unpack(_slc.recv(_CAN_FRAME.size))[0] & _CAN_EFF_MASK
+            if _can_id & 0xffff not in (0x0330, 0x0000):
+                _replies += 1
+                pass
+            pass
+        pass
+    except socket.timeout:
+        pass
+    _elapsed = time.perf_counter() - _begin
+    print('replies: {}, {:.0f} frames/s, hits: {}'.format(_replies, _replies / _elapsed, _node.get_hit_counts()))
+    _node.stop()
+    _device.disable()
+    _slc.close()
+    pass
+
+
+if __name__ == '__main__':
+    main()
+    pass
@@ -0,0 +1,386 @@
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+from BmcShm import attach_shared_memory
+
+# Region layout: the read counter and the write counter in their own cache lines, then the records.
+# The counters only increase, the slot of a counter is (counter & mask).
+_RING_MAGIC = b'BMCR'
+_RING_INFO = struct.Struct('<4sII')  # magic, capacity, record size
+_COUNTER = struct.Struct('<Q')
+_OFFSET_INFO = 0
+_OFFSET_HEAD = 64  # read counter, written by the consumer
+_OFFSET_TAIL = 128  # write counter, written by the producer
+_OFFSET_RECORDS = 192
+
+# One CAN frame: can id, dlc, channel, data
+FRAME_RECORD = struct.Struct('<IBB2x8s')
+
+
+class FrameRing:
+    """
+    Single producer / single consumer ring of CAN frame records in shared memory.
+
+    The producer and the consumer can live in different processes, no lock is taken.
+    If more than one thread of a process puts (or gets), these threads must serialize themselves.
+    """
+
+    def __init__(self, capacity: int = 4096, name: str = None, create: bool = True):
+        """
+        :param capacity: the number of records, must be a power of 2
+        :param name: the shared memory name
+        :param create: True creates a new ring, False attaches to the ring of the name
+        """
+        if create:
+            if capacity <= 0 or (capacity & (capacity - 1)) != 0:
+                raise ValueError('capacity must be a power of 2')
+            _size = _OFFSET_RECORDS + FRAME_RECORD.size * capacity
+            self.__shm = shared_memory.SharedMemory(name=name, create=True, size=_size)
+            self.__owner = True
+            _RING_INFO.pack_into(self.__shm.buf, _OFFSET_INFO, _RING_MAGIC, capacity, FRAME_RECORD.size)
+            pass
+        else:
+            self.__shm = attach_shared_memory(name)
+            self.__owner = False
+            _magic, capacity, _size = _RING_INFO.unpack_from(self.__shm.buf, _OFFSET_INFO)
+            if _magic != _RING_MAGIC or _size != FRAME_RECORD.size:
+                self.__shm.close()
+                raise ValueError('invalid frame ring {}'.format(name))
+            pass
+        self.__buf = self.__shm.buf
+        self.__capacity = capacity
+        self.__mask = capacity - 1
+        pass
+
+    @property
+    def name(self):
+        return self.__shm.name
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    def __len__(self):
+        return _COUNTER.unpack_from(self.__buf, _OFFSET_TAIL)[0] - _COUNTER.unpack_from(self.__buf, _OFFSET_HEAD)[0]
+
+    def close(self):
+        self.__buf = None
+        self.__shm.close()
+        if self.__owner:
+            self.__shm.unlink()
+            pass
+        pass
+
+    def put(self, channel: int, can_id: int, data) -> bool:
+        """
+        :param channel: the channel (device number) of the frame
+        :param can_id: the CAN id
+        :param data: the frame data, max 8 bytes
+        :return: False if the ring is full
+        """
+        _buf = self.__buf
+        _tail = _COUNTER.unpack_from(_buf, _OFFSET_TAIL)[0]
+        if _tail - _COUNTER.unpack_from(_buf, _OFFSET_HEAD)[0] >= self.__capacity:
+            return False
+        FRAME_RECORD.pack_into(_buf, _OFFSET_RECORDS + FRAME_RECORD.size * (_tail & self.__mask),
+                               can_id, len(data), channel, bytes(data))
+        _COUNTER.pack_into(_buf, _OFFSET_TAIL, _tail + 1)
+        return True
+
+    def get(self):
+        """
+        :return: (channel, can_id, data) of the oldest frame, or None if the ring is empty
+        """
+        _buf = self.__buf
+        _head = _COUNTER.unpack_from(_buf, _OFFSET_HEAD)[0]
+        if _head == _COUNTER.unpack_from(_buf, _OFFSET_TAIL)[0]:
+            return None
+        _can_id, _dlc, _channel, _data = FRAME_RECORD.unpack_from(
+            _buf, _OFFSET_RECORDS + FRAME_RECORD.size * (_head & self.__mask))
+        _COUNTER.pack_into(_buf, _OFFSET_HEAD, _head + 1)
+        return _channel, _can_id, _data[:_dlc]
+
+    pass
+
+
+_SLOT_SIZE = 16  # can id (4 bytes), dlc (1 byte), 3 bytes free, data (8 bytes)
+_SLOT_WORDS = _SLOT_SIZE // 4
+_OFFSET_DLC = 4
+_OFFSET_DATA = 8
+
+
+class SpmcFrameRing:
+    """
+    Single producer / multi consumer ring of CAN frame records in one preallocated buffer.
+
+    The producer routes every frame to one consumer, every consumer has its own part of the buffer and
+    its own counters, so a consumer only walks its own frames and the cost of a frame does not grow with
+    the number of consumers. A consumer gets the data of a frame as a memoryview of the slot, which is
+    valid until its handler returns, the id and the dlc are read from a pre-cast view of the buffer, so
+    nothing is copied or allocated per frame after the warm-up. If the part of a consumer is full, the
+    producer drops the frame and counts an overflow, it never blocks.
+    """
+
+    def __init__(self, capacity: int = 1024, consumers: int = 1, route=None):
+        """
+        :param capacity: the number of records of each consumer, must be a power of 2
+        :param consumers: the number of consumers
+        :param route: route(can_id) -> consumer index, None routes by the node index of the CAN id,
+                      (index % consumers), so the frames of one node go to the same consumer
+        """
+        if capacity <= 0 or (capacity & (capacity - 1)) != 0:
+            raise ValueError('capacity must be a power of 2')
+        if consumers < 1:
+            raise ValueError('at least one consumer')
+        self.__capacity = capacity
+        self.__mask = capacity - 1
+        self.__route = route
+        self.__count = consumers
+        self.__buf = bytearray(_SLOT_SIZE * capacity * consumers)
+        self.__view = memoryview(self.__buf)
+        self.__words = self.__view.cast('I')
+        self.__data_views = [[None] * 9 for _ in range(capacity * consumers)]  # [slot][dlc], created on first use
+        self.__bases = [_c * capacity for _c in range(consumers)]  # the first slot of every consumer
+        self.__tails = [0] * consumers
+        self.__heads = [0] * consumers
+        self.__received = 0
+        self.__overflow = 0
+        self.__high_water = 0
+        self.__sleeping = [False] * consumers
+        self.__events = [threading.Event() for _ in range(consumers)]
+        pass
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    @property
+    def consumers(self):
+        return len(self.__heads)
+
+    @property
+    def received(self):
+        """
+        :return: the number of frames put into the ring
+        """
+        return self.__received
+
+    @property
+    def overflow(self):
+        """
+        :return: the number of dropped frames because the part of the consumer is full
+        """
+        return self.__overflow
+
+    @property
+    def high_water(self):
+        """
+        :return: the max number of pending frames of one consumer ever seen
+        """
+        return self.__high_water
+
+    def pending(self, consumer: int) -> int:
+        return self.__tails[consumer] - self.__heads[consumer]
+
+    def put(self, can_id: int, data) -> bool:
+        """
+        Called by the producer only
+        :param can_id: the CAN id
+        :param data: the frame data, max 8 bytes
+        :return: False if the part of the consumer is full and the frame is dropped
+        """
+        _route = self.__route
+        _consumer = ((can_id >> 24) & 0xf) % self.__count if _route is None else _route(can_id)
+        _tail = self.__tails[_consumer]
+        _pending = _tail - self.__heads[_consumer]
+        if _pending >= self.__capacity:
+            self.__overflow += 1
+            return False
+        _slot = self.__bases[_consumer] + (_tail & self.__mask)
+        _offset = _slot * _SLOT_SIZE
+        _n = len(data)
+        _buf = self.__buf
+        self.__words[_slot * _SLOT_WORDS] = can_id
+        _buf[_offset + _OFFSET_DLC] = _n
+        _buf[_offset + _OFFSET_DATA:_offset + _OFFSET_DATA + _n] = data
+        self.__tails[_consumer] = _tail + 1
+        self.__received += 1
+        if _pending + 1 > self.__high_water:
+            self.__high_water = _pending + 1
+            pass
+        if self.__sleeping[_consumer]:
+            self.__sleeping[_consumer] = False
+            self.__events[_consumer].set()
+            pass
+        return True
+
+    def consume(self, consumer: int, handler, max_count: int = 64) -> int:
+        """
+        Called by the consumer only
+        :param consumer: the consumer index
+        :param handler: handler(can_id, data), data is a memoryview which is only valid during the call
+        :param max_count: the max number of handled frames
+        :return: the number of handled frames
+        """
+        _head = self.__heads[consumer]
+        _n = min(self.__tails[consumer] - _head, max_count)
+        _buf = self.__buf
+        _words = self.__words
+        _mask = self.__mask
+        _base = self.__bases[consumer]
+        _data_views = self.__data_views
+        for _seq in range(_head, _head + _n):
+            _slot = _base + (_seq & _mask)
+            _dlc = _buf[_slot * _SLOT_SIZE + _OFFSET_DLC]
+            _data = _data_views[_slot][_dlc]
+            if _data is None:
+                _offset = _slot * _SLOT_SIZE + _OFFSET_DATA
+                _data = _data_views[_slot][_dlc] = self.__view[_offset:_offset + _dlc]
+                pass
+            handler(_words[_slot * _SLOT_WORDS], _data)
+            pass
+        if _n:
+            self.__heads[consumer] = _head + _n
+            pass
+        return _n
+
+    def wait(self, consumer: int, timeout: float = None) -> bool:
+        """
+        Called by the consumer only, wait until there is a frame for it
+        :return: True if there is a frame
+        """
+        _event = self.__events[consumer]
+        _event.clear()
+        self.__sleeping[consumer] = True
+        if self.__tails[consumer] != self.__heads[consumer]:
+            return True
+        return _event.wait(timeout)
+
+    def wake_all(self):
+        for _event in self.__events:
+            _event.set()
+            pass
+        pass
+
+    pass
+
+
+class RxDispatcher:
+    """
+    Decouple the RX thread of a device from the node handlers.
+
+    The RX thread only puts the frames into a SpmcFrameRing, the consumer threads dispatch them to the
+    nodes. The nodes are partitioned by index over the consumers, so the frames of one node keep their
+    order and a slow handler only delays the nodes of its own consumer.
+    """
+
+    def __init__(self, device, consumers: int = 2, capacity: int = 1024):
+        """
+        :param device: the device instance
+        :param consumers: the number of consumer threads
+        :param capacity: the number of frames of each consumer, must be a power of 2
+        """
+        self.__device = device
+        self.__consumers = consumers
+        self.__capacity = capacity
+        self.__ring = None
+        self.__threads = []
+        self.__terminal = False
+        pass
+
+    @property
+    def ring(self) -> SpmcFrameRing:
+        return self.__ring
+
+    def start(self):
+        if self.__ring is not None:
+            return
+        self.__terminal = False
+        self.__ring = SpmcFrameRing(self.__capacity, self.__consumers)
+        for _i in range(self.__consumers):
+            _thread = threading.Thread(target=self.__run, args=(_i,), daemon=True)
+            _thread.start()
+            self.__threads.append(_thread)
+            pass
+        self.__device.set_receiver(self.__ring.put)
+        pass
+
+    def stop(self):
+        if self.__ring is None:
+            return
+        self.__device.set_receiver(None)
+        self.__terminal = True
+        self.__ring.wake_all()
+        for _thread in self.__threads:
+            _thread.join()
+            pass
+        self.__threads = []
+        self.__ring = None
+        pass
+
+    def __run(self, consumer: int):
+        # The ring routes the frames by node index, a consumer only gets the frames of its own nodes
+        _ring = self.__ring
+        _dispatch = self.__device.dispatch
+        while True:
+            if _ring.consume(consumer, _dispatch) == 0:
+                if self.__terminal:
+                    break
+                _ring.wait(consumer, 0.1)
+                pass
+            pass
+        pass
+
+    pass
+
+
+def main():
+    # Sustained frames/s of one producer and several consumers, the handler only counts the frames
+    _frames = 500000
+    _data = bytearray(8)
+    for _consumers in (1, 2, 4):
+        _ring = SpmcFrameRing(4096, _consumers)
+        _handled = [0] * _consumers
+        _terminal = []
+
+        def _run(consumer):
+            def _handler(can_id, data):
+                _handled[consumer] += 1
+                pass
+
+            while True:
+                if _ring.consume(consumer, _handler, 256) == 0:
+                    if _terminal:
+                        break
+                    _ring.wait(consumer, 0.01)
+                    pass
+                pass
+            pass
+
+        _threads = [threading.Thread(target=_run, args=(_i,)) for _i in range(_consumers)]
+        for _thread in _threads:
+            _thread.start()
+            pass
+        _begin = time.perf_counter()
+        for _i in range(_frames):
+            if not _ring.put(((_i % 10) << 24) | 0x10000330, _data):
+                time.sleep(0)  # let the consumers run, the overflow is counted anyway
+                pass
+            pass
+        _terminal.append(True)
+        _ring.wake_all()
+        for _thread in _threads:
+            _thread.join()
+            pass
+        _elapsed = time.perf_counter() - _begin
+        print('consumers: {}, put: {}, handled: {}, overflow: {}, high water: {}, {:.0f} frames/s'.format(
+            _consumers, _ring.received, sum(_handled), _ring.overflow, _ring.high_water, _ring.received / _elapsed))
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    main()
+    pass
@@ -0,0 +1,353 @@
+import multiprocessing
+import threading
+import time
+
+from BmcNode import Node, Device, BmcNode, make_message
+from BmcShm import SharedStatePlane
+from BmcRing import FrameRing
+
+
+class _ShardDevice(Device):
+    """
+    The device of the nodes in a worker process, the frames go through the TX ring to the front process.
+    """
+
+    def __init__(self, channel: int, tx_ring: FrameRing, tx_lock: threading.Lock):
+        super(_ShardDevice, self).__init__()
+        self.__channel = channel
+        self.__tx_ring = tx_ring
+        self.__tx_lock = tx_lock
+        pass
+
+    def send_message(self, msg):
+        # The ring is full if the front process can't send fast enough, wait like a full CAN buffer
+        while True:
+            with self.__tx_lock:
+                if self.__tx_ring.put(self.__channel, msg.arbitration_id, msg.data):
+                    break
+            time.sleep(0.001)
+            pass
+        pass
+
+    pass
+
+
+class _RemoteNode(Node):
+    """
+    The stand-in of a node in the front process, it forwards the received frames to the worker.
+    """
+    accepted_ids = BmcNode.accepted_ids
+
+    def __init__(self, channel: int, index: int, rx_ring: FrameRing, rx_lock: threading.Lock):
+        self.__channel = channel
+        self.__id = 0x1a000000 if index == 0 else (index << 24) | 0x10000000
+        self.__rx_ring = rx_ring
+        self.__rx_lock = rx_lock
+        self.__dropped = 0
+        pass
+
+    @property
+    def dropped(self) -> int:
+        """
+        :return: the number of the frames dropped by a full ring
+        """
+        return self.__dropped
+
+    def start(self):
+        pass
+
+    def stop(self):
+        # The ring is closed after this, a frame dispatched at the same time is dropped
+        with self.__rx_lock:
+            self.__rx_ring = None
+        pass
+
+    def on_message(self, msg_id: int, msg_data: bytearray):
+        # Dropped if the worker is too slow, like an overrun of the CAN controller. The requests coalesced by
+        # the fan-out of the device have no data
+        if msg_data is None:
+            msg_data = b''
+            pass
+        with self.__rx_lock:
+            if self.__rx_ring is not None:
+                if not self.__rx_ring.put(self.__channel, self.__id | msg_id, msg_data):
+                    self.__dropped += 1
+                    pass
+                pass
+        pass
+
+    pass
+
+
+def _worker_main(keys, slots, setup, plane_name, rx_name, tx_name, ready, terminal):
+    _plane = SharedStatePlane(name=plane_name)
+    _rx_ring = FrameRing(name=rx_name, create=False)
+    _tx_ring = FrameRing(name=tx_name, create=False)
+    _tx_lock = threading.Lock()
+    _devices = {}
+    _nodes = []
+    for (_channel, _index), _slot in zip(keys, slots):
+        if _channel not in _devices:
+            _devices[_channel] = _ShardDevice(_channel, _tx_ring, _tx_lock)
+            pass
+        _node = setup(_devices[_channel], _index)
+        _node.attach_state_plane(_plane, _slot)
+        _nodes.append(_node)
+        pass
+    ready.set()
+
+    _idle = 0
+    while True:
+        _frame = _rx_ring.get()
+        if _frame is None:
+            _idle += 1
+            if _idle > 100:
+                if terminal.is_set():
+                    break
+                time.sleep(0.001)
+                pass
+            continue
+        _idle = 0
+        _channel, _can_id, _data = _frame
+        try:
+            _devices[_channel].dispatch(_can_id, bytearray(_data))
+            pass
+        except KeyError:
+            pass
+        pass
+
+    for _node in _nodes:
+        _node.stop()
+        _node.detach_state_plane()
+        pass
+    _plane.close()
+    _rx_ring.close()
+    _tx_ring.close()
+    pass
+
+
+class ShardedFleet:
+    """
+    Host many BmcNode in several worker processes, so the fleet is not bound by the GIL of one process.
+
+    The front process (the one creating this instance) owns the devices: the received frames are routed
+    by node index to the worker which hosts the node, and the frames of all workers are sent by one TX
+    thread. The front and the workers are connected by shared memory frame rings. The dynamic data of
+    all nodes is kept in a SharedStatePlane, use `plane` and `slot` to change it from any process.
+    """
+
+    def __init__(self, devices: list, keys: list, setup, workers: int = None, ring_capacity: int = 4096):
+        """
+        :param devices: the device instances (CanDevice, SimCanDevice ...), the position is the channel
+        :param keys: the nodes to host, list of (channel, index)
+        :param setup: setup(device, index) -> BmcNode, called in the worker process to create, configure
+                      and start a node. It must be a module level function.
+        :param workers: the number of worker processes, default is the number of CPU cores
+        :param ring_capacity: the number of frames of each ring, must be a power of 2
+        """
+        self.__devices = list(devices)
+        self.__keys = [tuple(_k) for _k in keys]
+        if len(set(self.__keys)) != len(self.__keys):
+            raise ValueError('duplicated node')
+        for _channel, _index in self.__keys:
+            if _channel < 0 or _channel >= len(self.__devices):
+                raise ValueError('{} out of the range of channel'.format(_channel))
+            pass
+        self.__setup = setup
+        self.__workers = max(1, min(workers or multiprocessing.cpu_count(), len(self.__keys)))
+        self.__ring_capacity = ring_capacity
+        self.__plane = None
+        self.__rx_rings = []
+        self.__tx_rings = []
+        self.__processes = []
+        self.__proxies = []  # (channel, index, _RemoteNode) registered on the devices
+        self.__dropped = 0  # the frames dropped by the proxies of the last runs
+        self.__terminal = None
+        self.__thread = None
+        self.__running = False
+        pass
+
+    @property
+    def plane(self) -> SharedStatePlane:
+        return self.__plane
+
+    @property
+    def dropped(self) -> int:
+        """
+        :return: the number of the received frames dropped because the RX ring of a worker was full
+        """
+        return self.__dropped + sum(_proxy.dropped for _channel, _index, _proxy in self.__proxies)
+
+    def slot(self, channel: int, index: int) -> int:
+        """
+        :return: the slot of the node in the plane
+        """
+        return self.__keys.index((channel, index))
+
+    def start(self):
+        if self.__running:
+            return
+        self.__plane = SharedStatePlane(len(self.__keys))
+        self.__terminal = multiprocessing.Event()
+        _ready = []
+        for _w in range(self.__workers):
+            _rx_ring = FrameRing(self.__ring_capacity)
+            _tx_ring = FrameRing(self.__ring_capacity)
+            _rx_lock = threading.Lock()
+            _slots = list(range(_w, len(self.__keys), self.__workers))
+            _keys = [self.__keys[_s] for _s in _slots]
+            for _channel, _index in _keys:
+                _proxy = _RemoteNode(_channel, _index, _rx_ring, _rx_lock)
+                self.__devices[_channel].add_node(_index, _proxy)
+                self.__proxies.append((_channel, _index, _proxy))
+                pass
+            _event = multiprocessing.Event()
+            _process = multiprocessing.Process(
+                target=_worker_main,
+                args=(_keys, _slots, self.__setup, self.__plane.name, _rx_ring.name, _tx_ring.name,
+                      _event, self.__terminal),
+                daemon=True)
+            _process.start()
+            self.__rx_rings.append(_rx_ring)
+            self.__tx_rings.append(_tx_ring)
+            self.__processes.append(_process)
+            _ready.append(_event)
+            pass
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run_tx, daemon=True)
+        self.__thread.start()
+        for _event in _ready:
+            _event.wait()
+            pass
+        pass
+
+    def stop(self):
+        if not self.__running:
+            return
+        # No frame may reach a ring after it is closed
+        for _channel, _index, _proxy in self.__proxies:
+            self.__devices[_channel].remove_node(_index, _proxy)
+            _proxy.stop()
+            self.__dropped += _proxy.dropped
+            pass
+        self.__proxies = []
+        self.__terminal.set()
+        for _process in self.__processes:
+            _process.join()
+            pass
+        self.__running = False
+        self.__thread.join()
+        for _ring in self.__rx_rings + self.__tx_rings:
+            _ring.close()
+            pass
+        self.__plane.close()
+        self.__rx_rings = []
+        self.__tx_rings = []
+        self.__processes = []
+        self.__plane = None
+        self.__thread = None
+        pass
+
+    def __run_tx(self):
+        _idle = 0
+        while self.__running:
+            _n = 0
+            for _ring in self.__tx_rings:
+                # At most 64 frames of one worker per round, so no worker starves the others
+                _bursts = {}  # channel: frames
+                for _i in range(64):
+                    _frame = _ring.get()
+                    if _frame is None:
+                        break
+                    _channel, _can_id, _data = _frame
+                    _bursts.setdefault(_channel, []).append(make_message(_can_id, bytearray(_data)))
+                    _n += 1
+                    pass
+                # Through the transmitter of the device, like the TX thread of BmcNode
+                for _channel, _msgs in _bursts.items():
+                    try:
+                        if len(_msgs) == 1:
+                            self.__devices[_channel].transmit(_msgs[0])
+                            pass
+                        else:
+                            self.__devices[_channel].transmit_burst(_msgs)
+                            pass
+                        pass
+                    except Exception as _e:
+                        print('WARNING:', 'channel {} send failed: {}'.format(_channel, _e))
+                        pass
+                    pass
+                pass
+            if _n == 0:
+                _idle += 1
+                if _idle > 100:
+                    time.sleep(0.001)
+                    pass
+                pass
+            else:
+                _idle = 0
+                pass
+            pass
+        pass
+
+    pass
+
+
+def _bench_setup(device, index):
+    _node = BmcNode(index, device)
+    _node.config(sku='GVSMODBC9')
+    _node.start()
+    return _node
+
+
+class _CountDevice(Device):
+    def __init__(self):
+        super(_CountDevice, self).__init__()
+        self.count = 0
+        pass
+
+    def send_message(self, msg):
+        # The replies only, not the heartbeats (message id 0)
+        if msg.arbitration_id & 0xffff:
+            self.count += 1
+            pass
+        pass
+
+    pass
+
+
+def main():
+    # Throughput of 0x0330 replies (24 frames per request) for 10 channels x 10 nodes
+    _keys = [(_channel, _index) for _channel in range(10) for _index in range(10)]
+    for _workers in sorted({1, multiprocessing.cpu_count()}):
+        _devices = [_CountDevice() for _ in range(10)]
+        _fleet = ShardedFleet(_devices, _keys, _bench_setup, workers=_workers)
+        _fleet.start()
+        _requests = 200
+        _expected = _requests * len(_keys) * 24
+        _begin = time.perf_counter()
+        for _r in range(_requests):
+            for _channel, _index in _keys:
+                _id = (0x1a000000 if _index == 0 else (_index << 24) | 0x10000000) | 0x0330
+                _devices[_channel].on_message(make_message(_id))
+                pass
+            # Let the workers drain, the rings are not unbounded
+            while sum(_d.count for _d in _devices) < (_r + 1) * len(_keys) * 24 - 4096:
+                time.sleep(0.0005)
+                pass
+            pass
+        while sum(_d.count for _d in _devices) < _expected and time.perf_counter() - _begin < 120:
+            time.sleep(0.001)
+            pass
+        _elapsed = time.perf_counter() - _begin
+        _sent = sum(_d.count for _d in _devices)
+        print('workers: {}, frames: {}, {:.0f} frames/s, dropped: {}'.format(_workers, _sent, _sent / _elapsed,
+                                                                         _fleet.dropped))
+        _fleet.stop()
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    main()
+    pass
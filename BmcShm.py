@@ -0,0 +1,256 @@
+import struct
+import time
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+from BmcNode import BmcState
+
+# Region layout: header + one record per slot. Every record starts with a sequence counter
+# (seqlock): it is odd while a writer is changing the record and increased by 2 per change,
+# so a reader can detect a torn read and a changed record without any lock.
+_PLANE_MAGIC = b'BMCS'
+_PLANE_FORMAT_VERSION = 1
+_PLANE_HEADER = struct.Struct('<4sHHI')  # magic, format version, record size, slot count
+_SEQ = struct.Struct('<I')
+_RECORD = struct.Struct(
+    '<I'  # sequence
+    'B'  # bit0: fuse0, bit1: fuse1, bit2: breaker
+    '10H'  # currents
+    '40B'  # battery types, 10 x 4
+    '40b'  # battery temperatures, 10 x 4
+    '10B'  # string LED status
+)
+_RECORD_SIZE = 128  # _RECORD.size rounded up, keeps the records apart in the cache
+_OFFSET_FLAGS = 4
+_OFFSET_CURRENT = 5
+_OFFSET_TYPE = 25
+_OFFSET_TEMP = 65
+_CURRENT = struct.Struct('<H')
+_TYPE = struct.Struct('<4B')
+_TEMP = struct.Struct('<4b')
+_BYTE = struct.Struct('<B')
+_LOAD_SPINS = 1024  # the retries of a load before it yields the CPU to the writer
+_LOAD_TIMEOUT = 0.5  # seconds a load waits for a writer, e.g. one which died in the middle of a write
+
+
+def attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach an existing shared memory which is created and owned by another process
+    :param name: the shared memory name
+    :return: SharedMemory instance
+    """
+    _shm = shared_memory.SharedMemory(name=name, create=False)
+    # The creator owns the region, it must not be unlinked when this process exits.
+    # A multiprocessing child shares the resource tracker of its parent, nothing to do then.
+    if multiprocessing.parent_process() is None:
+        resource_tracker.unregister(_shm._name, 'shared_memory')
+        pass
+    return _shm
+
+
+class SharedStatePlane:
+    """
+    The dynamic data of a fleet of BmcNode in one shared memory region.
+
+    One process creates the plane and attaches its nodes by BmcNode.attach_state_plane, the
+    encoders of these nodes read the plane directly. Any other process can attach to the plane
+    by name and change the values in place, there is no IPC round-trip.
+
+    Only one writer may change one slot at the same time.
+    """
+
+    def __init__(self, slots: int = 0, name: str = None):
+        """
+        :param slots: the number of node slots, > 0 creates a new plane, 0 attaches to the plane of the name
+        :param name: the shared memory name
+        """
+        if slots > 0:
+            _size = _PLANE_HEADER.size + _RECORD_SIZE * slots
+            self.__shm = shared_memory.SharedMemory(name=name, create=True, size=_size)
+            self.__owner = True
+            _PLANE_HEADER.pack_into(self.__shm.buf, 0, _PLANE_MAGIC, _PLANE_FORMAT_VERSION, _RECORD_SIZE, slots)
+            pass
+        elif name is not None:
+            self.__shm = attach_shared_memory(name)
+            self.__owner = False
+            _magic, _version, _size, slots = _PLANE_HEADER.unpack_from(self.__shm.buf, 0)
+            if _magic != _PLANE_MAGIC or _version != _PLANE_FORMAT_VERSION or _size != _RECORD_SIZE:
+                self.__shm.close()
+                raise ValueError('invalid state plane {}'.format(name))
+            pass
+        else:
+            raise ValueError('slots or name must be given')
+        self.__slots = slots
+        self.__buf = self.__shm.buf
+        pass
+
+    @property
+    def name(self):
+        return self.__shm.name
+
+    @property
+    def slots(self):
+        return self.__slots
+
+    def close(self):
+        self.__buf = None
+        self.__shm.close()
+        if self.__owner:
+            self.__shm.unlink()
+            pass
+        pass
+
+    def attach_nodes(self, nodes):
+        """
+        Attach the nodes to the slots 0, 1, 2 ... in order
+        :param nodes: the BmcNode instances
+        :return:
+        """
+        for _slot, _node in enumerate(nodes):
+            _node.attach_state_plane(self, _slot)
+            pass
+        pass
+
+    def __offset(self, slot: int):
+        if slot < 0 or slot >= self.__slots:
+            raise ValueError('out of slot')
+        return _PLANE_HEADER.size + _RECORD_SIZE * slot
+
+    def __begin(self, offset: int, version: int = 0) -> int:
+        # With version the record is ended at this version if it is behind, see store
+        _seq = _SEQ.unpack_from(self.__buf, offset)[0] | 1
+        _seed = ((version << 1) - 1) & 0xffffffff
+        if version and _seed > _seq:
+            _seq = _seed
+            pass
+        _SEQ.pack_into(self.__buf, offset, _seq)
+        return _seq
+
+    def __end(self, offset: int, seq: int):
+        _SEQ.pack_into(self.__buf, offset, (seq + 1) & 0xffffffff)
+        pass
+
+    def load(self, slot: int, cache: BmcState = None) -> BmcState:
+        """
+        :param slot: the slot index
+        :param cache: the state returned by the last load, it is returned again if the slot is not changed,
+                      or if a writer does not end its change within 0.5 seconds
+        :return: the consistent state of the slot, TimeoutError if a writer does not end its change within
+                 0.5 seconds and there is no cache
+        """
+        _offset = self.__offset(slot)
+        _buf = self.__buf
+        _spins = 0
+        _deadline = None
+        while True:
+            _seq = _SEQ.unpack_from(_buf, _offset)[0]
+            if not _seq & 1:
+                if cache is not None and cache.version == _seq >> 1:
+                    return cache
+                _r = _RECORD.unpack_from(_buf, _offset)
+                if _SEQ.unpack_from(_buf, _offset)[0] == _seq:
+                    break
+                pass
+            # A change is in progress, give the writer the CPU after a while, and don't wait forever
+            _spins += 1
+            if _spins >= _LOAD_SPINS:
+                _now = time.monotonic()
+                if _deadline is None:
+                    _deadline = _now + _LOAD_TIMEOUT
+                    pass
+                elif _now > _deadline:
+                    if cache is not None:
+                        return cache
+                    raise TimeoutError('slot {} is not released by its writer'.format(slot))
+                time.sleep(0)
+                pass
+            pass
+        _flags = _r[1]
+        _type = _r[12:52]
+        _temp = _r[52:92]
+        return BmcState(
+            version=_seq >> 1,
+            fuse=((_flags & 0x01) != 0, (_flags & 0x02) != 0),
+            breaker=(_flags & 0x04) != 0,
+            current=_r[2:12],
+            bat_type=tuple(_type[_i:_i + 4] for _i in range(0, 40, 4)),
+            bat_temp=tuple(_temp[_i:_i + 4] for _i in range(0, 40, 4)),
+            string_led=_r[92:102])
+
+    def store(self, slot: int, state: BmcState):
+        """
+        Write the whole state to the slot. The version of the slot is raised to the version of the state if
+        it is behind, so a node attached to a plane keeps its versions increasing
+        :param slot: the slot index
+        :param state: BmcState instance
+        :return:
+        """
+        _offset = self.__offset(slot)
+        _flags = (0x01 if state.fuse[0] else 0) | (0x02 if state.fuse[1] else 0) | (0x04 if state.breaker else 0)
+        _seq = self.__begin(_offset, state.version)
+        _RECORD.pack_into(
+            self.__buf, _offset,
+            _seq,
+            _flags,
+            *[_v & 0xffff for _v in state.current],
+            *[_v & 0xff for _row in state.bat_type for _v in _row],
+            *[((_v + 0x80) & 0xff) - 0x80 for _row in state.bat_temp for _v in _row],
+            *[_v & 0xff for _v in state.string_led])
+        self.__end(_offset, _seq)
+        pass
+
+    def snapshot(self, slot: int) -> BmcState:
+        return self.load(slot, None)
+
+    def set_temperature(self, slot: int, index: int, va: int, vb: int, vc: int, vd: int):
+        if index < 0 or index > 9:
+            raise ValueError('out of index')
+        _offset = self.__offset(slot)
+        _seq = self.__begin(_offset)
+        _TEMP.pack_into(self.__buf, _offset + _OFFSET_TEMP + index * 4,
+                        ((va + 0x80) & 0xff) - 0x80, ((vb + 0x80) & 0xff) - 0x80,
+                        ((vc + 0x80) & 0xff) - 0x80, ((vd + 0x80) & 0xff) - 0x80)
+        self.__end(_offset, _seq)
+        pass
+
+    def set_type(self, slot: int, index: int, va: int, vb: int, vc: int, vd: int):
+        if index < 0 or index > 9:
+            raise ValueError('out of index')
+        _offset = self.__offset(slot)
+        _seq = self.__begin(_offset)
+        _TYPE.pack_into(self.__buf, _offset + _OFFSET_TYPE + index * 4, va & 0xff, vb & 0xff, vc & 0xff, vd & 0xff)
+        self.__end(_offset, _seq)
+        pass
+
+    def set_current(self, slot: int, index: int, value: int):
+        if index < 0 or index > 9:
+            raise ValueError('out of index')
+        _offset = self.__offset(slot)
+        _seq = self.__begin(_offset)
+        _CURRENT.pack_into(self.__buf, _offset + _OFFSET_CURRENT + index * 2, value & 0xffff)
+        self.__end(_offset, _seq)
+        pass
+
+    def set_fuse(self, slot: int, index: int, value: bool):
+        if index < 0 or index > 1:
+            raise ValueError('out of index')
+        self.__set_flag(slot, 0x01 << index, value)
+        pass
+
+    def set_breaker(self, slot: int, value: bool):
+        self.__set_flag(slot, 0x04, value)
+        pass
+
+    def __set_flag(self, slot: int, mask: int, value: bool):
+        _offset = self.__offset(slot)
+        _seq = self.__begin(_offset)
+        _flags = _BYTE.unpack_from(self.__buf, _offset + _OFFSET_FLAGS)[0]
+        _flags = (_flags | mask) if value else (_flags & ~mask)
+        _BYTE.pack_into(self.__buf, _offset + _OFFSET_FLAGS, _flags)
+        self.__end(_offset, _seq)
+        pass
+
+    def get_string_led_status(self, slot: int) -> list:
+        return list(self.load(slot, None).string_led)
+
+    pass
@@ -0,0 +1,330 @@
+import os
+import socket
+import select
+import threading
+import time
+
+from BmcNode import SIM_BATCH_MAGIC, pack_sim_frame, pack_sim_batches, unpack_sim_datagram
+from BmcStream import StreamParser, pack_stream_record
+
+
+class SlcStandIn:
+    """
+    A local stand-in of the SLC simulator for SimCanDevice: it sends the requests to the BMCs and counts
+    the received frames. It understands both wire formats of SimCanDevice, a SimCanDevice in the auto
+    wire format switches to batches after the first batch of requests.
+    """
+
+    E_WIRE_FRAME = 'frame'
+    E_WIRE_BATCH = 'batch'
+
+    def __init__(self, port: int = 8001, remote=('127.0.0.1', 8002), wire_format: str = 'frame',
+                 mtu: int = 1500, handler=None):
+        """
+        :param port: the local port, SimCanDevice sends to it
+        :param remote: the address of SimCanDevice
+        :param wire_format: E_WIRE_FRAME or E_WIRE_BATCH, the format of the requests
+        :param mtu: the MTU of the network, the size limit of a batch
+        :param handler: handler(arbitration_id, data), called for every received frame
+        """
+        if wire_format not in (SlcStandIn.E_WIRE_FRAME, SlcStandIn.E_WIRE_BATCH):
+            raise ValueError('{} is invalid wire format'.format(wire_format))
+        self.__local = ('0.0.0.0', port)
+        self.__remote = tuple(remote)
+        self.__wire_format = wire_format
+        self.__mtu = mtu
+        self.__handler = handler
+        self.__socket = None
+        self.__thread = None
+        self.__terminal = False
+        self.__cond = threading.Condition()
+        self.__counts = {}  # arbitration id: count
+        self.__last = {}  # arbitration id: data
+        self.__frames = 0
+        self.__datagrams = 0
+        self.__batches = 0
+        pass
+
+    @property
+    def frames(self) -> int:
+        """
+        :return: the number of received frames
+        """
+        return self.__frames
+
+    @property
+    def datagrams(self) -> int:
+        """
+        :return: the number of received datagrams
+        """
+        return self.__datagrams
+
+    @property
+    def batches(self) -> int:
+        """
+        :return: the number of received datagrams in the batch format
+        """
+        return self.__batches
+
+    def counts(self) -> dict:
+        """
+        :return: {arbitration id: the number of received frames}
+        """
+        with self.__cond:
+            return dict(self.__counts)
+
+    def last(self, arbitration_id: int):
+        """
+        :return: the data of the last received frame of the id, None if there is none
+        """
+        with self.__cond:
+            return self.__last.get(arbitration_id)
+
+    def start(self):
+        if self.__thread is None:
+            self.__terminal = False
+            self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.__socket.bind(self.__local)
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+            pass
+        pass
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__terminal = True
+            self.__thread.join()
+            self.__socket.close()
+            self.__socket = None
+            self.__thread = None
+            pass
+        pass
+
+    def request(self, index: int, msg_id: int, data=b''):
+        """
+        Send a request to one BMC
+        :param index: the BMC index, 0 ~ 9
+        :param msg_id: 16bit message id
+        :param data: the request data
+        :return:
+        """
+        self.poll((index,), msg_id, data)
+        pass
+
+    def poll(self, indexes, msg_id: int = 0x0330, data=b''):
+        """
+        Send the same request to many BMCs, in one datagram if the wire format is batch
+        :param indexes: the BMC indexes
+        :param msg_id: 16bit message id
+        :param data: the request data
+        :return:
+        """
+        _frames = [((0x1a000000 if _index == 0 else (_index << 24) | 0x10000000) | msg_id, data)
+                   for _index in indexes]
+        if self.__wire_format == SlcStandIn.E_WIRE_BATCH:
+            _datagrams = pack_sim_batches(_frames, self.__mtu)
+            pass
+        else:
+            _datagrams = [pack_sim_frame(_id, _data) for _id, _data in _frames]
+            pass
+        for _datagram in _datagrams:
+            self.__socket.sendto(_datagram, self.__remote)
+            pass
+        pass
+
+    def wait(self, frames: int, timeout: float = None) -> bool:
+        """
+        Wait until the number of received frames reaches frames
+        :return: False if timeout
+        """
+        with self.__cond:
+            return self.__cond.wait_for(lambda: self.__frames >= frames, timeout)
+
+    def __run(self):
+        _sock = self.__socket
+        while not self.__terminal:
+            if not select.select([_sock], [], [], 0.1)[0]:
+                continue
+            _datagram = _sock.recv(65536)
+            self._count(unpack_sim_datagram(_datagram), _datagram[:4] == SIM_BATCH_MAGIC)
+            pass
+        pass
+
+    def _count(self, frames: list, batch: bool):
+        # Count the frames of one received datagram (or record) and pass them to the handler
+        with self.__cond:
+            self.__datagrams += 1
+            if batch:
+                self.__batches += 1
+                pass
+            for _id, _data in frames:
+                self.__counts[_id] = self.__counts.get(_id, 0) + 1
+                self.__last[_id] = _data
+                pass
+            self.__frames += len(frames)
+            self.__cond.notify_all()
+        if self.__handler is not None:
+            for _id, _data in frames:
+                self.__handler(_id, _data)
+                pass
+            pass
+        pass
+
+    pass
+
+
+class StreamSlcStandIn(SlcStandIn):
+    """
+    The stand-in of the SLC simulator for BmcStream.StreamCanDevice: it listens on a TCP port or an
+    AF_UNIX path and takes one connection at a time, a new connection replaces the old one.
+    The records received by one recv are counted as a datagram.
+    """
+
+    def __init__(self, address, family: str = 'tcp', handler=None):
+        """
+        :param address: (ip, port) for TCP, the socket path for AF_UNIX
+        :param family: 'tcp' or 'unix'
+        :param handler: handler(arbitration_id, data), called for every received frame
+        """
+        super(StreamSlcStandIn, self).__init__(handler=handler)
+        if family not in ('tcp', 'unix'):
+            raise ValueError('{} is invalid family'.format(family))
+        self.__address = tuple(address) if family == 'tcp' else address
+        self.__family = family
+        self.__listener = None
+        self.__connection = None
+        self.__send_lock = threading.Lock()
+        self.__thread = None
+        self.__terminal = False
+        pass
+
+    @property
+    def connected(self) -> bool:
+        """
+        :return: True if a device is connected, the requests are dropped before
+        """
+        return self.__connection is not None
+
+    def start(self):
+        if self.__thread is None:
+            self.__terminal = False
+            if self.__family == 'tcp':
+                self.__listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.__listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                pass
+            else:
+                if os.path.exists(self.__address):
+                    os.unlink(self.__address)
+                    pass
+                self.__listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                pass
+            self.__listener.bind(self.__address)
+            self.__listener.listen(1)
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+            pass
+        pass
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__terminal = True
+            self.__thread.join()
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+                pass
+            self.__listener.close()
+            self.__listener = None
+            if self.__family == 'unix' and os.path.exists(self.__address):
+                os.unlink(self.__address)
+                pass
+            self.__thread = None
+            pass
+        pass
+
+    def poll(self, indexes, msg_id: int = 0x0330, data=b''):
+        _record = pack_stream_record([((0x1a000000 if _index == 0 else (_index << 24) | 0x10000000) | msg_id, data)
+                                      for _index in indexes])
+        with self.__send_lock:
+            if self.__connection is not None:
+                self.__connection.sendall(_record)
+                pass
+        pass
+
+    def __run(self):
+        _parser = StreamParser()
+        while not self.__terminal:
+            _sockets = [self.__listener] + ([self.__connection] if self.__connection is not None else [])
+            for _sock in select.select(_sockets, [], [], 0.1)[0]:
+                if _sock is self.__listener:
+                    _connection = self.__listener.accept()[0]
+                    with self.__send_lock:
+                        if self.__connection is not None:
+                            self.__connection.close()
+                            pass
+                        self.__connection = _connection
+                    _parser.reset()
+                    continue
+                try:
+                    _data = _sock.recv(65536)
+                    _frames = _parser.feed(_data) if _data else None
+                    pass
+                except (OSError, ValueError):
+                    _frames = None
+                    pass
+                if _frames is None:
+                    # Closed by the device or a broken stream
+                    with self.__send_lock:
+                        self.__connection.close()
+                        self.__connection = None
+                    continue
+                if _frames:
+                    self._count(_frames, True)
+                    pass
+                pass
+            pass
+        pass
+
+    pass
+
+
+def main():
+    # 0x0330 replies of 10 BMCs to the stand-in, in both wire formats
+    from BmcNode import BmcNode, SimCanDevice
+
+    for _wire_format in (SimCanDevice.E_WIRE_FRAME, SimCanDevice.E_WIRE_AUTO):
+        _device = SimCanDevice('127.0.0.1', 8001, wire_format=_wire_format)
+        _device.enable()
+        _nodes = []
+        for _i in range(10):
+            _node = BmcNode(_i, _device)
+            _node.config(sku='GVSMODBC9')
+            _node.start()
+            _nodes.append(_node)
+            pass
+        _slc = SlcStandIn(wire_format=SlcStandIn.E_WIRE_FRAME if _wire_format == SimCanDevice.E_WIRE_FRAME
+                          else SlcStandIn.E_WIRE_BATCH)
+        _slc.start()
+        _polls = 200
+        _begin = time.perf_counter()
+        for _r in range(_polls):
+            _slc.poll(range(10))
+            # The frames per datagram is what counts here, UDP must not drop
+            _slc.wait((_r + 1) * 10 * 24, 2)
+            pass
+        _elapsed = time.perf_counter() - _begin
+        print('{}: frames: {}, datagrams: {}, {:.0f} frames/s'.format(
+            _device.wire_format, _slc.frames, _slc.datagrams, _slc.frames / _elapsed))
+        for _node in _nodes:
+            _node.stop()
+            pass
+        _slc.stop()
+        _device.disable()
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    main()
+    pass
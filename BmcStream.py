@@ -0,0 +1,372 @@
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from BmcNode import Device, SIM_FRAME
+
+# A stream is a sequence of records: the payload length, then the payload of socketcan frames
+STREAM_HEADER = struct.Struct('<I')
+_CAN_EFF_FLAG = 0x80000000
+_MAX_RECORD = 0x10000  # the max payload of a record, a larger one is a broken stream
+
+
+def pack_stream_record(frames) -> bytearray:
+    """
+    :param frames: list of (arbitration_id, data) of extended frames
+    :return: one record of the frames
+    """
+    _buf = bytearray(STREAM_HEADER.size + SIM_FRAME.size * len(frames))
+    STREAM_HEADER.pack_into(_buf, 0, SIM_FRAME.size * len(frames))
+    for _i, (_id, _data) in enumerate(frames):
+        SIM_FRAME.pack_into(_buf, STREAM_HEADER.size + SIM_FRAME.size * _i, (_id & 0x1fffffff) | _CAN_EFF_FLAG,
+                            len(_data), bytes(_data))
+        pass
+    return _buf
+
+
+class StreamParser:
+    """
+    Split the received bytes of a stream into frames
+    """
+
+    def __init__(self):
+        self.__buf = bytearray()
+        pass
+
+    def reset(self):
+        self.__buf = bytearray()
+        pass
+
+    def feed(self, data) -> list:
+        """
+        :param data: the received bytes
+        :return: list of (arbitration_id, data) of the complete records
+        """
+        _buf = self.__buf
+        _buf += data
+        _frames = []
+        _offset = 0
+        while len(_buf) - _offset >= STREAM_HEADER.size:
+            _size = STREAM_HEADER.unpack_from(_buf, _offset)[0]
+            if _size % SIM_FRAME.size or _size > _MAX_RECORD:
+                raise ValueError('invalid stream record')
+            if len(_buf) - _offset - STREAM_HEADER.size < _size:
+                break
+            _begin = _offset + STREAM_HEADER.size
+            for _pos in range(_begin, _begin + _size, SIM_FRAME.size):
+                _can_id, _dlc, _data = SIM_FRAME.unpack_from(_buf, _pos)
+                _can_id = (_can_id & 0x1fffffff) if _can_id & _CAN_EFF_FLAG else (_can_id & 0x7ff)
+                _frames.append((_can_id, bytearray(_data[:min(_dlc, 8)])))
+                pass
+            _offset = _begin + _size
+            pass
+        if _offset:
+            del _buf[:_offset]
+            pass
+        return _frames
+
+    pass
+
+
+class StreamCanDevice(Device):
+    """
+    The SimCanDevice over a stream socket (TCP, or AF_UNIX for local runs) to the SLC simulator.
+
+    The frames are coalesced into length prefixed records of at most max_bytes of frames: a record is sent
+    when it is full, or max_delay after its first frame. Unlike UDP the stream gives back-pressure: when the socket can't
+    send, the senders wait once max_pending bytes are waiting, the frames and the records not sent yet together. The connection is kept and reconnected
+    after an error; the frames sent while there is no connection are dropped and counted.
+    """
+
+    E_FAMILY_TCP = 'tcp'
+    E_FAMILY_UNIX = 'unix'
+
+    def __init__(self, address, family: str = 'tcp', max_delay: float = 0.001, max_bytes: int = 1400,
+                 max_pending: int = 65536, reconnect_interval: float = 0.5):
+        """
+        :param address: (ip, port) for TCP, the socket path for AF_UNIX
+        :param family: E_FAMILY_TCP or E_FAMILY_UNIX
+        :param max_delay: seconds, the max time a frame waits for coalescing
+        :param max_bytes: the payload size which sends a record at once
+        :param max_pending: the bytes waiting to be sent (pending frames and unsent records) before the senders
+                            are blocked
+        :param reconnect_interval: seconds between two connection attempts
+        """
+        super(StreamCanDevice, self).__init__()
+        if family not in (StreamCanDevice.E_FAMILY_TCP, StreamCanDevice.E_FAMILY_UNIX):
+            raise ValueError('{} is invalid family'.format(family))
+        self.__address = tuple(address) if family == StreamCanDevice.E_FAMILY_TCP else address
+        self.__family = family
+        self.__max_delay = max_delay
+        self.__max_bytes = max_bytes
+        self.__max_pending = max(max_pending, max_bytes)
+        self.__reconnect_interval = reconnect_interval
+        self.__cond = threading.Condition()
+        self.__pending = []  # (arbitration_id, data) waiting for a record
+        self.__pending_bytes = 0
+        self.__out = bytearray()  # the records not sent yet, counted in max_pending too
+        self.__first_time = None  # the time of the first pending frame
+        self.__socket = None
+        self.__wake = None  # socket pair waking up the IO thread
+        self.__thread = None
+        self.__terminal = False
+        self.__dropped = 0
+        self.__records = 0
+        self.__connects = 0
+        pass
+
+    @property
+    def connected(self) -> bool:
+        return self.__socket is not None
+
+    @property
+    def dropped(self) -> int:
+        """
+        :return: the number of the frames dropped while there is no connection
+        """
+        return self.__dropped
+
+    @property
+    def records(self) -> int:
+        """
+        :return: the number of sent records
+        """
+        return self.__records
+
+    @property
+    def connects(self) -> int:
+        """
+        :return: the number of the connections made, more than 1 means reconnected
+        """
+        return self.__connects
+
+    def enable(self):
+        if self.__thread is None:
+            self.__terminal = False
+            self.__wake = socket.socketpair()
+            self.__wake[0].setblocking(False)
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+            pass
+        pass
+
+    def disable(self):
+        if self.__thread is not None:
+            with self.__cond:
+                self.__terminal = True
+                self.__cond.notify_all()
+            self.__wake[1].send(b'\0')
+            self.__thread.join()
+            for _s in self.__wake:
+                _s.close()
+                pass
+            self.__wake = None
+            self.__thread = None
+            pass
+        pass
+
+    def send_message(self, msg):
+        self.send_burst((msg,))
+        pass
+
+    def send_burst(self, msgs: list):
+        _bytes = SIM_FRAME.size * len(msgs)
+        with self.__cond:
+            while self.__socket is not None and not self.__terminal and \
+                    self.__pending_bytes + len(self.__out) + _bytes > self.__max_pending and \
+                    (self.__pending or self.__out):
+                self.__cond.wait()
+                pass
+            if self.__socket is None or self.__terminal:
+                self.__dropped += len(msgs)
+                return
+            _wake = not self.__pending
+            self.__pending.extend((_msg.arbitration_id, _msg.data) for _msg in msgs)
+            self.__pending_bytes += _bytes
+            if self.__first_time is None:
+                self.__first_time = time.monotonic()
+                pass
+            _wake = _wake or self.__pending_bytes >= self.__max_bytes
+        if _wake:
+            try:
+                self.__wake[1].send(b'\0')
+                pass
+            except (OSError, AttributeError):
+                pass
+            pass
+        pass
+
+    def __connect(self):
+        if self.__family == StreamCanDevice.E_FAMILY_TCP:
+            _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            _sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # coalesced by this device
+            pass
+        else:
+            _sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            pass
+        try:
+            _sock.settimeout(self.__reconnect_interval)
+            _sock.connect(self.__address)
+            _sock.setblocking(False)
+            pass
+        except OSError:
+            _sock.close()
+            return None
+        return _sock
+
+    def __close(self):
+        with self.__cond:
+            self.__socket.close()
+            self.__socket = None
+            # The frames not sent yet are lost with the connection, a partly sent record is counted too
+            self.__dropped += len(self.__out) // SIM_FRAME.size
+            self.__out = bytearray()
+            self.__dropped += len(self.__pending)
+            self.__pending = []
+            self.__pending_bytes = 0
+            self.__first_time = None
+            self.__cond.notify_all()
+        pass
+
+    def __run(self):
+        _parser = StreamParser()
+        _wake = self.__wake[0]
+        while not self.__terminal:
+            if self.__socket is None:
+                _sock = self.__connect()
+                if _sock is None:
+                    with self.__cond:
+                        self.__cond.wait(self.__reconnect_interval)
+                    continue
+                _parser.reset()
+                with self.__cond:
+                    self.__out = bytearray()
+                    self.__socket = _sock
+                    self.__connects += 1
+                pass
+            _sock = self.__socket
+
+            # Move the pending frames into records of max_bytes if the last ones are sent and it is time
+            _timeout = 0.5
+            with self.__cond:
+                _out = self.__out
+                if self.__pending and not _out:
+                    _due = self.__first_time + self.__max_delay
+                    _now = time.monotonic()
+                    if self.__pending_bytes >= self.__max_bytes or _now >= _due:
+                        _count = max(1, min(self.__max_bytes, _MAX_RECORD) // SIM_FRAME.size)
+                        _pending = self.__pending
+                        for _begin in range(0, len(_pending), _count):
+                            _out += pack_stream_record(_pending[_begin:_begin + _count])
+                            self.__records += 1
+                            pass
+                        self.__pending = []
+                        self.__pending_bytes = 0
+                        self.__first_time = None
+                        self.__cond.notify_all()
+                        pass
+                    else:
+                        _timeout = _due - _now
+                        pass
+                    pass
+
+            try:
+                _readable, _writable, _ = select.select([_sock, _wake], [_sock] if _out else [], [], _timeout)
+                if _wake in _readable:
+                    try:
+                        _wake.recv(4096)
+                        pass
+                    except BlockingIOError:
+                        pass
+                    pass
+                if _sock in _readable:
+                    _data = _sock.recv(65536)
+                    if not _data:
+                        raise ConnectionError('closed by the remote')
+                    for _arbitration_id, _frame_data in _parser.feed(_data):
+                        self.on_frame(_arbitration_id, _frame_data)
+                        pass
+                    pass
+                if _sock in _writable:
+                    _n = _sock.send(_out)
+                    with self.__cond:
+                        del _out[:_n]
+                        self.__cond.notify_all()
+                    pass
+                pass
+            except (OSError, ValueError) as _e:
+                print('WARNING:', 'stream to {} is broken: {}'.format(self.__address, _e))
+                self.__close()
+                pass
+            pass
+        if self.__socket is not None:
+            self.__close()
+            pass
+        pass
+
+    pass
+
+
+def main():
+    # 0x0330 replies of 10 BMCs to the stream stand-in over AF_UNIX and TCP
+    from BmcNode import BmcNode
+    from BmcSlc import StreamSlcStandIn
+
+    _path = '/tmp/bmc-stream-{}.sock'.format(os.getpid())
+    for _family, _address in ((StreamCanDevice.E_FAMILY_UNIX, _path),
+                              (StreamCanDevice.E_FAMILY_TCP, ('127.0.0.1', 8003))):
+        _slc = StreamSlcStandIn(_address, _family)
+        _slc.start()
+        _device = StreamCanDevice(_address, _family)
+        _device.enable()
+        _nodes = []
+        for _i in range(10):
+            _node = BmcNode(_i, _device)
+            _node.config(sku='GVSMODBC9')
+            _node.start()
+            _nodes.append(_node)
+            pass
+        while not (_device.connected and _slc.connected):
+            time.sleep(0.01)
+            pass
+        _polls = 500
+        _begin = time.perf_counter()
+        for _r in range(_polls):
+            _slc.poll(range(10))
+            pass
+        _slc.wait(_polls * 10 * 24, 10)
+        _elapsed = time.perf_counter() - _begin
+        print('{}: frames: {}, records: {}, dropped: {}, {:.0f} frames/s'.format(
+            _family, _slc.frames, _device.records, _device.dropped, _slc.frames / _elapsed))
+
+        # The device reconnects when the stand-in comes back: from the restart of the stand-in to the first
+        # frame received on the new connection, a poll is sent as soon as the device is connected
+        _slc.stop()
+        _slc = StreamSlcStandIn(_address, _family)
+        _begin = time.perf_counter()
+        _slc.start()
+        _polled = False
+        while _slc.frames == 0 and time.perf_counter() - _begin < 5:
+            if not _polled and _slc.connected:
+                _slc.poll(range(10))
+                _polled = True
+                pass
+            time.sleep(0.001)
+            pass
+        print('{}: reconnected, the first frame in {:.3f}s, connects: {}'.format(
+            _family, time.perf_counter() - _begin, _device.connects))
+        for _node in _nodes:
+            _node.stop()
+            pass
+        _device.disable()
+        _slc.stop()
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    main()
+    pass
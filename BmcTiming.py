@@ -0,0 +1,211 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class Scheduler:
+    """
+    One thread calling the callbacks at their due time (time.monotonic), shared by many nodes instead of
+    one time.sleep per node. The callbacks must be short, e.g. putting a frame into a queue.
+    """
+
+    def __init__(self):
+        self.__heap = []
+        self.__seq = itertools.count()  # keeps the order of the callbacks with the same due time
+        self.__cond = threading.Condition()
+        self.__thread = None
+        self.__terminal = False
+        pass
+
+    def call_at(self, due: float, callback, *args):
+        """
+        :param due: time.monotonic() based time
+        :param callback: callback(*args)
+        :return:
+        """
+        with self.__cond:
+            if self.__thread is None:
+                self.__terminal = False
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+                pass
+            heapq.heappush(self.__heap, (due, next(self.__seq), callback, args))
+            if self.__heap[0][0] == due:
+                self.__cond.notify()
+                pass
+        pass
+
+    def call_later(self, delay: float, callback, *args):
+        self.call_at(time.monotonic() + delay, callback, *args)
+        pass
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def stop(self):
+        """
+        Stop the thread, the pending callbacks are dropped
+        """
+        with self.__cond:
+            _thread = self.__thread
+            self.__thread = None
+            self.__terminal = True
+            self.__heap = []
+            self.__cond.notify()
+        if _thread is not None and _thread is not threading.current_thread():
+            _thread.join()
+            pass
+        pass
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while not self.__terminal:
+                    if not self.__heap:
+                        self.__cond.wait()
+                        continue
+                    _delay = self.__heap[0][0] - time.monotonic()
+                    if _delay <= 0:
+                        break
+                    self.__cond.wait(_delay)
+                    pass
+                if self.__terminal:
+                    break
+                _now = time.monotonic()
+                _due = []
+                while self.__heap and self.__heap[0][0] <= _now:
+                    _due.append(heapq.heappop(self.__heap))
+                    pass
+            for _item in _due:
+                try:
+                    _item[2](*_item[3])
+                    pass
+                except Exception as _e:
+                    print('WARNING:', 'scheduled callback failed: {}'.format(_e))
+                    pass
+                pass
+            pass
+        pass
+
+    pass
+
+
+_shared_scheduler = None
+_shared_scheduler_lock = threading.Lock()
+
+
+def shared_scheduler() -> Scheduler:
+    """
+    :return: the scheduler shared by all the timing models of this process
+    """
+    global _shared_scheduler
+    with _shared_scheduler_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = Scheduler()
+            pass
+        return _shared_scheduler
+
+
+class TimingModel:
+    """
+    The response timing of one node: the delay from a request to the first frame of its reply, the min
+    spacing between two frames, and a token bucket limiting the frames per second. The frames are released
+    by a Scheduler, nothing sleeps. One instance can only be used by one node.
+    """
+
+    def __init__(self, delay: float = 0.0, jitter: float = 0.0, distribution=None, spacing: float = 0.0,
+                 rate: float = None, burst: int = 1, seed: int = None, scheduler: Scheduler = None):
+        """
+        :param delay: seconds, the fixed delay from the request to the first frame
+        :param jitter: seconds, a uniform random delay 0 ~ jitter is added to the fixed delay
+        :param distribution: distribution(rnd) -> seconds, it replaces delay and jitter, e.g.
+                             lambda rnd: rnd.gauss(0.002, 0.0005). rnd is a random.Random instance.
+        :param spacing: seconds, the min gap between two frames
+        :param rate: the max frames per second, None is unlimited
+        :param burst: the number of frames which can be sent at once within the rate
+        :param seed: the seed of the random delays, for repeatable runs
+        :param scheduler: default is the shared scheduler
+        """
+        if delay < 0 or jitter < 0 or spacing < 0:
+            raise ValueError('delay, jitter and spacing must not be negative')
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive')
+        if burst < 1:
+            raise ValueError('burst must be at least 1')
+        self.__delay = delay
+        self.__jitter = jitter
+        self.__distribution = distribution
+        self.__spacing = spacing
+        self.__rate = rate
+        self.__burst = burst
+        self.__random = random.Random(seed)
+        self.__scheduler = scheduler if scheduler is not None else shared_scheduler()
+        self.__lock = threading.Lock()
+        self.__last = float('-inf')  # the release time of the last frame
+        self.__tokens = float(burst)
+        self.__tokens_time = None  # the time of the tokens, the bucket is full at the first frame
+        pass
+
+    def __reply_delay(self) -> float:
+        if self.__distribution is not None:
+            return max(0.0, self.__distribution(self.__random))
+        if self.__jitter:
+            return self.__delay + self.__random.uniform(0.0, self.__jitter)
+        return self.__delay
+
+    def __take_token(self, t: float) -> float:
+        # The release time of a frame at t or later, which is allowed by the token bucket
+        if self.__rate is None:
+            return t
+        if self.__tokens_time is None:
+            # On the clock of the caller, release_times may be given a simulated now
+            self.__tokens_time = t
+            pass
+        if t > self.__tokens_time:
+            self.__tokens = min(float(self.__burst), self.__tokens + (t - self.__tokens_time) * self.__rate)
+            self.__tokens_time = t
+            pass
+        else:
+            t = self.__tokens_time
+            pass
+        if self.__tokens < 1.0:
+            _wait = (1.0 - self.__tokens) / self.__rate
+            self.__tokens_time += _wait
+            self.__tokens = 1.0
+            t = self.__tokens_time
+            pass
+        self.__tokens -= 1.0
+        return t
+
+    def release_times(self, count: int, now: float = None) -> list:
+        """
+        :param count: the number of frames of one reply
+        :param now: the time of the request, default is time.monotonic()
+        :return: the release times of the frames, it also takes the frames from the token bucket
+        """
+        _now = time.monotonic() if now is None else now
+        _times = []
+        with self.__lock:
+            _t = _now + self.__reply_delay()
+            for _i in range(count):
+                _t = self.__take_token(max(_t, self.__last + self.__spacing))
+                self.__last = _t
+                _times.append(_t)
+                pass
+        return _times
+
+    def submit(self, frames: list, sink):
+        """
+        Release the frames of one reply in order by the scheduler
+        :param frames: the frames
+        :param sink: sink(frame), called at the release time of each frame
+        :return:
+        """
+        for _t, _frame in zip(self.release_times(len(frames)), frames):
+            self.__scheduler.call_at(_t, sink, _frame)
+            pass
+        pass
+
+    pass
@@ -24,7 +24,7 @@ from PyQt5 import QtCore
 from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication, QMainWindow, QHBoxLayout, \
     QWidget, QVBoxLayout, QPushButton, QLineEdit, QGridLayout, QCheckBox, QComboBox, QLabel, QSizePolicy, QTabWidget, \
-    QDialog, QMessageBox, QDialogButtonBox
+    QDialog, QMessageBox, QDialogButtonBox, QFileDialog
 
 
 def import_bmc_node():
@@ -81,6 +81,8 @@ class BMCPanel(QWidget):
         else:
             self.__bmc_node = None
 
+        self.__state_version = None
+
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.on_timer)
         self.timer.start(500)
@@ -242,9 +244,40 @@ class BMCPanel(QWidget):
 
         self.setLayout(self.__main_layout)
 
+    @property
+    def bmc_node(self):
+        return self.__bmc_node
+
+    def refresh_from_node(self):
+        # Update the widgets from the node, e.g. after a fleet file is loaded
+        if self.__bmc_node is None:
+            return
+        self.__edit_hw.setText(self.__bmc_node.hw)
+        self.__edit_fw.setText(self.__bmc_node.fw)
+        self.__edit_sn.setText(self.__bmc_node.sn)
+        self.__edit_mbc_sn.setText(self.__bmc_node.mbc_sn)
+        self.__combox_sku.setCurrentText(self.__bmc_node.sku)
+
+        state = self.__bmc_node.snapshot()
+        self.__check_fuse1_status.setChecked(state.fuse[0])
+        self.__check_fuse2_status.setChecked(state.fuse[1])
+        self.__check_breaker_status.setChecked(state.breaker)
+        for string_index in range(0, 10):
+            for cartridge_index in range(0, 4):
+                type_combox = self.__combox_device_type[string_index][cartridge_index]
+                type_combox.blockSignals(True)
+                type_combox.setCurrentIndex(state.bat_type[string_index][cartridge_index])
+                type_combox.blockSignals(False)
+                self.__editor_device_temp[string_index][cartridge_index].setText(
+                    str(state.bat_temp[string_index][cartridge_index]))
+
     def on_timer(self):
         if self.__bmc_node is not None:
-            led_status = self.__bmc_node.get_string_led_status()
+            state = self.__bmc_node.snapshot()
+            if state.version == self.__state_version:
+                return
+            self.__state_version = state.version
+            led_status = state.string_led
             led_text = ' '.join([BMCPanel.LED_STATUS_STRING[status] for status in led_status])
             self.__label_led.setText(led_text)
 
@@ -383,6 +416,16 @@ class BMCBoard(QTabWidget):
         self.__layout_main.addWidget(self.__tab_widget)
         self.setLayout(self.__layout_main)
 
+    def save_fleet(self, path: str):
+        nodes = [panel.bmc_node for panel in self.__bmc_panels if panel.bmc_node is not None]
+        self.__can_node.save_fleet(path, nodes)
+
+    def load_fleet(self, path: str):
+        panels = [panel for panel in self.__bmc_panels if panel.bmc_node is not None]
+        self.__can_node.load_fleet(path, [panel.bmc_node for panel in panels])
+        for panel in panels:
+            panel.refresh_from_node()
+
 
 class BmcCommunicationSelectDlg(QDialog):
     def __init__(self,parent=None):
@@ -485,6 +528,29 @@ class BmcMainWindow(QMainWindow):
         self.move(QApplication.desktop().screen().rect().center() - self.rect().center())
         self.setWindowTitle('BMC UI - Sleepy')
 
+        file_menu = self.menuBar().addMenu('File')
+        file_menu.addAction('Save Fleet...', self.on_save_fleet)
+        file_menu.addAction('Load Fleet...', self.on_load_fleet)
+        file_menu.setEnabled(self.can_device is not None)
+
+    def on_save_fleet(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Save Fleet', '', 'BMC fleet (*.bmcf)')
+        if not path:
+            return
+        try:
+            self.__bmc_board.save_fleet(path)
+        except Exception as e:
+            QMessageBox().warning(self, 'Save Fleet', 'Save failed: ' + str(e))
+
+    def on_load_fleet(self):
+        path, _ = QFileDialog.getOpenFileName(self, 'Load Fleet', '', 'BMC fleet (*.bmcf)')
+        if not path:
+            return
+        try:
+            self.__bmc_board.load_fleet(path)
+        except Exception as e:
+            QMessageBox().warning(self, 'Load Fleet', 'Load failed: ' + str(e))
+
     def closeEvent(self, event):
         result = QMessageBox().question(self, "Confirm Exit...", "Are you sure you want to exit ?",
                                         QMessageBox.Yes | QMessageBox.No)
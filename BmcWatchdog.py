@@ -0,0 +1,309 @@
+import threading
+import time
+
+from BmcNode import BmcNode
+
+
+class Watchdog:
+    """
+    Watch the TX path of the nodes against the limits of the SLC:
+        dead           a running node whose TX thread is gone, e.g. killed by a send error
+        tx_stall       a transmit which does not return, e.g. the retries of a full buffer of CanDevice
+        queue_age      frames waiting in the TX queue while nothing is sent
+        heartbeat      no frame is sent, the SLC sees the heartbeat loss
+        reply_latency  the time from a request to the transmit of its replies, or the age of a request not
+                       replied yet. The watchdog takes the worst latency of a node by reset_reply_latency
+
+    One thread scans the nodes every interval, the nodes keep a few times of their own TX thread, so the
+    cost of a frame does not depend on the watchdog or on the size of the fleet. A violation is reported
+    once when it begins, and it is cleared when a later scan finds the node within the limit again.
+    """
+
+    E_DEAD = 'dead'
+    E_TX_STALL = 'tx_stall'
+    E_QUEUE_AGE = 'queue_age'
+    E_HEARTBEAT = 'heartbeat'
+    E_REPLY_LATENCY = 'reply_latency'
+    E_KINDS = (E_DEAD, E_TX_STALL, E_QUEUE_AGE, E_HEARTBEAT, E_REPLY_LATENCY)
+
+    def __init__(self, nodes=(), interval: float = 0.1, max_tx_stall: float = 0.5, max_queue_age: float = 0.5,
+                 max_tx_gap: float = 1.5, max_reply_latency: float = 0.1, on_violation=None, restart: bool = False):
+        """
+        :param nodes: the BmcNode instances
+        :param interval: seconds between two scans
+        :param max_tx_stall: seconds, the max time of one transmit
+        :param max_queue_age: seconds, the max time frames are waiting without a transmit
+        :param max_tx_gap: seconds, the max time between two transmits, a node sends a heartbeat every second
+        :param max_reply_latency: seconds, the max time from a request to its replies, None does not check it
+        :param on_violation: on_violation(kind, node, seconds), called by the thread of the watchdog when
+                             a violation begins
+        :param restart: True restarts the TX thread of a dead or stalled node, see BmcNode.restart_tx
+        """
+        if interval <= 0:
+            raise ValueError('interval must be greater than 0')
+        self.__nodes = []
+        self.__interval = interval
+        self.__limits = {Watchdog.E_TX_STALL: max_tx_stall, Watchdog.E_QUEUE_AGE: max_queue_age,
+                         Watchdog.E_HEARTBEAT: max_tx_gap, Watchdog.E_REPLY_LATENCY: max_reply_latency}
+        self.__on_violation = on_violation
+        self.__restart = restart
+        self.__lock = threading.Lock()
+        self.__active = {}  # (node, kind): seconds
+        self.__counts = dict.fromkeys(Watchdog.E_KINDS, 0)
+        self.__worst = dict.fromkeys(Watchdog.E_KINDS, 0.0)
+        self.__restarts = 0
+        self.__scans = 0
+        self.__scan_time = 0.0
+        self.__thread = None
+        self.__terminal = threading.Event()
+        self.watch(nodes)
+        pass
+
+    def watch(self, nodes):
+        """
+        Add the nodes to watch, a node which is not running is skipped by the scans
+        :param nodes: the BmcNode instances
+        :return:
+        """
+        with self.__lock:
+            _known = set(self.__nodes)
+            self.__nodes.extend(_node for _node in nodes if _node not in _known)
+        pass
+
+    def start(self):
+        if self.__thread is None:
+            self.__terminal.clear()
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+            pass
+        pass
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__terminal.set()
+            self.__thread.join()
+            self.__thread = None
+            pass
+        pass
+
+    def active(self) -> list:
+        """
+        :return: list of (kind, node, seconds) of the violations which are not cleared
+        """
+        with self.__lock:
+            return [(_kind, _node, _value) for (_node, _kind), _value in self.__active.items()]
+
+    def metrics(self) -> dict:
+        """
+        :return: dict of 'scans', 'scan_time' (seconds of the last scan), 'nodes', 'restarts',
+                 'violations' ({kind: the number of the violations begun}), 'active' ({kind: the number of
+                 the violations not cleared}) and 'worst' ({kind: the max seconds seen})
+        """
+        with self.__lock:
+            _active = dict.fromkeys(Watchdog.E_KINDS, 0)
+            for _node, _kind in self.__active:
+                _active[_kind] += 1
+                pass
+            return {'scans': self.__scans, 'scan_time': self.__scan_time, 'nodes': len(self.__nodes),
+                    'restarts': self.__restarts, 'violations': dict(self.__counts), 'active': _active,
+                    'worst': dict(self.__worst)}
+
+    def check(self) -> list:
+        """
+        Scan the nodes once, it is called by the thread of the watchdog, or by the caller without start
+        :return: list of (kind, node, seconds) of the violations begun by this scan
+        """
+        _begin = time.monotonic()
+        with self.__lock:
+            _nodes = list(self.__nodes)
+        _max_tx_stall = self.__limits[Watchdog.E_TX_STALL]
+        _max_queue_age = self.__limits[Watchdog.E_QUEUE_AGE]
+        _max_tx_gap = self.__limits[Watchdog.E_HEARTBEAT]
+        _max_reply_latency = self.__limits[Watchdog.E_REPLY_LATENCY]
+        _found = []
+        for _node in _nodes:
+            _running, _alive, _last_tx, _tx_since, _queued, _request_time, _latency = _node._tx_status()
+            if not _running:
+                continue
+            if not _alive:
+                _found.append((Watchdog.E_DEAD, _node, _begin - _last_tx))
+                continue
+            if _tx_since is not None and _begin - _tx_since > _max_tx_stall:
+                _found.append((Watchdog.E_TX_STALL, _node, _begin - _tx_since))
+                pass
+            if _queued and _begin - _last_tx > _max_queue_age:
+                _found.append((Watchdog.E_QUEUE_AGE, _node, _begin - _last_tx))
+                pass
+            if _begin - _last_tx > _max_tx_gap:
+                _found.append((Watchdog.E_HEARTBEAT, _node, _begin - _last_tx))
+                pass
+            if _max_reply_latency is not None:
+                if _latency:
+                    # Each scan judges the replies sent since the scan before
+                    _latency = _node.reset_reply_latency()
+                    pass
+                if _request_time is not None and _begin - _request_time > _latency:
+                    _latency = _begin - _request_time
+                    pass
+                if _latency > _max_reply_latency:
+                    _found.append((Watchdog.E_REPLY_LATENCY, _node, _latency))
+                    pass
+                pass
+            pass
+        return self.__update(_found, _begin)
+
+    def __update(self, found: list, begin: float) -> list:
+        _begun = []
+        with self.__lock:
+            _active = {}
+            for _kind, _node, _value in found:
+                _key = (_node, _kind)
+                if _key not in self.__active:
+                    _begun.append((_kind, _node, _value))
+                    self.__counts[_kind] += 1
+                    pass
+                if _value > self.__worst[_kind]:
+                    self.__worst[_kind] = _value
+                    pass
+                _active[_key] = _value
+                pass
+            self.__active = _active
+            self.__scans += 1
+            pass
+        if self.__restart:
+            _restarted = set()
+            for _kind, _node, _value in _begun:
+                if _kind in (Watchdog.E_DEAD, Watchdog.E_TX_STALL) and _node not in _restarted:
+                    if _node.restart_tx():
+                        _restarted.add(_node)
+                        pass
+                    pass
+                pass
+            with self.__lock:
+                self.__restarts += len(_restarted)
+            pass
+        if self.__on_violation is not None:
+            for _kind, _node, _value in _begun:
+                try:
+                    self.__on_violation(_kind, _node, _value)
+                    pass
+                except Exception as _e:
+                    print('WARNING:', 'watchdog callback failed: {}'.format(_e))
+                    pass
+                pass
+            pass
+        self.__scan_time = time.monotonic() - begin
+        return _begun
+
+    def __run(self):
+        while not self.__terminal.wait(self.__interval):
+            self.check()
+            pass
+        pass
+
+    pass
+
+
+def main():
+    # 10 nodes on a device which blocks its sends for a while, then fails one node, with restart on
+    from BmcNode import Device, _can_error
+
+    class _StallDevice(Device):
+        def __init__(self):
+            super(_StallDevice, self).__init__()
+            self.count = 0
+            self.running = threading.Event()
+            self.running.set()
+            self.fail_index = None
+            pass
+
+        def send_message(self, msg):
+            self.running.wait()
+            if (msg.arbitration_id >> 24) & 0xf == self.fail_index:
+                self.fail_index = None
+                raise _can_error('bus off')
+            self.count += 1
+            pass
+
+        pass
+
+    def _poll():
+        # One request per node, a broadcast would be sent by the fan-out of the device in this thread
+        for _i in range(10):
+            _device.on_frame(((_i << 24) | 0x10000330) if _i else 0x1a000330, bytearray())
+            pass
+        pass
+
+    def _on_violation(kind, node, seconds):
+        print('{:.3f}s: {} of BMC {}, {:.3f}s'.format(time.monotonic() - _begin, kind, node.index, seconds))
+        pass
+
+    threading.excepthook = lambda args: print('BMC TX thread died: {}'.format(args.exc_value))
+    _device = _StallDevice()
+    _nodes = []
+    for _i in range(10):
+        _node = BmcNode(_i, _device)
+        _node.config(sku='GVSMODBC9')
+        _node.start()
+        _nodes.append(_node)
+        pass
+    _watchdog = Watchdog(_nodes, interval=0.05, max_tx_stall=0.3, on_violation=_on_violation, restart=True)
+    _watchdog.start()
+    _begin = time.monotonic()
+    _poll()
+    time.sleep(0.2)
+    print('the device is blocked')
+    _device.running.clear()
+    _poll()
+    time.sleep(0.6)
+    _device.running.set()
+    time.sleep(0.2)
+    print('BMC 3 fails a send')
+    _device.fail_index = 3
+    _device.on_frame(0x13000330, bytearray())
+    time.sleep(0.3)
+    _device.on_frame(0x13000330, bytearray())
+    time.sleep(0.2)
+    _metrics = _watchdog.metrics()
+    print('restarts: {}, violations: {}, active: {}'.format(
+        _metrics['restarts'], _metrics['violations'], sum(_metrics['active'].values())))
+    _watchdog.stop()
+    for _node in _nodes:
+        _node.stop()
+        pass
+
+    # The cost of a scan of started nodes, all checks run on every node
+    import sys
+    from BmcNode import start_all, stop_all
+    for _size in (1000, 4000):
+        _fleet = []
+        for _i in range(_size):
+            _node = BmcNode(_i % 10, _device)
+            _node.config(sku='GVSMODBC9')
+            _fleet.append(_node)
+            pass
+        _stdout = sys.stdout
+        sys.stdout = None  # the start and stop lines of the nodes
+        try:
+            start_all(_fleet)
+            _watchdog = Watchdog(_fleet)
+            _rounds = 20
+            _begin = time.perf_counter()
+            for _r in range(_rounds):
+                _watchdog.check()
+                pass
+            _elapsed = (time.perf_counter() - _begin) / _rounds
+            stop_all(_fleet)
+            pass
+        finally:
+            sys.stdout = _stdout
+            pass
+        print('scan of {} started nodes: {:.2f} ms, {:.2f} us per node'.format(_size, _elapsed * 1e3,
+                                                                             _elapsed / _size * 1e6))
+        pass
+    pass
+
+
+if __name__ == '__main__':
+    main()
+    pass